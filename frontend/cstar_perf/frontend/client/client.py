@@ -20,6 +20,7 @@ import shutil
 import traceback
 import urlparse
 import threading
+import io
 import psutil
 import glob
 from collections import namedtuple
@@ -37,7 +38,8 @@ from cstar_perf.frontend import CLIENT_CONFIG_PATH, KEEPALIVE_MARKER, EOF_MARKER
 from cstar_perf.frontend.lib.crypto import APIKey, BadConfigFileException
 from cstar_perf.frontend.lib.util import random_token, timeout, TimeoutError, format_bytesize, cd, generate_object_id, sha256_of_file
 from cstar_perf.frontend.lib.socket_comms import Command, Response, CommandResponseBase, receive_data, UnauthenticatedError
-from cstar_perf.tool.benchmark import CSTAR_PERF_LOGS_DIR
+from cstar_perf.tool.benchmark import STATS_JOURNAL_SUFFIX, compact_stats_journal
+from cstar_perf.tool.intervals import load_stats
 from api_client import APIClient
 
 logging.basicConfig(level=logging.DEBUG)
@@ -45,6 +47,14 @@ logging.getLogger('paramiko').setLevel(logging.WARNING)
 logging.getLogger('requests').setLevel(logging.WARNING)
 log = logging.getLogger('cstar_perf.client')
 
+# Size of the binary websocket frames artifacts are uploaded in, if the
+# server supports them. Can be set with artifact_frame_size in the
+# [cluster] section of client.conf:
+ARTIFACT_FRAME_SIZE = 512 * 1024
+# The number of artifact chunks kept in flight, if the server supports
+# windowed uploads. Can be set with chunk_window in client.conf:
+CHUNK_WINDOW = 4
+
 
 class JobFailure(Exception):
     pass
@@ -90,6 +100,10 @@ class WebSocketClient(object):
     def send(self, data_or_command_response, assertions={}):
         return self.__socket_comms('send', data_or_command_response, assertions)
 
+    def send_binary(self, data):
+        """Send data on the raw websocket as a binary frame"""
+        return self.__socket_comms('send_binary', data)
+
     def receive(self, ws_or_command_response, assertions={}):
         return self.__socket_comms('recv', ws_or_command_response, assertions)
 
@@ -102,10 +116,11 @@ class WebSocketClient(object):
         This wrapper is used to track websocket connection state and
         recover appropriately if the socket dies.
 
-        method - 'send', 'recv', or 'respond'
+        method - 'send', 'send_binary', 'recv', or 'respond'
 
         obj - Data to operate on, method dependent.
             send - either a text string to send on the websocket, or a prepared Command / Response object.
+            send_binary - a byte string to send on the raw websocket as a binary frame.
             recv - either a websocket object to receive from, or a Command / Response object.
             respond - a Command / Response object
 
@@ -133,6 +148,8 @@ class WebSocketClient(object):
                 elif method == 'send':
                     # Assume obj is a piece of data to send on the raw websocket:
                     data_or_response = self.ws.send(obj)
+                elif method == 'send_binary':
+                    data_or_response = self.ws.send_binary(obj)
                 if len(assertions) > 0:
                     assert isinstance(data_or_response, CommandResponseBase)
                     assertions = set(assertions.items())
@@ -191,6 +208,14 @@ class JobRunner(object):
     def __init__(self, ws_endpoint):
         self.__ws_client = WebSocketClient(ws_endpoint)
         self.ws_endpoint = ws_endpoint
+        config = ConfigParser.RawConfigParser()
+        config.read(CLIENT_CONFIG_PATH)
+        self.artifact_frame_size = ARTIFACT_FRAME_SIZE
+        if config.has_option('cluster', 'artifact_frame_size'):
+            self.artifact_frame_size = config.getint('cluster', 'artifact_frame_size')
+        self.chunk_window = CHUNK_WINDOW
+        if config.has_option('cluster', 'chunk_window'):
+            self.chunk_window = config.getint('cluster', 'chunk_window')
 
     def run(self):
         """Run a job, collect artifacts, send them to the server"""
@@ -262,6 +287,10 @@ class JobRunner(object):
                                       operations=job['operations'],
                                       title=job['title'],
                                       leave_data=job.get('leave_data', False),
+                                      compact_intervals=job.get('compact_intervals', False),
+                                      log_max_file_size=job.get('log_max_file_size'),
+                                      log_include=job.get('log_include'),
+                                      log_exclude=job.get('log_exclude'),
                                       log=stats_path))
 
         # Create a temporary location to store the stress_compare json file:
@@ -316,13 +345,15 @@ class JobRunner(object):
 
         response = self.__ws_client.receive(response, assertions={'message': 'stream_received', 'done': True})
 
-        # Find the log tarball for each revision by introspecting the stats json:
-        system_logs = []
+        # Find the flamegraph and yourkit tarballs for each revision by introspecting the stats json.
+        # (Cassandra logs are streamed into cassandra_logs.<test_id>.tar.gz by stress_compare directly):
         flamegraph_logs = []
         yourkit_logs = []
-        log_dir = CSTAR_PERF_LOGS_DIR
         flamegraph_dir = os.path.join(os.path.expanduser("~"), '.cstar_perf', 'flamegraph')
         yourkit_dir = os.path.join(os.path.expanduser("~"), '.cstar_perf', 'yourkit')
+        # stress_compare compacts its stats journal on exit, but if it
+        # was killed the journal may still be around:
+        compact_stats_journal(stats_path, compact=job.get('compact_intervals', False))
         #Create a stats summary file without voluminous interval data
         if os.path.isfile(stats_path):
             with open(stats_path) as stats:
@@ -330,7 +361,6 @@ class JobRunner(object):
                 for rev in stats['revisions']:
                     last_log_rev_id = rev.get('last_log')
                     if last_log_rev_id:
-                        system_logs.append(os.path.join(log_dir, "{name}.tar.gz".format(name=last_log_rev_id)))
                         fg_path = os.path.join(flamegraph_dir, "{name}.tar.gz".format(name=last_log_rev_id))
                         yourkit_path = os.path.join(yourkit_dir, "{name}.tar.gz".format(name=last_log_rev_id))
                         if os.path.exists(fg_path):
@@ -353,26 +383,6 @@ class JobRunner(object):
                     if hadStats:
                         json.dump(obj=stats, fp=summary, sort_keys=True, indent=4, separators=(',', ': '))
 
-        # Make a new tarball containing all the revision logs:
-        tmptardir = tempfile.mkdtemp()
-        try:
-            startup_log_tarball = self._maybe_get_startup_log_tarball(job['test_id'], log_dir)
-            if startup_log_tarball:
-                system_logs.append(startup_log_tarball)
-            job_log_dir = os.path.join(tmptardir, 'cassandra_logs.{test_id}'.format(test_id=job['test_id']))
-            os.mkdir(job_log_dir)
-            for x, syslog in enumerate(system_logs, 1):
-                with tarfile.open(syslog) as tar:
-                    tar.extractall(job_log_dir)
-                    os.rename(os.path.join(job_log_dir, tar.getnames()[0]), os.path.join(job_log_dir, 'revision_{x:02d}'.format(x=x)))
-            system_logs_path = os.path.join(job_dir, 'cassandra_logs.{test_id}.tar.gz'.format(test_id=job['test_id']))
-            with tarfile.open(system_logs_path, 'w:gz') as tar:
-                with cd(tmptardir):
-                    tar.add('cassandra_logs.{test_id}'.format(test_id=job['test_id']))
-            assert os.path.exists(system_logs_path)
-        finally:
-            shutil.rmtree(tmptardir)
-
         # Make a new tarball containing all the flamegraph and data
         if flamegraph_logs:
             tmptardir = tempfile.mkdtemp()
@@ -447,20 +457,6 @@ class JobRunner(object):
             with open(os.path.join(job_dir, '0.job_status'), 'w') as f:
                 f.write(final_status)
 
-    def _maybe_get_startup_log_tarball(self, job_id, log_dir):
-        """
-        In case something went wrong during startup of C*, we will basically only have a single tarball
-        with the startup log.
-        :param job_id: The id of the cstar_perf job
-        :param log_dir: The log directory
-        :return: The full path to the startup log tarball if it exists, otherwise None.
-        """
-        startup_logs_tarball = os.path.join(log_dir, "{name}.tar.gz".format(name=job_id))
-        if os.path.exists(startup_logs_tarball):
-            log.info('Found tarball with startup log at {loc}'.format(loc=startup_logs_tarball))
-            return startup_logs_tarball
-        return None
-
     def stream_artifacts(self, job_id):
         """Stream all job artifacts
 
@@ -546,6 +542,87 @@ class JobRunner(object):
         final_chunk_size = file_size - chunk_start
         yield(chunk_start, final_chunk_size, chunk_num)
 
+    def _send_binary_frames(self, fh, size, sha):
+        """Send size bytes from a file as binary websocket frames of up to artifact_frame_size
+
+        The file is read into a single reused buffer.
+        """
+        buf = memoryview(bytearray(self.artifact_frame_size))
+        remaining = size
+        while remaining > 0:
+            read = fh.readinto(buf[:min(remaining, self.artifact_frame_size)])
+            if not read:
+                raise IOError('{name} ended {remaining} bytes early'.format(name=fh.name, remaining=remaining))
+            sha.update(buf[:read])
+            self.__ws_client.send_binary(buf[:read].tobytes())
+            remaining -= read
+
+    @staticmethod
+    def _get_chunk_sha(fh, chunk_start, chunk_size):
+        fh.seek(chunk_start, os.SEEK_SET)
+        return hashlib.sha256(fh.read(chunk_size)).hexdigest()
+
+    def _send_chunk(self, fh, chunk_start, chunk_size, binary_frames):
+        """Send a chunk of a file as a data stream, returning its sha256"""
+        chunk_sha = hashlib.sha256()
+        fh.seek(chunk_start, os.SEEK_SET)
+        if binary_frames:
+            self._send_binary_frames(fh, chunk_size, chunk_sha)
+        else:
+            while fh.tell() < (chunk_start + chunk_size):
+                byte_size = 512 if fh.tell() + 512 < (chunk_start + chunk_size) else (chunk_start + chunk_size) - fh.tell()
+                data = fh.read(byte_size)
+                chunk_sha.update(data)
+                data = base64.b64encode(data)
+                self.__ws_client.send(data)
+        self.__ws_client.send(base64.b64encode(EOF_MARKER))
+        return chunk_sha.hexdigest()
+
+    def _stream_chunks_windowed(self, fh, chunks, window, **stream_args):
+        """Stream chunks keeping up to window of them in flight
+
+        The server acknowledges each chunk by chunk_id once it is
+        stored, in whatever order that happens.
+
+        chunks - list of (chunk_start, chunk_size, chunk_id) to send
+        stream_args - the object's chunk-stream parameters
+
+        returns the number of chunks the server stored with a matching sha
+        """
+        command = Command.new(self.__ws_client.socket(), action='chunk-stream-window', window=window,
+                              eof=EOF_MARKER, keepalive=KEEPALIVE_MARKER, frames='binary', **stream_args)
+        response = self.__ws_client.send(command, assertions={'message': 'ready'})
+        window = response.get('window', 1)
+
+        in_flight = {}  # chunk_id -> sha of the chunk sent
+        matching_chunks = [0]
+
+        def receive_ack():
+            ack = self.__ws_client.receive(command, assertions={'message': 'chunk_received'})
+            chunk_sha = in_flight.pop(ack.get('chunk_id'), None)
+            if chunk_sha is not None and chunk_sha == ack.get('chunk_sha'):
+                matching_chunks[0] += 1
+            else:
+                log.error('chunk upload failed: response[{}], objectid: [{}], name: [{}]'.format(
+                    ack, stream_args['object_id'], stream_args['name']))
+
+        for chunk_start, chunk_size, chunk_id in chunks:
+            while len(in_flight) >= window and self.__ws_client.in_sync():
+                receive_ack()
+            if not self.__ws_client.in_sync():
+                break
+            log.info("sending artifact[{}][{}] chunk: {}".format(stream_args['name'], stream_args['object_id'], chunk_id))
+            # The chunk header doesn't get a response of its own:
+            self.__ws_client.send(json.dumps(Command.new(self.__ws_client.socket(), action='chunk',
+                                                         chunk_id=chunk_id, chunk_size=chunk_size)))
+            in_flight[chunk_id] = self._send_chunk(fh, chunk_start, chunk_size, binary_frames=True)
+
+        while in_flight and self.__ws_client.in_sync():
+            receive_ack()
+        self.__ws_client.send(json.dumps(Command.new(self.__ws_client.socket(), action='chunk-window-end')))
+        self.__ws_client.receive(command, assertions={'message': 'chunks_received', 'done': True})
+        return matching_chunks[0]
+
     def stream_artifact_in_chunks(self, job_id, kind, name, path, binary=False):
         """Stream job artifact to server in chunks"""
 
@@ -554,7 +631,9 @@ class JobRunner(object):
         object_sha = sha256_of_file(path)
         num_chunks = len(list(self._get_chunks(file_size)))
 
-        query = Command.new(self.__ws_client.socket(), action='chunk-stream-query', object_id=object_id)
+        # Servers supporting windowed uploads respond with the window they accept:
+        query = Command.new(self.__ws_client.socket(), action='chunk-stream-query', object_id=object_id,
+                            window=self.chunk_window)
         query_result = self.__ws_client.send(query, assertions={'message': 'ok'})
         existing_chunk_shas = {}
         if 'stored_chunk_shas' in query_result and query_result['stored_chunk_shas'] != '':
@@ -563,33 +642,41 @@ class JobRunner(object):
 
         matching_uploaded_chunks = 0
         try:
-            for chunk_start, chunk_size, chunk_id in self._get_chunks(file_size):
-                # skip if server already has chunk stored
-                if str(chunk_id) in existing_chunk_shas:
-                    log.info("chunk {} already exists on server skipping upload".format(chunk_id))
-                    continue
-
-                log.info("sending artifact[{}][{}] chunk: {}".format(name, object_id, chunk_id))
-
-                command = Command.new(self.__ws_client.socket(), action='chunk-stream', test_id=job_id, file_size=file_size,
-                                      num_of_chunks=num_chunks, chunk_id=chunk_id, object_id=object_id,
-                                      object_sha=object_sha, chunk_size=chunk_size,
-                                      kind=kind, name=name, eof=EOF_MARKER, keepalive=KEEPALIVE_MARKER, binary=binary)
-                response = self.__ws_client.send(command, assertions={'message': 'ready'})
-
-                chunk_sha = hashlib.sha256()
-                with open(path) as fh:
-                    fh.seek(chunk_start, os.SEEK_SET)
-                    while fh.tell() < (chunk_start + chunk_size):
-                        byte_size = 512 if fh.tell() + 512 < (chunk_start + chunk_size) else (chunk_start + chunk_size) - fh.tell()
-                        data = fh.read(byte_size)
-                        chunk_sha.update(data)
-                        data = base64.b64encode(data)
-                        self.__ws_client.send(data)
-                    self.__ws_client.send(base64.b64encode(EOF_MARKER))
+            with io.open(path, 'rb') as fh:
+                chunks = []
+                for chunk_start, chunk_size, chunk_id in self._get_chunks(file_size):
+                    # skip if server already has chunk stored
+                    if str(chunk_id) in existing_chunk_shas and \
+                       existing_chunk_shas[str(chunk_id)] == self._get_chunk_sha(fh, chunk_start, chunk_size):
+                        log.info("chunk {} already exists on server skipping upload".format(chunk_id))
+                        matching_uploaded_chunks += 1
+                    else:
+                        chunks.append((chunk_start, chunk_size, chunk_id))
+
+                if query_result.get('window'):
+                    matching_uploaded_chunks += self._stream_chunks_windowed(
+                        fh, chunks, query_result['window'], test_id=job_id, file_size=file_size,
+                        num_of_chunks=num_chunks, object_id=object_id, object_sha=object_sha,
+                        kind=kind, name=name, binary=binary)
+                    return
+
+                for chunk_start, chunk_size, chunk_id in chunks:
+                    log.info("sending artifact[{}][{}] chunk: {}".format(name, object_id, chunk_id))
+
+                    # Ask for binary frames. Servers that don't support them
+                    # won't say so in their response, and get base64 frames:
+                    command = Command.new(self.__ws_client.socket(), action='chunk-stream', test_id=job_id, file_size=file_size,
+                                          num_of_chunks=num_chunks, chunk_id=chunk_id, object_id=object_id,
+                                          object_sha=object_sha, chunk_size=chunk_size,
+                                          kind=kind, name=name, eof=EOF_MARKER, keepalive=KEEPALIVE_MARKER, binary=binary,
+                                          frames='binary')
+                    response = self.__ws_client.send(command, assertions={'message': 'ready'})
+
+                    chunk_sha = self._send_chunk(fh, chunk_start, chunk_size,
+                                                 binary_frames=response.get('frames') == 'binary')
                     response = self.__ws_client.receive(response, assertions={'message': 'chunk_received', 'done': True})
 
-                    if 'chunk_sha' in response and chunk_sha.hexdigest() == response['chunk_sha']:
+                    if 'chunk_sha' in response and chunk_sha == response['chunk_sha']:
                         matching_uploaded_chunks += 1
                     else:
                         log.error('chunk upload failed: response[{}], objectid: [{}], chunkid: [{}], totalchunks: [{}], name: [{}]'
@@ -663,14 +750,13 @@ class JobRunner(object):
     def __spot_check_stats(self, job, stats_path):
         """Spot check stats to ensure it has the data it should contain"""
         try:
-            with open(stats_path) as stats:
-                stats = json.loads(stats.read())
-                for op_num, op in enumerate(job['operations']):
-                    assert stats['stats'][op_num]['type'] == op['type']
-                    if op['type'] in ('stress', 'nodetool'):
-                        assert stats['stats'][op_num]['command'].startswith(op['command'])
-                    if op['type'] == 'stress':
-                        assert len(stats['stats'][op_num]['intervals']) > 0
+            stats = load_stats(stats_path)
+            for op_num, op in enumerate(job['operations']):
+                assert stats['stats'][op_num]['type'] == op['type']
+                if op['type'] in ('stress', 'nodetool'):
+                    assert stats['stats'][op_num]['command'].startswith(op['command'])
+                if op['type'] == 'stress':
+                    assert len(stats['stats'][op_num]['intervals']) > 0
         except Exception, e:
             message = e.message
             stacktrace = traceback.format_exc(e)
@@ -679,24 +765,28 @@ class JobRunner(object):
 
     def __get_work(self):
         """Ask the server for work"""
-        command = Command.new(self.__ws_client.socket(), action='get_work')
-        response = command.send()
         while True:
-            # We either got a job, or we received a wait request:
-            if response.get('action') == 'wait':
-                response = response.receive()
-                continue
-            elif response.has_key('test'):
-                break
-            else:
-                raise AssertionError(
-                    'Response was neither a wait action, nor contained '
-                    'any test for us to run: {response}'.format(response=response))
-        job = response['test']
-        test_id = job['test_id']
-        response = response.respond(test_id=test_id, status='prepared')
-        assert response['status'] == 'in_progress'
-        return job
+            command = Command.new(self.__ws_client.socket(), action='get_work')
+            response = command.send()
+            while True:
+                # We either got a job, or we received a wait request:
+                if response.get('action') == 'wait':
+                    response = response.receive()
+                    continue
+                elif response.has_key('test'):
+                    break
+                else:
+                    raise AssertionError(
+                        'Response was neither a wait action, nor contained '
+                        'any test for us to run: {response}'.format(response=response))
+            job = response['test']
+            test_id = job['test_id']
+            response = response.respond(test_id=test_id, status='prepared')
+            if response['status'] == 'in_progress':
+                return job
+            # The test was cancelled before it started, ask for another one:
+            assert response['status'] == 'cancelled'
+            log.info("Job {test_id} was cancelled before it started".format(test_id=test_id))
 
     def __job_done(self, job_id, status='completed', message=None, stacktrace=None):
         """Tell the server we're done with a job, and give it the test artifacts"""
@@ -716,10 +806,18 @@ class JobRunner(object):
 
 
 class UpdateServerProgressMessageHandler(RegexMatchingEventHandler):
+    """Send a progress message to the server as stress_compare logs operations
+
+    Watches the stats journal, and only reads the records appended since
+    the last time it looked.
+    """
     def __init__(self, job, api_endpoint_url):
-        super(UpdateServerProgressMessageHandler, self).__init__(regexes=[r'^.*stats\..*\.json$'])
+        super(UpdateServerProgressMessageHandler, self).__init__(
+            regexes=[r'^.*stats\..*\.json{suffix}$'.format(suffix=re.escape(STATS_JOURNAL_SUFFIX))])
         self._api_endpoint_url = api_endpoint_url
         self._job = job
+        self._journal_offset = 0
+        self._ops_completed = 0
 
     def on_modified(self, event):
         self.__tell_server(event)
@@ -727,14 +825,35 @@ class UpdateServerProgressMessageHandler(RegexMatchingEventHandler):
     def on_created(self, event):
         self.__tell_server(event)
 
+    def __read_new_stats(self, path):
+        """Read the stats records appended to the journal since our last read"""
+        try:
+            with open(path) as fh:
+                fh.seek(self._journal_offset)
+                data = fh.read()
+        except IOError:
+            # The journal was compacted and removed:
+            return []
+        # Only consume complete lines, a record may still be being written:
+        data = data[:data.rfind('\n') + 1]
+        self._journal_offset += len(data)
+        new_stats = []
+        for line in data.splitlines():
+            record = json.loads(line)
+            if 'stats' in record:
+                new_stats.append(record['stats'])
+        return new_stats
+
     def __tell_server(self, event):
-        with open(event.src_path) as fh:
-            stats_json = json.loads(fh.read())
-        last_stat = stats_json['stats'][-1]
+        new_stats = self.__read_new_stats(event.src_path)
+        if not new_stats:
+            return
+        self._ops_completed += len(new_stats)
+        last_stat = new_stats[-1]
         total_ops = len(self._job['operations']) * len(self._job['revisions'])
 
         msg = "Last Op Completed: {}:{}, finished {} of {} total ops ({})".format(
-            last_stat['revision'], last_stat['type'], len(stats_json['stats']), total_ops, str(datetime.datetime.now())
+            last_stat['revision'], last_stat['type'], self._ops_completed, total_ops, str(datetime.datetime.now())
         )
         api_client = APIClient(self._api_endpoint_url)
         api_client.post('/tests/progress/id/{}'.format(self._job['test_id']), data=json.dumps({'progress_msg': msg}))
@@ -144,11 +144,20 @@ def receive_stream(ws, command, frame_callback):
     command - the Command object that issued the stream action. This will include the following things:
        - keepalive - denotes a frame that should be ignored, just for keeping the connection alive.
        - eof - denotes a frame that marks the end of the stream. This method will return True when it encounters this.
-    frame_callback is a function to call on each non keepalive, non eof, frame. It takes a single argument for the frame data.
+       - frames - 'binary' if the data is sent in binary frames. Otherwise,
+         every frame is base64 encoded. The eof and keepalive frames are
+         always base64 encoded text frames.
+    frame_callback is a function to call on each non keepalive, non eof, frame. It takes
+    the frame data, and whether the data is a byte string rather than unicode.
     """
     binary = command.get('binary', False)
+    binary_frames = command.get('frames') == 'binary'
     while True:
         data = ws.receive()
+        if binary_frames and not isinstance(data, unicode):
+            # Raw data, no need to decode:
+            frame_callback(data, True)
+            continue
         data = base64.b64decode(data)
         if not binary:
             data = unicode(data, "utf-8","ignore")
@@ -0,0 +1,48 @@
+"""Fill the denormalized tables added by schema migrations from existing data"""
+
+import argparse
+import logging
+
+from cstar_perf.frontend.server.util import load_app_config
+from cstar_perf.frontend.lib.util import auth_provider_if_configured
+
+log = logging.getLogger('cstar_perf.model')
+
+# Table name -> (Model method filling it, description of what was filled):
+BACKFILLS = {
+    'series_summaries': ('backfill_series_summaries', 'completed tests'),
+    'test_series': ('backfill_series_status', 'test statuses'),
+    'tests_by_user': ('backfill_tests_by_user', 'test_status rows'),
+    'tests_completed_by_month': ('backfill_tests_completed_by_month', 'tests_completed rows'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cstar_perf_backfill')
+    parser.add_argument('tables', nargs='+', choices=sorted(BACKFILLS.keys()),
+                        help='Tables to fill')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print log messages', dest='verbose')
+    args = parser.parse_args()
+
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    config = load_app_config()
+    cassandra_hosts = [h.strip() for h in config.get('server', 'cassandra_hosts').split(",")]
+    from cstar_perf.frontend.server.model import Model
+    from cassandra.cluster import Cluster
+
+    auth_provider = auth_provider_if_configured(config)
+    cluster = Cluster(contact_points=cassandra_hosts, auth_provider=auth_provider, connect_timeout=30)
+    keyspace = config.get('server', 'cassandra_keyspace') if config.has_option('server', 'cassandra_keyspace') else 'cstar_perf'
+    db = Model(cluster=cluster, keyspace=keyspace)
+
+    for table in args.tables:
+        method, description = BACKFILLS[table]
+        count = getattr(db, method)()
+        print("Filled {table} from {count} {description}".format(table=table, count=count, description=description))
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,22 +5,55 @@ import base64
 import uuid
 import os
 from flask import Flask
-import zmq
 import hashlib
-import cStringIO
+import tempfile
+import time
+import gevent
+import gevent.lock
+import gevent.pool
 
 from app import app, db, sockets
+from model import UnknownTestError, TestStatusConflictError
 from cstar_perf.frontend.lib.crypto import APIKey, BadConfigFileException
-from cstar_perf.frontend.lib.util import random_token
+from cstar_perf.frontend.lib.util import random_token, generate_object_id
 import cstar_perf.frontend.lib.socket_comms as socket_comms
 from cstar_perf.frontend.lib.socket_comms import Command, Response, receive_data, UnauthenticatedError
 from cstar_perf.frontend import SERVER_KEY_PATH
 from notifications import console_publish
+from dispatcher import Dispatcher
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('cstar_perf.cluster_api')
 
+# Scheduled tests of the clusters connected to this worker:
+dispatcher = Dispatcher(db)
+# Seconds a cluster waits for work before it is sent a wait response:
+WORK_WAIT_INTERVAL = 15
+# Wait responses between reloads of the cluster's queue from Cassandra,
+# which catch up on any scheduled notification that got lost:
+WORK_RELOAD_WAITS = 4
+
+# The most artifact chunks a client may have in flight at once:
+MAX_CHUNK_WINDOW = 8
+
+# Received data is kept in memory up to this size, then spooled to a temp file:
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+# Streamed artifacts are stored in chunks of this size as they arrive. This
+# is the client's chunk size, so a later chunked upload of the same
+# artifact finds the chunks already stored:
+STREAM_CHUNK_SIZE = 10485760
+
+# Console output is published at most this often, in seconds, or once
+# this many bytes are waiting:
+CONSOLE_BATCH_INTERVAL = 0.1
+CONSOLE_BATCH_MAX_SIZE = 64 * 1024
+
+# IN_PROGRESS is published at most this often per test while an artifact
+# is being received, in seconds:
+IN_PROGRESS_INTERVAL = 1.0
+
 class BadResponseError(Exception):
     pass
 
@@ -28,6 +61,41 @@ class CloseConnectionException(Exception):
     pass
 
 
+class ConsoleBatcher(object):
+    """Coalesce the console output of a job into fewer console messages
+
+    Output is published CONSOLE_BATCH_INTERVAL seconds after it first
+    arrives, or as soon as CONSOLE_BATCH_MAX_SIZE bytes are waiting.
+    """
+    def __init__(self, cluster_name, job_id, interval=CONSOLE_BATCH_INTERVAL, max_size=CONSOLE_BATCH_MAX_SIZE):
+        self.cluster_name = cluster_name
+        self.job_id = job_id
+        self.interval = interval
+        self.max_size = max_size
+        self.pending = []
+        self.pending_size = 0
+        self.timer = None
+
+    def write(self, msg):
+        self.pending.append(msg)
+        self.pending_size += len(msg)
+        if self.pending_size >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = gevent.spawn_later(self.interval, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            if self.timer is not gevent.getcurrent():
+                self.timer.kill(block=False)
+            self.timer = None
+        if self.pending:
+            msg = ''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            console_publish(self.cluster_name, {'job_id':self.job_id, 'msg':msg})
+
+
 @sockets.route('/api/cluster_comms')
 def cluster_comms(ws):
     """Websocket to communicate with the test clusters
@@ -87,6 +155,9 @@ def cluster_comms(ws):
         {type:'response', command_id:'yyy', test_id:'xxxxxxx'}
       * server updates status of test to in_progress in database
         {type:'response', command_id:'yyy', message:'test_updated', done:true}
+        or, if the test was cancelled meanwhile, tells the client to drop it
+        and ask for work again:
+        {type:'response', command_id:'yyy', test_id:'xxxxxxx', status:'cancelled', done:true}
       * client sends artifacts via streaming protocol (See below)
       * client sends 'ok, test done, artifacts sent.' request.
         {type:'command', command_id:'llll', action:'test_done', test_id:'xxxxxxx'}
@@ -108,6 +179,24 @@ def cluster_comms(ws):
       * Once $$$EOF$$$ is seen by the receiving peer, in it's own message, the receiving peer can respond:
         {type:'response', command_id='xxx', message:'stream_received', done:true}
 
+     Windowed chunk streaming:
+      protocol for sending the chunks of an artifact without waiting on each one.
+      * Sending peer asks which chunks are stored, and for the window it may use:
+        {type:'command', command_id='ccc', action:'chunk-stream-query', object_id='xxx', window=4}
+      * Receiving peer responds with the window it accepts (older servers don't include it):
+        {type:'response', command_id='ccc', message:'ok', stored_chunk_shas='0:sha,1:sha', window=4, done:true}
+      * Sending peer opens the window with the object's chunk-stream parameters:
+        {type:'command', command_id='www', action:'chunk-stream-window', object_id='xxx', window=4, ...}
+      * Receiving peer responds it is ready:
+        {type:'response', command_id='www', message:'ready', window=4}
+      * For each chunk, the sending peer sends a header and streams the chunk data up to $$$EOF$$$:
+        {type:'command', command_id='hhh', action:'chunk', chunk_id=0, chunk_size=10485760}
+      * Once each chunk is stored, in any order, the receiving peer responds:
+        {type:'response', command_id='www', message:'chunk_received', chunk_id=0, chunk_sha='sha'}
+      * The sending peer keeps at most window chunks unacknowledged, then closes the window:
+        {type:'command', command_id='eee', action:'chunk-window-end'}
+        {type:'response', command_id='www', message:'chunks_received', done:true}
+
     """
     context = {'apikey': APIKey.load(SERVER_KEY_PATH),
                'cluster': None}
@@ -139,59 +228,55 @@ def cluster_comms(ws):
             raise UnauthenticatedError("Our peer could not validate our signed auth token")
 
     def get_work(command):
-        # Mark any existing in_process jobs for this cluster as
-        # failed. If the cluster is asking for new work, then these
-        # got dropped on the floor:
-        for test in db.get_in_progress_tests(context['cluster']):
-            db.update_test_status(test['test_id'], 'failed')
-
-        # Find the next test scheduled for the client's cluster:
-        tests = db.get_scheduled_tests(context['cluster'], limit=1)
-        if len(tests) > 0:
-            test_id = tests[0]['test_id']
-        else:
-            # No tests are currently scheduled.
-            # Register a zmq listener of notifications of incoming tests, with a timeout.
-            # When we see any test scheduled notification for our cluster, redo the query.
-            # If timeout reached, redo the query anyway in case we missed the notification.
-            def setup_zmq():
-                zmq_context = zmq.Context()
-                zmq_socket = zmq_context.socket(zmq.SUB)
-                zmq_socket.connect('tcp://127.0.0.1:5557')
-                zmq_socket.setsockopt_string(
-                    zmq.SUBSCRIBE, 
-                    unicode('scheduled {cluster} '.format(cluster=context['cluster'])))
-                zmq_socket.setsockopt(zmq.RCVTIMEO, 15000)
-                return zmq_socket
-            zmq_socket = setup_zmq()
-            while True:
-                try:
-                    cluster, test_id = zmq_socket.recv_string().split()
-                except zmq.error.Again:
-                    pass
-                except zmq.error.ZMQError, e:
-                    if e.errno == zmq.POLLERR:
-                        log.error(e)
-                        # Interrupted zmq socket code, reinitialize:
-                        # I get this when I resize my terminal.. WTF?
-                        zmq_socket = setup_zmq()
-                finally:
-                    tests = db.get_scheduled_tests(context['cluster'], limit=1)
-                    if len(tests) > 0:
-                        test_id = tests[0]['test_id']
-                        break
-                    else:
-                        # Send no-work-yet message:
-                        console_publish(context['cluster'], {'ctl':'WAIT'})
-                        command.respond(action='wait', follow_up=False)
-        test = db.get_test(test_id)
-        # Give the test to the client:
-        response = command.respond(test=test)
-        # Expect an prepared status message back:
-        assert response['test_id'] == test['test_id'] and \
-            response['status'] == 'prepared'
-        # Update the test status:
-        db.update_test_status(test['test_id'], 'in_progress')
+        if not context.get('work_requested'):
+            # Mark any existing in_process jobs for this cluster as
+            # failed. If the cluster is asking for new work on a new
+            # connection, then these got dropped on the floor:
+            for test in db.get_in_progress_tests(context['cluster']):
+                db.update_test_status(test['test_id'], 'failed')
+            # Catch up on tests scheduled while the cluster was away:
+            dispatcher.load(context['cluster'])
+            context['work_requested'] = True
+
+        waits = 0
+        while True:
+            # Wait for the next test scheduled for the client's cluster,
+            # letting the client know we're still here every so often:
+            test_id = dispatcher.get(context['cluster'], timeout=WORK_WAIT_INTERVAL)
+            if test_id is None:
+                # Send no-work-yet message:
+                console_publish(context['cluster'], {'ctl':'WAIT'})
+                command.respond(action='wait', follow_up=False)
+                waits += 1
+                if waits % WORK_RELOAD_WAITS == 0:
+                    dispatcher.load(context['cluster'])
+                continue
+            # The queue may be behind on a test cancelled or deleted meanwhile:
+            try:
+                test = db.get_test(test_id)
+            except UnknownTestError:
+                continue
+            if test['status'] == 'scheduled':
+                break
+        try:
+            # Give the test to the client:
+            response = command.respond(test=test)
+            # Expect an prepared status message back:
+            assert response['test_id'] == test['test_id'] and \
+                response['status'] == 'prepared'
+            # Update the test status, unless it was cancelled while the
+            # client prepared it:
+            try:
+                db.update_test_status(test['test_id'], 'in_progress', test=test, expected_status='scheduled')
+            except TestStatusConflictError, e:
+                log.info("Not starting {test_id}: {e}".format(test_id=test['test_id'], e=e))
+                # Let the client know to drop it:
+                response.respond(test_id=test['test_id'], status="cancelled", done=True)
+                return
+        except:
+            # Still scheduled, so leave it for the next request:
+            dispatcher.requeue(context['cluster'], test_id)
+            raise
         # Let the client know they can start it:
         response.respond(test_id=test['test_id'], status="in_progress", done=True)
 
@@ -206,8 +291,12 @@ def cluster_comms(ws):
         command.respond(test_id=command['test_id'], message='test_update', done=True)
 
     def receive_artifact_chunk_object(command):
-        command.respond(message="ready", follow_up=False, done=False)
-        tmp = cStringIO.StringIO()
+        if command.get('frames') == 'binary':
+            # Let the client know we accept binary frames:
+            command.respond(message="ready", frames='binary', follow_up=False, done=False)
+        else:
+            command.respond(message="ready", follow_up=False, done=False)
+        tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
         chunk_sha = hashlib.sha256()
 
         def frame_callback(frame, binary):
@@ -224,13 +313,58 @@ def cluster_comms(ws):
         # respond with current sha
         command.respond(message='chunk_received', done=True, chunk_id=command['chunk_id'], chunk_sha=chunk_sha.hexdigest())
 
+    def receive_artifact_chunk_window(command):
+        """Receive chunks of an object back to back, acknowledging each one once stored"""
+        window = max(1, min(command.get('window', 1), MAX_CHUNK_WINDOW))
+        command.respond(message="ready", window=window, follow_up=False, done=False)
+        # Chunks are stored concurrently, while the next ones are received:
+        pool = gevent.pool.Pool(window)
+        send_lock = gevent.lock.Semaphore()
+
+        def store_chunk(chunk_id, chunk_size, chunk_sha, data):
+            try:
+                db.insert_artifact_chunk(command['object_id'], chunk_id, chunk_size, chunk_sha, data,
+                                         command['num_of_chunks'], command['file_size'], command['object_sha'])
+            except Exception:
+                log.exception("Failed to store chunk {} of {}".format(chunk_id, command['object_id']))
+                chunk_sha = None
+            with send_lock:
+                command.respond(message='chunk_received', follow_up=False, done=False,
+                                chunk_id=chunk_id, chunk_sha=chunk_sha)
+
+        while True:
+            chunk = receive_data(ws)
+            if chunk['action'] == 'chunk-window-end':
+                break
+            assert chunk['action'] == 'chunk', "Unexpected command in chunk window: {}".format(chunk)
+            tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+            chunk_sha = hashlib.sha256()
+
+            def frame_callback(frame, binary):
+                if not binary:
+                    frame = frame.encode("utf-8")
+                chunk_sha.update(frame)
+                tmp.write(frame)
+
+            socket_comms.receive_stream(ws, command, frame_callback)
+            # Waits for a free slot if window chunks are still being stored:
+            pool.spawn(store_chunk, chunk['chunk_id'], chunk['chunk_size'], chunk_sha.hexdigest(), tmp)
+
+        pool.join()
+        command.respond(message='chunks_received', done=True)
+
     def receive_artifact_chunk_complete(command):
         db.update_test_artifact(command['test_id'], command['kind'], None, command['name'],
                                 available=command['successful'], object_id=command['object_id'])
         command.respond(message='ok', stored_chunk_shas=_get_stored_chunks(command['object_id']), done=True)
 
     def receive_artifact_chunk_query(command):
-        command.respond(message='ok', stored_chunk_shas=_get_stored_chunks(command['object_id']), done=True)
+        if 'window' in command:
+            # Let the client know it can use chunk-stream-window:
+            command.respond(message='ok', stored_chunk_shas=_get_stored_chunks(command['object_id']),
+                            window=max(1, min(command['window'], MAX_CHUNK_WINDOW)), done=True)
+        else:
+            command.respond(message='ok', stored_chunk_shas=_get_stored_chunks(command['object_id']), done=True)
 
     def _get_stored_chunks(object_id):
         """
@@ -251,20 +385,49 @@ def cluster_comms(ws):
             except OSError:
                 pass
             console = open(os.path.join(console_dir, command['test_id']), "w")
-        tmp = cStringIO.StringIO()
+            console_batcher = ConsoleBatcher(context['cluster'], command['test_id'])
+        last_in_progress = [0]
+        # The stream is stored in chunked object storage as it arrives,
+        # so only one chunk is held at a time:
+        object_id = generate_object_id(command['test_id'], command['kind'], command['name'])
         sha = hashlib.sha256()
+        stored = {'chunks': 0, 'size': 0}
+        chunk = {}
+
+        def new_chunk():
+            chunk['data'] = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+            chunk['sha'] = hashlib.sha256()
+            chunk['size'] = 0
+
+        def store_chunk():
+            db.insert_artifact_chunk(object_id, stored['chunks'], chunk['size'], chunk['sha'].hexdigest(),
+                                     chunk['data'], None, None, None)
+            chunk['data'].close()
+            stored['chunks'] += 1
+            stored['size'] += chunk['size']
+            new_chunk()
+
+        new_chunk()
         try:
             def frame_callback(frame, binary):
                 if not binary:
                     frame = frame.encode("utf-8")
                 if command['kind'] == 'console':
                     console.write(frame)
-                    console_publish(context['cluster'], {'job_id':command['test_id'], 'msg':frame})
+                    console_batcher.write(frame)
                     console.flush()
-                else:
+                elif time.time() - last_in_progress[0] >= IN_PROGRESS_INTERVAL:
                     console_publish(context['cluster'], {'job_id':command['test_id'], 'ctl':'IN_PROGRESS'})
+                    last_in_progress[0] = time.time()
                 sha.update(frame)
-                tmp.write(frame)
+                while frame:
+                    data = frame[:STREAM_CHUNK_SIZE - chunk['size']]
+                    frame = frame[len(data):]
+                    chunk['data'].write(data)
+                    chunk['sha'].update(data)
+                    chunk['size'] += len(data)
+                    if chunk['size'] == STREAM_CHUNK_SIZE:
+                        store_chunk()
             socket_comms.receive_stream(ws, command, frame_callback)
             if command['kind'] == 'console':
                 console.close()
@@ -275,8 +438,13 @@ def cluster_comms(ws):
             # what we have of the artifact to the database. Better to
             # have something than nothing. It's the client's
             # responsibility to resend artifacts that failed.
-
-            db.update_test_artifact(command['test_id'], command['kind'], tmp, command['name'])
+            if command['kind'] == 'console':
+                console_batcher.flush()
+            if chunk['size'] or not stored['chunks']:
+                store_chunk()
+            db.set_chunk_object_info(object_id, stored['chunks'], stored['size'], sha.hexdigest())
+            db.update_test_artifact(command['test_id'], command['kind'], None, command['name'],
+                                    available=True, object_id=object_id)
 
         command.respond(message='stream_received', done=True, sha256=sha.hexdigest())
         
@@ -300,6 +468,8 @@ def cluster_comms(ws):
                 receive_artifact_chunk_query(command)
             elif command['action'] == 'chunk-stream':
                 receive_artifact_chunk_object(command)
+            elif command['action'] == 'chunk-stream-window':
+                receive_artifact_chunk_window(command)
             elif command['action'] == 'chunk-stream-complete':
                 receive_artifact_chunk_complete(command)
             elif command['action'] == 'good_bye':
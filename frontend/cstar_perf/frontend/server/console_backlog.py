@@ -0,0 +1,111 @@
+"""Persistent console backlog of the clusters
+
+Each cluster's console messages are numbered with a sequence number and
+kept up to a byte budget, oldest dropped first. They are also appended to
+a log file per cluster, so the backlog survives a restart. The log file
+is rewritten from the messages still in the backlog once it grows past
+twice the budget.
+
+Messages are stored as the JSON text they were published with, so they
+can be replayed without being decoded and encoded again.
+"""
+
+import os
+import urllib
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+CONSOLE_BACKLOG_DIR = os.path.join(os.path.expanduser("~"), ".cstar_perf", "console_backlog")
+CONSOLE_BACKLOG_SIZE = 1024 * 1024
+
+
+class ClusterBacklog(object):
+    """The console backlog of one cluster
+
+    Entries are (seq, job_id, msg) tuples.
+    """
+    def __init__(self, path, max_size=CONSOLE_BACKLOG_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.entries = deque()
+        self.size = 0
+        self.next_seq = 0
+        self._load()
+        self.log_file = open(self.path, 'a')
+
+    def _append(self, seq, job_id, msg):
+        self.entries.append((seq, job_id, msg))
+        self.size += len(msg)
+        while self.size > self.max_size and len(self.entries) > 1:
+            self.size -= len(self.entries.popleft()[2])
+        self.next_seq = seq + 1
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    seq, job_id, msg = line.rstrip('\n').split(' ', 2)
+                    self._append(int(seq), job_id, msg)
+                except ValueError:
+                    log.warn("Skipping bad console backlog line in {path}".format(path=self.path))
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries:
+                f.write('{} {} {}\n'.format(*entry))
+        os.rename(tmp_path, self.path)
+        self.log_file.close()
+        self.log_file = open(self.path, 'a')
+
+    def add(self, job_id, msg):
+        """Add a message to the backlog, returning its sequence number"""
+        seq = self.next_seq
+        job_id = job_id or '-'
+        self._append(seq, job_id, msg)
+        self.log_file.write('{} {} {}\n'.format(seq, job_id, msg))
+        self.log_file.flush()
+        if self.log_file.tell() > self.max_size * 2:
+            self._compact()
+        return seq
+
+    def replay(self, from_seq=0, job_id=None):
+        """Get the (seq, msg) of the messages since from_seq, of all jobs or of job_id"""
+        return [(seq, msg) for seq, entry_job_id, msg in self.entries
+                if seq >= from_seq and (job_id is None or entry_job_id == job_id)]
+
+
+class ConsoleBacklog(object):
+    """The console backlogs of all the clusters"""
+    def __init__(self, directory=CONSOLE_BACKLOG_DIR, max_size=CONSOLE_BACKLOG_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.clusters = {}
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+    def _path(self, cluster_name):
+        return os.path.join(self.directory, urllib.quote(cluster_name, safe='') + '.log')
+
+    def __getitem__(self, cluster_name):
+        """Get the backlog of a cluster, creating it if it doesn't exist"""
+        try:
+            return self.clusters[cluster_name]
+        except KeyError:
+            backlog = self.clusters[cluster_name] = ClusterBacklog(self._path(cluster_name), self.max_size)
+            return backlog
+
+    def get(self, cluster_name):
+        """Get the backlog of a cluster, or None if it has none
+
+        Unlike [], nothing is created for a cluster without a backlog.
+        """
+        if cluster_name not in self.clusters and not os.path.exists(self._path(cluster_name)):
+            return None
+        return self[cluster_name]
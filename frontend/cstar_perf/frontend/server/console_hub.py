@@ -0,0 +1,147 @@
+"""Fan out console messages to the websockets of a frontend worker
+
+Each worker has a single ConsoleHub. It subscribes to the console
+monitor once per cluster being watched, however many browsers watch
+it, and queues every message for each of that cluster's websockets.
+New subscriptions start with the backlog replayed by the console
+monitor, from a given sequence number.
+"""
+
+import logging
+import re
+from collections import defaultdict, deque
+
+import gevent
+import gevent.event
+import zmq.green as zmq
+
+from notifications import CONSOLE_MONITOR_PORT_SUB, console_replay
+
+log = logging.getLogger('cstar_perf.console_hub')
+
+# The most messages queued for one websocket. When a client falls behind,
+# the oldest messages are dropped:
+CLIENT_QUEUE_SIZE = 1000
+
+# The sequence number console_monitor_service appends to messages:
+SEQ_PATTERN = re.compile(r'"seq": (\d+), "realtime": (?:true|false)\}$')
+
+
+def message_seq(msg):
+    match = SEQ_PATTERN.search(msg)
+    return int(match.group(1)) if match else None
+
+
+class ConsoleSubscription(object):
+    """The bounded queue of console messages for one websocket"""
+    def __init__(self, hub, cluster_name, from_seq=0, maxlen=CLIENT_QUEUE_SIZE):
+        self.hub = hub
+        self.cluster_name = cluster_name
+        self.queue = deque(maxlen=maxlen)
+        self.event = gevent.event.Event()
+        self.dropped = 0
+        # Messages before this one were already queued, or not asked for:
+        self.next_seq = from_seq
+        # Messages received while the backlog is being replayed:
+        self.held = None
+
+    def put(self, msg, seq):
+        if self.held is not None:
+            self.held.append((msg, seq))
+            return
+        if seq is not None:
+            if seq < self.next_seq:
+                return
+            self.next_seq = seq + 1
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(msg)
+        self.event.set()
+
+    def get(self, timeout=None):
+        """Get the next message, or None if there was none within timeout seconds"""
+        if not self.queue:
+            self.event.clear()
+            self.event.wait(timeout)
+            if not self.queue:
+                return None
+        return self.queue.popleft()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class ConsoleHub(object):
+    def __init__(self, url='tcp://localhost:{port}'.format(port=CONSOLE_MONITOR_PORT_SUB)):
+        self.url = url
+        self.socket = None
+        self.reader = None
+        self.subscriptions = defaultdict(set)  # cluster_name -> set of ConsoleSubscription
+
+    @staticmethod
+    def _topic(cluster_name):
+        return u'console {cluster_name} '.format(cluster_name=cluster_name)
+
+    def _start(self):
+        # Started on first use, so the socket belongs to the worker process:
+        if self.socket is None:
+            self.socket = zmq.Context.instance().socket(zmq.SUB)
+            self.socket.connect(self.url)
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read)
+
+    def subscribe(self, cluster_name, from_seq=0):
+        """Get a ConsoleSubscription to the messages of a cluster
+
+        from_seq - the sequence number of the first backlog message to replay
+        """
+        self._start()
+        subscription = ConsoleSubscription(self, cluster_name, from_seq)
+        # Hold on to live messages until the backlog is queued:
+        subscription.held = []
+        if not self.subscriptions[cluster_name]:
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, self._topic(cluster_name))
+        self.subscriptions[cluster_name].add(subscription)
+        try:
+            replay = console_replay(cluster_name, from_seq, zmq=zmq)
+        except:
+            self.unsubscribe(subscription)
+            raise
+        if replay is None:
+            log.error("console_monitor_service did not replay the backlog of {cluster}".format(cluster=cluster_name))
+            replay = from_seq, []
+        replay_from, backlog = replay
+        if replay_from < from_seq:
+            # The sequence numbers started over, messages from before
+            # from_seq are new ones:
+            subscription.next_seq = replay_from
+        held, subscription.held = subscription.held, None
+        # Messages replayed and received live are told apart by sequence number:
+        for msg in backlog:
+            subscription.put(msg, message_seq(msg))
+        for msg, seq in held:
+            subscription.put(msg, seq)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        cluster_name = subscription.cluster_name
+        self.subscriptions[cluster_name].discard(subscription)
+        if subscription.dropped:
+            log.info("Dropped {n} console messages of {cluster} for a slow client".format(
+                n=subscription.dropped, cluster=cluster_name))
+        if not self.subscriptions[cluster_name]:
+            del self.subscriptions[cluster_name]
+            self.socket.setsockopt_string(zmq.UNSUBSCRIBE, self._topic(cluster_name))
+
+    def _read(self):
+        while True:
+            try:
+                data = self.socket.recv_string()
+            except zmq.ZMQError:
+                log.exception("Error receiving console messages")
+                gevent.sleep(1)
+                continue
+            topic, cluster_name, msg = data.split(' ', 2)
+            seq = message_seq(msg)
+            for subscription in list(self.subscriptions.get(cluster_name, ())):
+                subscription.put(msg, seq)
@@ -11,7 +11,6 @@ import time
 from datetime import datetime
 from functools import partial
 
-import zmq
 import json
 import ConfigParser
 from flask import ( Flask, render_template, request, redirect, abort, Response,
@@ -26,8 +25,9 @@ from oauth2client.client import ( AccessTokenRefreshError,
                                   FlowExchangeError)
 
 from app import app, app_config, db, sockets
-from model import Model, UnknownUserError, UnknownTestError
-from notifications import console_subscribe
+from model import Model, UnknownUserError, UnknownTestError, TestStatusConflictError
+from console_hub import ConsoleHub
+from dispatcher import queue_stats
 from cstar_perf.frontend.lib.util import random_token
 from cstar_perf.frontend.lib import screenshot, stupid_cache
 from cstar_perf.frontend import SERVER_KEY_PATH
@@ -36,6 +36,17 @@ from cstar_perf.frontend.lib.crypto import APIKey
 import logging
 log = logging.getLogger('cstar_perf.controllers')
 
+# Console messages of all the websockets of this worker:
+console_hub = ConsoleHub()
+# Seconds without console messages before a websocket is sent a keepalive:
+CONSOLE_KEEPALIVE_INTERVAL = 5
+
+# Page sizes of the /api/tests listing:
+DEFAULT_TESTS_PAGE_SIZE = 1000
+MAX_TESTS_PAGE_SIZE = 5000
+# Completed tests shown per page of /tests:
+COMPLETED_TESTS_PAGE_SIZE = 100
+
 ### Setup authentication method configured in server.conf:
 try:
     authentication_type = app_config.get("server", "authentication_type")
@@ -215,11 +226,16 @@ def tests():
         in_progress_tests = db.get_in_progress_tests(c)
         if len(in_progress_tests) > 0:
             cluster_in_progress_tests[c] = in_progress_tests
-    completed_tests = db.get_completed_tests()
+    try:
+        completed_tests, next_page = db.get_completed_tests_page(
+            page_size=COMPLETED_TESTS_PAGE_SIZE, page=request.args.get('page', None))
+    except ValueError:
+        return make_response('Invalid page.', 400)
+    next_url = url_for('tests', page=next_page) if next_page else None
     return render_template('tests.jinja2.html', clusters=clusters, 
                            cluster_scheduled_tests=cluster_scheduled_tests, 
                            cluster_in_progress_tests=cluster_in_progress_tests,
-                           completed_tests=completed_tests)
+                           completed_tests=completed_tests, next_url=next_url)
 
 @app.route('/tests/user')
 @requires_auth('user')
@@ -266,8 +282,6 @@ def get_artifact(test_id, artifact_type, artifact_name=None):
     if not artifact_name:
         return make_response(jsonify({'error':'No artifact name provided.'}), 400)
 
-    artifact, object_id, artifact_available = db.get_test_artifact_data(test_id, artifact_type, artifact_name)
-
     if artifact_name.endswith(".tar.gz"):
         mimetype = 'application/gzip'
     elif artifact_name.endswith(".json"):
@@ -276,14 +290,54 @@ def get_artifact(test_id, artifact_type, artifact_name=None):
         mimetype = 'image/svg+xml'
     else:
         mimetype = 'text/plain'
+    headers = {"Content-Disposition": "filename={name}".format(name=artifact_name)}
 
-    if artifact is None and object_id is not None and artifact_available:
+    try:
+        artifact_meta = db.get_test_artifact(test_id, artifact_type, artifact_name)
+    except IndexError:
+        return make_response(jsonify({'error':'Artifact not found.'}), 404)
+
+    if not (artifact_meta['object_id'] and artifact_meta['artifact_available']):
+        # Old style artifact, stored in a single blob:
+        artifact, object_id, artifact_available = db.get_test_artifact_data(test_id, artifact_type, artifact_name)
+        return Response(response=artifact,
+                        status=200,
+                        mimetype=mimetype,
+                        headers=headers)
+
+    # Chunked artifact, streamed to the client one chunk at a time:
+    object_id = artifact_meta['object_id']
+    chunk_info = db.get_base_chunk_info(object_id)
+    size = db.get_object_size(object_id, chunk_info)
+    etag = '"{sha}"'.format(sha=chunk_info['object_sha'])
+    headers['ETag'] = etag
+    headers['Accept-Ranges'] = 'bytes'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    byte_range = request.range
+    if byte_range and byte_range.units == 'bytes' and len(byte_range.ranges) == 1 and \
+       request.headers.get('If-Range', etag) == etag:
+        requested = byte_range.range_for_length(size)
+        if requested is None:
+            headers['Content-Range'] = 'bytes */{size}'.format(size=size)
+            return Response(status=416, headers=headers)
+        start, stop = requested
+        status = 206
+        headers['Content-Range'] = 'bytes {start}-{end}/{size}'.format(start=start, end=stop - 1, size=size)
+    headers['Content-Length'] = str(stop - start)
+
+    if status == 200:
         artifact = db.generate_object_by_chunks(object_id)
-
+    else:
+        artifact = db.generate_object_by_chunks(object_id, start, stop)
     return Response(response=artifact,
-                    status=200,
+                    status=status,
                     mimetype=mimetype,
-                    headers={"Content-Disposition": "filename={name}".format(name=artifact_name)})
+                    headers=headers,
+                    direct_passthrough=True)
 
 @app.route('/graph')
 def graph():
@@ -367,46 +421,57 @@ def cancel_test():
     if test['status'] == 'in_progress' or test['status'] == 'cancel_pending':
         new_status = 'cancel_pending'
 
-    if user_in_role('admin'):
-        db.update_test_status(test_id, new_status)
-    else:
-        # Check if the test is owned by the user:
-        if test['user'] == get_user_id():
-            db.update_test_status(test_id, new_status)
-        else:
-            return make_response(jsonify({'error':'Access Denied to modify test {test_id}'
-                            .format(test_id=test_id)}), 401)
+    # Check if the test is owned by the user:
+    if not user_in_role('admin') and test['user'] != get_user_id():
+        return make_response(jsonify({'error':'Access Denied to modify test {test_id}'
+                        .format(test_id=test_id)}), 401)
+    try:
+        # Don't overwrite a status the cluster set since the test was read:
+        db.update_test_status(test_id, new_status, test=test, expected_status=test['status'])
+    except TestStatusConflictError, e:
+        return make_response(jsonify({'error':str(e)}), 409)
     return jsonify({'success':'Test cancelled'})
 
 @app.route('/api/tests')
 def get_tests():
-    """Retreive all completed tests"""
+    """Retreive completed tests, most recently completed first
 
-    completed_tests = db.get_completed_tests()
+    Tests are returned a page at a time. When there are more, the Link
+    header has the URL of the next page."""
 
-    # Apply filters
     try:
         param_from = request.args.get('date_from', None)
         param_to = request.args.get('date_to', None)
-        date_from = datetime.fromtimestamp(float(param_from)) if param_from else None
-        date_to = datetime.fromtimestamp(float(param_to)) if param_to else None
+        date_from = float(param_from) if param_from else None
+        date_to = float(param_to) if param_to else None
     except:
         return make_response(jsonify({'error':'Invalid date parameters.'}), 400)
-
-    if date_from:
-        completed_tests = [t for t in completed_tests if t['scheduled_date'] >= date_from]
-    if date_to:
-        completed_tests = [t for t in completed_tests if t['scheduled_date'] <= date_to]
+    try:
+        page_size = min(int(request.args.get('page_size', DEFAULT_TESTS_PAGE_SIZE)), MAX_TESTS_PAGE_SIZE)
+        page = request.args.get('page', None)
+        if page_size < 1:
+            raise ValueError
+        completed_tests, next_page = db.get_completed_tests_page(
+            page_size=page_size, page=page, date_from=date_from, date_to=date_to)
+    except (ValueError, TypeError):
+        return make_response(jsonify({'error':'Invalid paging parameters.'}), 400)
 
     tests = map(lambda t: {
         'test_id': t['test_id'],
         'href': url_for('get_test', test_id=t['test_id'])
     }, completed_tests)
 
+    headers = {}
+    if next_page:
+        next_url = url_for('get_tests', page=next_page, page_size=page_size,
+                           date_from=param_from, date_to=param_to)
+        headers['Link'] = '<{url}>; rel="next"'.format(url=next_url)
+
     response = json.dumps(obj=tests)
     return Response(response=response,
                     status=200,
-                    mimetype= 'application/json')
+                    mimetype= 'application/json',
+                    headers=headers)
 
 @app.route('/api/tests/id/<test_id>')
 @requires_auth('user')
@@ -434,9 +499,7 @@ def get_series_list():
 
 @app.route('/api/series/<series>/<start_timestamp>/<end_timestamp>')
 def get_series( series, start_timestamp, end_timestamp):
-    series = db.get_series( series, start_timestamp, end_timestamp)
-    # barf -- like below this sucks -- changing the series table to include status needs to be done
-    valid_jobs = [job_id for job_id in series if db.get_test_status(job_id) == 'completed']
+    valid_jobs = db.get_series( series, start_timestamp, end_timestamp, status='completed')
 
     jsobj = {'series': valid_jobs}
     if 'true' == request.args.get('pretty', 'True').lower():
@@ -447,37 +510,14 @@ def get_series( series, start_timestamp, end_timestamp):
                     status=200,
                     mimetype='application/json')
 
-def get_series_summaries_impl(series, start_timestamp, end_timestamp):
-    series = db.get_series(series, start_timestamp, end_timestamp)
-    summaries = []
-    for test_id in series:
-        status = db.get_test_status(test_id)
-        if status == 'completed':
-            artifact = db.get_test_artifact_data(test_id, 'stats_summary', 'stats_summary.{}.json'.format(test_id))
-            if artifact and artifact[0]:
-                summaries.append(json.loads(artifact[0]))
-    return summaries
-
 @app.route('/api/series/<series>/<start_timestamp>/<end_timestamp>/summaries')
 def get_series_summaries(series, start_timestamp, end_timestamp):
-    summaries = get_series_summaries_impl(series, start_timestamp, end_timestamp)
-    # Construct the response in two passes, first sort the data points on the UUID
-    # Then denormalize to arrays for each metric
-    # Operation -> revision label -> uuid (for ordering) -> metrics as a bloc
+    # The stats summaries of completed tests are indexed in the
+    # series_summaries table, sorted by operation, revision label (not
+    # actual revision branch/tag,sha), test id and stat id:
+    # Operation -> revision label -> uuids (for ordering) -> metrics as a bloc
     # Then do Operation -> revision label -> metrics as arrays (already sorted)
-    byOperation = {}
-
-    for summary in summaries:
-        # First get everything sorted by operation, revision label (not actual revision branch/tag,sha), test id
-        for stat in summary['stats']:
-            if 'test' not in stat:
-                log.error("stat summary without test key: {}".format(stat['id']))
-                continue
-            operationStats = byOperation.setdefault(stat['test'], {})
-            revisionStats = operationStats.setdefault(stat['label'], OrderedDict())
-            revisionStats[uuid.UUID(stat['id'])] = stat
-            del stat['test']
-            del stat['label']
+    byOperation = db.get_series_summaries(series, start_timestamp, end_timestamp)
 
     # Now flatten the entire thing to arrays for each operation -> revision
     summaries = {}
@@ -579,6 +619,14 @@ def get_clusters_by_name(cluster_name):
     return make_response(jsonify(clusters[cluster_name]))
 
 
+@app.route('/api/clusters/<cluster_name>/queue')
+@requires_auth('user')
+def get_cluster_queue(cluster_name):
+    """Retrieve the depth and wait times, in seconds, of a cluster's scheduled tests"""
+    tests = db.get_scheduled_tests(cluster_name)
+    return make_response(jsonify(queue_stats([t['test_id'] for t in tests])))
+
+
 @app.route('/api/tests/progress/id/<test_id>', methods=['POST'])
 @requires_auth(role=None)  # we don't need to check if the user has a role
 def set_progress_message_on_test(test_id):
@@ -609,33 +657,35 @@ def console_messages(ws):
        console cluster_name {"ctl":"IDLE"}
 
     When forwarding messages to the websocket client, the "console cluster_name" 
-    portion is dropped and just the JSON is sent.
+    portion is dropped and just the JSON is sent. Messages carry a "seq"
+    sequence number, and "realtime", false when they are replayed from
+    the backlog.
+
+    The websocket client first sends the cluster name, optionally
+    followed by a space and the sequence number to replay the backlog
+    from, to resume after a reconnect.
 
     Websocket sends keepalive messages periodically:
      {"ctl":"KEEPALIVE"}
 
     """
-    cluster_name = ws.receive()
-    console_socket = console_subscribe(cluster_name)
+    request = ws.receive().split(' ')
+    cluster_name = request[0]
+    try:
+        from_seq = int(request[1]) if len(request) > 1 else 0
+    except ValueError:
+        from_seq = 0
+    subscription = console_hub.subscribe(cluster_name, from_seq)
     try:
         while True:
-            try:
-                data = console_socket.recv_string()
-                data = data.lstrip("console {cluster_name} ".format(cluster_name=cluster_name))
+            data = subscription.get(timeout=CONSOLE_KEEPALIVE_INTERVAL)
+            if data is not None:
                 ws.send(data)
-            except zmq.error.Again:
-                # If we timeout from zmq, send a keep alive request to the
+            else:
+                # If nothing came for a while, send a keep alive request to the
                 # websocket client:
                 ws.send('{"ctl":"KEEPALIVE"}')
                 # The client websocket will send keepalive back:
                 ws.receive()
-            except zmq.error.ZMQError, e:
-
-                if e.errno == zmq.POLLERR:
-                    log.error(e)
-                    # Interrupted zmq socket code, reinitialize:
-                    # I get this when I resize my terminal.. WTF?
-                    console_socket = setup_zmq()
     finally:
-        log.error("Unsubscribing from zmq socket")
-        console_socket.setsockopt_string(zmq.UNSUBSCRIBE, u'')
+        subscription.close()
@@ -0,0 +1,168 @@
+"""Hand out scheduled tests to the clusters waiting for work
+
+Each worker has a single Dispatcher. It keeps a queue of the scheduled
+test ids of every cluster connected to the worker, loaded from Cassandra
+when the cluster connects and kept up to date from the test status
+notifications of test_notification_service. A cluster waiting for work
+is woken as soon as a test is scheduled for it, instead of polling the
+database. The queue is only reloaded once in a while, in case a
+notification was lost.
+"""
+
+import bisect
+import logging
+import time
+import uuid
+
+import gevent
+import gevent.event
+import zmq.green as zmq
+
+from notifications import TEST_NOTIFICATION_PORT_SUB
+
+log = logging.getLogger('cstar_perf.dispatcher')
+
+# 100-ns intervals between the UUID epoch and the Unix epoch:
+UUID_EPOCH_OFFSET = 0x01b21dd213814000
+
+
+def scheduled_time(test_id):
+    """Get the time a test was scheduled, in seconds, from its time uuid"""
+    return (uuid.UUID(str(test_id)).time - UUID_EPOCH_OFFSET) / 1e7
+
+
+def queue_stats(test_ids, now=None):
+    """Get the depth and wait times, in seconds, of a queue of scheduled test ids"""
+    now = time.time() if now is None else now
+    waits = [now - scheduled_time(test_id) for test_id in test_ids]
+    return {'depth': len(waits),
+            'oldest_wait': max(waits) if waits else 0,
+            'mean_wait': sum(waits) / len(waits) if waits else 0}
+
+
+class ClusterQueue(object):
+    """The scheduled tests of one cluster, oldest first"""
+    def __init__(self, cluster_name):
+        self.cluster_name = cluster_name
+        self.entries = []  # sorted (scheduled time, test_id)
+        self.test_ids = set()
+        self.event = gevent.event.Event()
+        self.dispatched = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def add(self, test_id):
+        test_id = str(test_id)
+        if test_id in self.test_ids:
+            return
+        self.test_ids.add(test_id)
+        bisect.insort(self.entries, (scheduled_time(test_id), test_id))
+        self.event.set()
+
+    def remove(self, test_id):
+        test_id = str(test_id)
+        if test_id not in self.test_ids:
+            return
+        self.test_ids.discard(test_id)
+        self.entries.remove((scheduled_time(test_id), test_id))
+
+    def get(self, timeout=None):
+        """Take the oldest test id, or None if none was scheduled within timeout seconds"""
+        if not self.entries:
+            self.event.clear()
+            self.event.wait(timeout)
+            if not self.entries:
+                return None
+        scheduled, test_id = self.entries.pop(0)
+        self.test_ids.discard(test_id)
+        wait = time.time() - scheduled
+        self.dispatched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        log.info("Dispatching {test_id} to {cluster} after {wait:.1f}s - {stats}".format(
+            test_id=test_id, cluster=self.cluster_name, wait=wait, stats=self.stats()))
+        return test_id
+
+    def stats(self):
+        stats = queue_stats(self.test_ids)
+        stats.update({'dispatched': self.dispatched,
+                      'dispatched_mean_wait': self.total_wait / self.dispatched if self.dispatched else 0,
+                      'dispatched_max_wait': self.max_wait})
+        return stats
+
+
+class Dispatcher(object):
+    def __init__(self, db, url='tcp://localhost:{port}'.format(port=TEST_NOTIFICATION_PORT_SUB)):
+        self.db = db
+        self.url = url
+        self.socket = None
+        self.reader = None
+        self.queues = {}  # cluster_name -> ClusterQueue
+
+    def _start(self):
+        # Started on first use, so the socket belongs to the worker process:
+        if self.socket is None:
+            self.socket = zmq.Context.instance().socket(zmq.SUB)
+            self.socket.connect(self.url)
+            # Notifications are "{status} {cluster} {test_id}", so
+            # clusters can't be told apart by topic:
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, u'')
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read)
+
+    def load(self, cluster_name):
+        """(Re)load the queue of a cluster from Cassandra
+
+        Called when a cluster connects, which also catches up on any
+        notification missed while it was away, and every so often while
+        it waits for work, as notifications are lost if
+        test_notification_service restarts.
+        """
+        self._start()
+        queue = self.queues.get(cluster_name)
+        if queue is None:
+            queue = self.queues[cluster_name] = ClusterQueue(cluster_name)
+        # Notifications received while loading are applied to the same
+        # queue, so none are lost between the query and the subscription:
+        queued = set(queue.test_ids)
+        scheduled = [str(test['test_id']) for test in self.db.get_scheduled_tests(cluster_name)]
+        for test_id in queued - set(scheduled):
+            queue.remove(test_id)
+        for test_id in scheduled:
+            queue.add(test_id)
+        return queue
+
+    def get(self, cluster_name, timeout=None):
+        """Take the next scheduled test id of a cluster
+
+        Returns None if no test was scheduled within timeout seconds.
+        """
+        queue = self.queues.get(cluster_name) or self.load(cluster_name)
+        return queue.get(timeout)
+
+    def requeue(self, cluster_name, test_id):
+        """Put back a test that could not be handed out"""
+        queue = self.queues.get(cluster_name)
+        if queue is not None:
+            queue.add(test_id)
+
+    def _read(self):
+        while True:
+            try:
+                data = self.socket.recv_string()
+            except zmq.ZMQError:
+                log.exception("Error receiving test notifications")
+                gevent.sleep(1)
+                continue
+            try:
+                status, cluster_name, test_id = data.split()
+            except ValueError:
+                log.warn("Unknown test notification: {data}".format(data=data))
+                continue
+            queue = self.queues.get(cluster_name)
+            if queue is None:
+                continue
+            if status == 'scheduled':
+                queue.add(test_id)
+            else:
+                queue.remove(test_id)
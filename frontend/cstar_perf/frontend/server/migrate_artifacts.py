@@ -0,0 +1,39 @@
+"""Rewrite hex encoded artifacts stored by older versions as raw bytes"""
+
+import argparse
+import logging
+
+from cstar_perf.frontend.server.util import load_app_config
+from cstar_perf.frontend.lib.util import auth_provider_if_configured
+
+log = logging.getLogger('cstar_perf.model')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cstar_perf_migrate_artifacts')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='Seconds to sleep after each rewritten row, to limit the load on Cassandra', dest='throttle')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print log messages', dest='verbose')
+    args = parser.parse_args()
+
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    config = load_app_config()
+    cassandra_hosts = [h.strip() for h in config.get('server', 'cassandra_hosts').split(",")]
+    from cstar_perf.frontend.server.model import Model
+    from cassandra.cluster import Cluster
+
+    auth_provider = auth_provider_if_configured(config)
+    cluster = Cluster(contact_points=cassandra_hosts, auth_provider=auth_provider, connect_timeout=30)
+    keyspace = config.get('server', 'cassandra_keyspace') if config.has_option('server', 'cassandra_keyspace') else 'cstar_perf'
+    db = Model(cluster=cluster, keyspace=keyspace)
+
+    artifacts, chunks, skipped = db.migrate_hex_artifacts(throttle=args.throttle)
+    print("Migrated {artifacts} artifacts and {chunks} artifact chunks, skipped {skipped} chunks not matching their sha".format(
+        artifacts=artifacts, chunks=chunks, skipped=skipped))
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -39,14 +39,18 @@
 
 import cassandra
 from cassandra.cluster import Cluster, Session
+from cassandra.query import BatchStatement, BatchType
 import json
 import uuid
 import logging
 import datetime
 import zmq
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
 import base64
 import math
+import hashlib
+import itertools
+import time
 
 Session.default_timeout = 45
 
@@ -77,28 +81,146 @@ class UnknownAPIKeyError(Exception):
     pass
 class NoTestsScheduledError(Exception):
     pass
+class TestStatusConflictError(Exception):
+    pass
 
 TEST_STATES =  ('scheduled', 'in_progress', 'completed', 'cancel_pending', 'cancelled', 'failed')
 
+class TestRecord(object):
+    """A test row returned by the test listings
+
+    Reads like the dict returned by get_test, but values are only
+    converted when accessed: test_id as a string, scheduled_date and
+    completed_date as datetimes, and test_definition parsed from JSON.
+    """
+    __slots__ = ('_row', '_values')
+
+    def __init__(self, row):
+        self._row = row
+        self._values = None
+
+    def _convert(self, key):
+        if key == 'scheduled_date':
+            return uuid_to_datetime(self._row.test_id)
+        value = getattr(self._row, key)
+        if key == 'test_id':
+            return str(value)
+        if key == 'completed_date' and value is not None:
+            return uuid_to_datetime(value)
+        if key == 'test_definition' and value is not None:
+            return json.loads(value)
+        return value
+
+    def __getitem__(self, key):
+        if self._values is not None and key in self._values:
+            return self._values[key]
+        if key != 'scheduled_date' and key not in self._row._fields:
+            raise KeyError(key)
+        value = self._convert(key)
+        if key in ('scheduled_date', 'completed_date', 'test_definition'):
+            # Cache the values that are expensive to convert:
+            if self._values is None:
+                self._values = {}
+            self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self._values is None:
+            self._values = {}
+        self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        keys = list(self._row._fields) + ['scheduled_date']
+        if self._values is not None:
+            keys.extend(k for k in self._values if k not in keys)
+        return keys
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'TestRecord({test})'.format(test=self.to_dict())
+
+# object_size is an int column, larger objects are stored with this size:
+OBJECT_SIZE_CAP = int(math.pow(2, 31)) - 1
+
+# Upper bound for timestamp ranges, 9999-12-31 in milliseconds:
+MAX_TIMESTAMP_MS = 253402300799000
+
+def timestamp_month(timestamp):
+    """Get the UTC month of a timestamp in seconds, as YYYY-MM"""
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m')
+
+def completed_month(completed_date):
+    """Get the month bucket of a completed_date timeuuid"""
+    return timestamp_month((completed_date.time - 0x01b21dd213814000L) / 1e7)
+
+# Number of chunk reads kept in flight when reading a chunked object:
+CHUNK_PREFETCH_WINDOW = 4
+
+# Artifact blobs used to be stored hex encoded. Rows written before the
+# encoding column existed have no encoding set, and are hex:
+ARTIFACT_ENCODING_RAW = 'raw'
+ARTIFACT_ENCODING_HEX = 'hex'
+
+def decode_artifact_blob(data, encoding):
+    """Get the raw bytes of an artifact blob stored with the given encoding"""
+    if data is None:
+        return None
+    if encoding == ARTIFACT_ENCODING_RAW:
+        return str(data)
+    return data.decode("hex")
+
 class Model(object):
 
     statements = {
         'insert_test': "INSERT INTO tests (test_id, user, cluster, status, test_definition) VALUES (?, ?, ?, ?, ?);",
         'select_test': "SELECT * FROM tests WHERE test_id = ?;",
-        'insert_series': "INSERT INTO test_series (series, test_id) VALUES ( ?, ?);",
-        'select_series' : "SELECT test_id from test_series where series = ? AND test_id > ? AND test_id < ?",
+        'insert_series': "INSERT INTO test_series (series, test_id, status) VALUES ( ?, ?, ?);",
+        'select_series' : "SELECT test_id, status from test_series where series = ? AND test_id > ? AND test_id < ?",
+        'select_series_all' : "SELECT series, test_id, status from test_series",
+        'update_series_set_status': "UPDATE test_series SET status = ? WHERE series = ? AND test_id = ?",
         'select_series_list' : "SELECT DISTINCT series from test_series",
+        'insert_series_summary_metric': "INSERT INTO series_summaries (series, test_id, operation, label, stat_id, metric, value) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        'select_series_summaries': "SELECT test_id, operation, label, stat_id, metric, value FROM series_summaries WHERE series = ? AND test_id > ? AND test_id < ?",
         'get_test_status': "SELECT status FROM tests WHERE test_id = ?;",
         'update_test_set_status': "UPDATE tests SET status = ? WHERE test_id = ?",
         'update_test_set_progress_msg': "UPDATE tests SET progress_msg = ? WHERE test_id = ?",
         'update_test_status_set_progress_msg': "UPDATE test_status SET progress_msg = ? WHERE status = ? and cluster = ? and test_id = ? IF EXISTS",
         'update_test_set_status_completed': "UPDATE tests SET status = ?, completed_date = ? WHERE test_id = ?",
+        'update_test_set_status_if': "UPDATE tests SET status = ? WHERE test_id = ? IF status = ?",
+        'update_test_set_status_completed_if': "UPDATE tests SET status = ?, completed_date = ? WHERE test_id = ? IF status = ?",
         'insert_test_status': "INSERT INTO test_status (status, cluster, test_id, user, title) VALUES (?, ?, ?, ?, ?);",
-        'select_test_status_asc': "SELECT * FROM test_status WHERE status = ? AND cluster = ? ORDER BY cluster DESC, test_id ASC LIMIT ?",
-        'select_test_status_desc': "SELECT * FROM test_status WHERE status = ? AND cluster= ? ORDER BY cluster ASC, test_id DESC LIMIT ?",
-        'select_test_status_by_user': "SELECT * FROM test_status WHERE status = ? AND user = ? LIMIT ?",
-        'select_next_scheduled': "SELECT * FROM test_status WHERE status = 'scheduled' AND cluster = ? ORDER BY cluster DESC, test_id ASC LIMIT 1",
-        'select_test_status_all': "SELECT * FROM test_status WHERE status = ? LIMIT ?",
+        'select_test_status_asc': "SELECT status, cluster, test_id, user, title, progress_msg FROM test_status WHERE status = ? AND cluster = ? ORDER BY cluster DESC, test_id ASC LIMIT ?",
+        'select_test_status_desc': "SELECT status, cluster, test_id, user, title, progress_msg FROM test_status WHERE status = ? AND cluster= ? ORDER BY cluster ASC, test_id DESC LIMIT ?",
+        'select_test_status_all_rows': "SELECT status, cluster, test_id, user, title, progress_msg FROM test_status",
+        'insert_test_by_user': "INSERT INTO tests_by_user (user, status, test_id, cluster, title, progress_msg) VALUES (?, ?, ?, ?, ?, ?);",
+        'delete_test_by_user': "DELETE FROM tests_by_user WHERE user = ? AND status = ? AND test_id = ?",
+        'update_test_by_user_set_progress_msg': "UPDATE tests_by_user SET progress_msg = ? WHERE user = ? AND status = ? AND test_id = ? IF EXISTS",
+        'select_tests_by_user': "SELECT user, status, test_id, cluster, title, progress_msg FROM tests_by_user WHERE user = ? AND status = ? LIMIT ?",
+        'select_next_scheduled': "SELECT status, cluster, test_id, user, title, progress_msg FROM test_status WHERE status = 'scheduled' AND cluster = ? ORDER BY cluster DESC, test_id ASC LIMIT 1",
+        'select_test_status_all': "SELECT status, cluster, test_id, user, title, progress_msg FROM test_status WHERE status = ? LIMIT ?",
         'delete_test_status': "DELETE FROM test_status WHERE status= ? AND cluster = ? AND test_id = ?",
         'select_clusters_name': "SELECT name from clusters;",
         'select_clusters': "SELECT name, description, jvms, nodes, additional_products FROM clusters;",
@@ -110,17 +232,26 @@ class Model(object):
         'select_user_passphrase_hash': "SELECT hash, salt FROM user_passphrase WHERE user_id = ?;",
         'update_user_passphrase_hash': "UPDATE user_passphrase SET hash = ?, salt = ? WHERE user_id = ?",
         'select_user_roles': "SELECT roles FROM users WHERE user_id = ?;",
-        'update_test_artifact': "UPDATE test_artifacts SET artifact = ?, artifact_available = ?, object_id = ? WHERE test_id = ? AND artifact_type = ? AND name = ?;",
+        'update_test_artifact': "UPDATE test_artifacts SET artifact = ?, encoding = ?, artifact_available = ?, object_id = ? WHERE test_id = ? AND artifact_type = ? AND name = ?;",
+        'select_test_artifact': "SELECT artifact_type, name, object_id, artifact_available FROM test_artifacts WHERE test_id = ? AND artifact_type = ? AND name = ?",
         'select_test_artifacts_by_type': "SELECT artifact_type, name, object_id, artifact_available FROM test_artifacts WHERE test_id = ? AND artifact_type = ?",
         'select_test_artifacts_all': "SELECT artifact_type, name, object_id, artifact_available FROM test_artifacts WHERE test_id = ? ORDER BY artifact_type ASC",
-        'select_test_artifact_data': "SELECT artifact, object_id, artifact_available FROM test_artifacts WHERE test_id = ? AND artifact_type = ? AND name = ?",
-        'insert_chunk_object': "INSERT INTO chunk_object_storage (object_id, chunk_id, chunk_size, chunk_sha, object_chunk, total_chunks, object_size, object_sha) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        'select_test_artifact_data': "SELECT artifact, encoding, object_id, artifact_available FROM test_artifacts WHERE test_id = ? AND artifact_type = ? AND name = ?",
+        'select_test_artifact_encodings': "SELECT test_id, artifact_type, name, encoding FROM test_artifacts",
+        'update_test_artifact_data': "UPDATE test_artifacts SET artifact = ?, encoding = ? WHERE test_id = ? AND artifact_type = ? AND name = ? IF encoding = null",
+        'insert_chunk_object': "INSERT INTO chunk_object_storage (object_id, chunk_id, chunk_size, chunk_sha, object_chunk, encoding, total_chunks, object_size, object_sha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
         'insert_chunk_artifact_meta': "UPDATE test_artifacts SET object_id = ?, artifact_available = ? WHERE test_id = ? AND artifact_type = ? AND name = ?;",
+        'update_chunk_object_info': "UPDATE chunk_object_storage SET total_chunks = ?, object_size = ?, object_sha = ? WHERE object_id = ?",
         'select_chunk_info': "select chunk_id, chunk_sha from chunk_object_storage where object_id = ?",
         'select_base_chunk_info': "SELECT object_id, total_chunks, object_size, object_sha FROM chunk_object_storage where object_id = ? ORDER BY chunk_id ASC LIMIT 1",
-        'select_chunk_data': "SELECT object_chunk FROM chunk_object_storage where object_id = ? AND chunk_id = ?",
-        'insert_test_completed': "INSERT INTO tests_completed (status, completed_date, test_id, cluster, title, user) VALUES (?, ?, ?, ?, ?, ?);",
-        'select_test_completed': "SELECT * FROM tests_completed LIMIT ?;",
+        'select_chunk_sizes': "SELECT chunk_id, chunk_size FROM chunk_object_storage where object_id = ?",
+        'select_chunk_data': "SELECT object_chunk, encoding FROM chunk_object_storage where object_id = ? AND chunk_id = ?",
+        'select_chunk_encodings': "SELECT object_id, chunk_id, chunk_sha, encoding FROM chunk_object_storage",
+        'update_chunk_data': "UPDATE chunk_object_storage SET object_chunk = ?, encoding = ? WHERE object_id = ? AND chunk_id = ? IF encoding = null",
+        'insert_test_completed_month': "INSERT INTO tests_completed_months (status, month) VALUES ('completed', ?);",
+        'select_test_completed_months': "SELECT month FROM tests_completed_months WHERE status = 'completed'",
+        'insert_test_completed_by_month': "INSERT INTO tests_completed_by_month (month, completed_date, status, test_id, cluster, title, user) VALUES (?, ?, ?, ?, ?, ?, ?);",
+        'select_test_completed_by_month': "SELECT completed_date, status, test_id, cluster, title, user FROM tests_completed_by_month WHERE month = ? AND completed_date >= minTimeuuid(?) AND completed_date <= maxTimeuuid(?)",
         'select_api_pubkey': "SELECT * FROM api_pubkeys WHERE name = ? LIMIT 1",
         'insert_api_pubkey': "INSERT INTO api_pubkeys (name, user_type, pubkey) VALUES (?, ?, ?);"
     }
@@ -187,18 +318,25 @@ class Model(object):
         session.execute("CREATE TABLE tests (test_id timeuuid PRIMARY KEY, user text, cluster text, status text, test_definition text, completed_date timeuuid, progress_msg text);")
 
         # Index series by series name and then the tests by uuid
-        session.execute("CREATE TABLE test_series (series text, test_id timeuuid, PRIMARY KEY (series, test_id));")
+        session.execute("CREATE TABLE test_series (series text, test_id timeuuid, status text, PRIMARY KEY (series, test_id));")
+
+        # Stats summary metrics of completed tests, by series, so a
+        # series can be charted with a single range query:
+        session.execute("CREATE TABLE series_summaries (series text, test_id timeuuid, operation text, label text, stat_id timeuuid, metric text, value text, PRIMARY KEY (series, test_id, operation, label, stat_id, metric));")
 
         # Tests listed by status, sorted by timestamp, in descending
         # order. Descending order because the completed status will have
         # the largest number. 'scheduled' status will want to be queried
         # in ASC order.
         session.execute("CREATE TABLE test_status (status text, test_id timeuuid, cluster text, user text, title text, progress_msg text, PRIMARY KEY (status, cluster, test_id)) WITH CLUSTERING ORDER BY (cluster ASC, test_id DESC);")
-        session.execute("CREATE INDEX ON test_status (user);")
-        # A denormalized copy of test_status for the completed tests.
-        # This makes a reverse querying of completed tests for the
-        # main page doable:
-        session.execute("CREATE TABLE tests_completed (status text, completed_date timeuuid, test_id timeuuid, cluster text, title text, user text, PRIMARY KEY (status, completed_date)) WITH CLUSTERING ORDER BY (completed_date DESC)")
+        # Tests listed by user and status, newest first:
+        session.execute("CREATE TABLE tests_by_user (user text, status text, test_id timeuuid, cluster text, title text, progress_msg text, PRIMARY KEY ((user, status), test_id)) WITH CLUSTERING ORDER BY (test_id DESC);")
+        # A denormalized copy of test_status for the completed tests,
+        # one partition per month. This makes a reverse querying of
+        # completed tests for the main page doable, walking the months
+        # listed in tests_completed_months newest first:
+        session.execute("CREATE TABLE tests_completed_by_month (month text, completed_date timeuuid, status text, test_id timeuuid, cluster text, title text, user text, PRIMARY KEY (month, completed_date)) WITH CLUSTERING ORDER BY (completed_date DESC)")
+        session.execute("CREATE TABLE tests_completed_months (status text, month text, PRIMARY KEY (status, month)) WITH CLUSTERING ORDER BY (month DESC)")
 
         # Test artifacts
         session.execute("""CREATE TABLE test_artifacts (
@@ -206,6 +344,7 @@ class Model(object):
                                 artifact_type text,
                                 name text,
                                 artifact blob,
+                                encoding text,
                                 artifact_available boolean,
                                 object_id text,
                                 PRIMARY KEY (test_id, artifact_type, name)
@@ -217,6 +356,7 @@ class Model(object):
                                 chunk_size int,
                                 chunk_sha text,
                                 object_chunk blob,
+                                encoding text,
                                 total_chunks int static,
                                 object_size int static,
                                 object_sha text static,
@@ -243,8 +383,9 @@ class Model(object):
         test_definition['test_id'] = str(test_id)
         test_json = json.dumps(test_definition)
         session.execute(self.__prepared_statements['insert_test'], (test_id, user, cluster, 'scheduled', test_json))
-        session.execute(self.__prepared_statements['insert_series'], (test_series, test_id))
+        session.execute(self.__prepared_statements['insert_series'], (test_series, test_id, 'scheduled'))
         session.execute(self.__prepared_statements['insert_test_status'], ('scheduled', cluster, test_id, user, test_definition['title']))
+        session.execute(self.__prepared_statements['insert_test_by_user'], (user, 'scheduled', test_id, cluster, test_definition['title'], None))
         self.zmq_socket.send_string("scheduled {cluster} {test_id}".format(**locals()))
         return test_id
 
@@ -259,18 +400,122 @@ class Model(object):
         test = self.__test_row_to_dict(test)
         return test
 
-    def get_series(self, series, start_timestamp, end_timestamp):
+    def __get_test_series(self, test):
+        return test['test_definition'].get('testseries') or 'no_series'
+
+    def get_series(self, series, start_timestamp, end_timestamp, status=None):
+        """Get the ids of the tests in a series
+
+        status - only get the tests with this status
+        """
         start_timestamp = int(start_timestamp)
         end_timestamp = int(end_timestamp)
         session = self.get_session()
         series = session.execute(self.__prepared_statements['select_series'], (series, uuid_from_time(start_timestamp), uuid_from_time(end_timestamp)))
-        return [str(row.__dict__['test_id']) for row in series]
+        return [str(row.__dict__['test_id']) for row in series if status is None or row.__dict__['status'] == status]
+
+    def backfill_series_status(self):
+        """Set the status of the test_series rows written before it was stored there
+
+        returns the number of rows updated
+        """
+        session = self.get_session(shared=False)
+        updated = 0
+        for row in session.execute(self.__prepared_statements['select_series_all']):
+            if row.status is not None:
+                continue
+            try:
+                status = self.get_test_status(row.test_id)
+            except UnknownTestError:
+                log.warn("Series {series} has unknown test {test_id}".format(series=row.series, test_id=row.test_id))
+                continue
+            session.execute(self.__prepared_statements['update_series_set_status'], (status, row.series, row.test_id))
+            updated += 1
+        session.shutdown()
+        return updated
 
     def get_series_list(self):
         session = self.get_session()
         series = session.execute(self.__prepared_statements['select_series_list'])
         return [row.__dict__['series'] for row in series if row.__dict__['series'] != 'no_series']
 
+    def index_series_summary(self, test_id, test=None):
+        """Copy the metrics of a completed test's stats summary into series_summaries
+
+        returns the number of metrics indexed
+        """
+        if not isinstance(test_id, uuid.UUID):
+            test_id = uuid.UUID(test_id)
+        if test is None:
+            test = self.get_test(test_id)
+        series = self.__get_test_series(test)
+        artifact = self.get_test_artifact_data(test_id, 'stats_summary', 'stats_summary.{}.json'.format(test_id))
+        if not artifact or not artifact[0]:
+            return 0
+
+        session = self.get_session()
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        metrics = 0
+        for stat in json.loads(artifact[0])['stats']:
+            if 'test' not in stat:
+                log.error("stat summary without test key: {}".format(stat.get('id')))
+                continue
+            for metric, value in stat.items():
+                if metric in ('test', 'label'):
+                    continue
+                batch.add(self.__prepared_statements['insert_series_summary_metric'],
+                          (series, test_id, stat['test'], stat['label'], uuid.UUID(stat['id']), metric, json.dumps(value)))
+                metrics += 1
+        if metrics:
+            session.execute(batch)
+        return metrics
+
+    def backfill_series_summaries(self):
+        """Index the stats summaries of all the tests completed so far
+
+        returns the number of tests indexed
+        """
+        session = self.get_session(shared=False)
+        indexed = 0
+        for row in self.__generate_completed_test_rows(session):
+            try:
+                if self.index_series_summary(row.test_id):
+                    indexed += 1
+            except (UnknownTestError, ValueError, KeyError):
+                log.exception("Failed to index the stats summary of {test_id}".format(test_id=row.test_id))
+        session.shutdown()
+        return indexed
+
+    def backfill_tests_by_user(self):
+        """Copy the rows of test_status into tests_by_user
+
+        returns the number of tests copied
+        """
+        session = self.get_session(shared=False)
+        copied = 0
+        for row in session.execute(self.__prepared_statements['select_test_status_all_rows']):
+            session.execute(self.__prepared_statements['insert_test_by_user'],
+                            (row.user, row.status, row.test_id, row.cluster, row.title, row.progress_msg))
+            copied += 1
+        session.shutdown()
+        return copied
+
+    def get_series_summaries(self, series, start_timestamp, end_timestamp):
+        """Get the stats summaries of the completed tests in a series
+
+        returns {operation: {label: OrderedDict((test_id, stat_id): {metric: value})}},
+        ordered by test_id. Revisions of a test sharing a label each have
+        their own stat id.
+        """
+        session = self.get_session()
+        rows = session.execute(self.__prepared_statements['select_series_summaries'],
+                               (series, uuid_from_time(int(start_timestamp)), uuid_from_time(int(end_timestamp))))
+        summaries = {}
+        for row in rows:
+            stats = summaries.setdefault(row.operation, {}).setdefault(row.label, OrderedDict())
+            stats.setdefault((row.test_id, row.stat_id), {})[row.metric] = json.loads(row.value)
+        return summaries
+
     def get_test_status(self, test_id):
         session = self.get_session()
         if not isinstance(test_id, uuid.UUID):
@@ -289,26 +534,65 @@ class Model(object):
         session.execute(self.__prepared_statements['update_test_set_progress_msg'], (progress_msg, test_id))
         session.execute(self.__prepared_statements['update_test_status_set_progress_msg'],
                         (progress_msg, 'in_progress', test['cluster'], test_id))
+        session.execute(self.__prepared_statements['update_test_by_user_set_progress_msg'],
+                        (progress_msg, test['user'], 'in_progress', test_id))
 
-    def update_test_status(self, test_id, status):
+    def update_test_status(self, test_id, status, test=None, expected_status=None):
+        """Move a test to a new status
+
+        test - the test, as returned by get_test, if it was already read
+        expected_status - only update the test if its status is still this
+                          one, checked with a lightweight transaction.
+                          Raises TestStatusConflictError otherwise.
+        """
         assert status in TEST_STATES, "{status} is not a valid test state".format(status=status)
         session = self.get_session()
         if not isinstance(test_id, uuid.UUID):
             test_id = uuid.UUID(test_id)
-        test = self.get_test(test_id)
-        original_status = self.get_test_status(test_id)
+        if test is None:
+            test = self.get_test(test_id)
+        original_status = test['status']
+        completed_date = uuid.uuid1() if status == "completed" else None
+
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
         # Update tests table:
-        if status == "completed":
-            completed_date = uuid.uuid1()
-            session.execute(self.__prepared_statements['update_test_set_status_completed'], (status, completed_date, test_id ))
-            # Add denormalized copy in tests_
-            session.execute(self.__prepared_statements['insert_test_completed'], ("completed", completed_date, test_id, test['cluster'], test['test_definition']['title'], test['user']))
+        if expected_status is not None:
+            # Conditional updates can't be batched with other partitions,
+            # so this one goes first and decides if the rest is applied:
+            if completed_date:
+                result = session.execute(self.__prepared_statements['update_test_set_status_completed_if'], (status, completed_date, test_id, expected_status))
+            else:
+                result = session.execute(self.__prepared_statements['update_test_set_status_if'], (status, test_id, expected_status))
+            if not result[0].applied:
+                raise TestStatusConflictError('Test {test_id} is {actual}, not {expected}'.format(
+                    test_id=test_id, actual=result[0].status, expected=expected_status))
+            original_status = expected_status
+        elif completed_date:
+            batch.add(self.__prepared_statements['update_test_set_status_completed'], (status, completed_date, test_id))
         else:
-            session.execute(self.__prepared_statements['update_test_set_status'], (status, test_id))
-        # Remove the old status from test_status:
-        session.execute(self.__prepared_statements['delete_test_status'], (test['status'], test['cluster'], test_id))
-        # Add the new status to test_status:
-        session.execute(self.__prepared_statements['insert_test_status'], (status, test['cluster'], test_id, test['user'], test['test_definition']['title']))
+            batch.add(self.__prepared_statements['update_test_set_status'], (status, test_id))
+        if completed_date:
+            # Add denormalized copy in tests_completed_by_month
+            month = completed_month(completed_date)
+            batch.add(self.__prepared_statements['insert_test_completed_month'], (month,))
+            batch.add(self.__prepared_statements['insert_test_completed_by_month'], (month, completed_date, "completed", test_id, test['cluster'], test['test_definition']['title'], test['user']))
+        batch.add(self.__prepared_statements['update_series_set_status'],
+                  (status, self.__get_test_series(test), test_id))
+        # Move the test to the new status in test_status. The delete and
+        # insert get the same timestamp, so the delete would win if the
+        # status doesn't change:
+        if original_status != status:
+            batch.add(self.__prepared_statements['delete_test_status'], (original_status, test['cluster'], test_id))
+            batch.add(self.__prepared_statements['delete_test_by_user'], (test['user'], original_status, test_id))
+        batch.add(self.__prepared_statements['insert_test_status'], (status, test['cluster'], test_id, test['user'], test['test_definition']['title']))
+        batch.add(self.__prepared_statements['insert_test_by_user'], (test['user'], status, test_id, test['cluster'], test['test_definition']['title'], test.get('progress_msg')))
+        session.execute(batch)
+
+        if completed_date:
+            try:
+                self.index_series_summary(test_id, test)
+            except Exception:
+                log.exception("Failed to index the stats summary of {test_id}".format(test_id=test_id))
         self.zmq_socket.send_string("{status} {cluster} {test_id}".format(status=status, cluster=test['cluster'], test_id=test_id))
         log.info("test status is: {status}".format(status=status))
 
@@ -336,9 +620,10 @@ class Model(object):
             test_id = uuid.UUID(test_id)
         if not name:
             name = "Unknown artifact"
-        if hasattr(artifact, 'encode'):
-            artifact = artifact.encode("hex")
-        session.execute(self.__prepared_statements['update_test_artifact'], (artifact, available, object_id, test_id, artifact_type, name), timeout=60)
+        if isinstance(artifact, unicode):
+            artifact = artifact.encode("utf-8")
+        encoding = ARTIFACT_ENCODING_RAW if artifact is not None else None
+        session.execute(self.__prepared_statements['update_test_artifact'], (artifact, encoding, available, object_id, test_id, artifact_type, name), timeout=60)
         return test_id
 
     def insert_artifact_chunk(self, object_id, chunk_id, chunk_size, chunk_sha, object_chunk, total_chunks, object_size, object_sha):
@@ -348,7 +633,6 @@ class Model(object):
             f.seek(0)
             object_chunk = f.read()
             f.seek(pos)
-        object_chunk = object_chunk.encode("hex")
         session = self.get_session()
         session.execute(self.__prepared_statements['insert_chunk_object'],
                         (object_id,
@@ -356,13 +640,20 @@ class Model(object):
                          chunk_size,
                          chunk_sha,
                          object_chunk,
+                         ARTIFACT_ENCODING_RAW,
                          total_chunks,
                          # Workaround. If object size is >= 2^31, the insert
                          # will fail, so we cap it at (2^31) - 1
-                         min(object_size, int(math.pow(2, 31)) - 1),
+                         min(object_size, OBJECT_SIZE_CAP) if object_size is not None else None,
                          object_sha)
                         )
 
+    def set_chunk_object_info(self, object_id, total_chunks, object_size, object_sha):
+        """Set the size and sha of a chunked object whose chunks were stored before they were known"""
+        session = self.get_session()
+        session.execute(self.__prepared_statements['update_chunk_object_info'],
+                        (total_chunks, min(object_size, OBJECT_SIZE_CAP), object_sha, object_id))
+
     def get_chunk_info(self, object_id):
         session = self.get_session()
         rows = session.execute(self.__prepared_statements['select_chunk_info'], (object_id, ))
@@ -377,7 +668,7 @@ class Model(object):
         session = self.get_session()
         rows = session.execute(self.__prepared_statements['select_chunk_data'], (object_id, chunk_id))
         if rows:
-            return rows[0].object_chunk.decode("hex")
+            return decode_artifact_blob(rows[0].object_chunk, rows[0].encoding) or ""
         return ""
 
     def add_chunk_artifact(self, test_id, artifact_type, object_id, name, artifact_complete=False):
@@ -385,10 +676,65 @@ class Model(object):
         session.execute(self.__prepared_statements['insert_chunk_artifact_meta'],
                         (object_id, artifact_complete, test_id, artifact_type, name))
 
-    def generate_object_by_chunks(self, object_id):
-        chunk_info = self.get_base_chunk_info(object_id)
-        for chunk_num in range(chunk_info['total_chunks']):
-            yield self.get_chunk_data(object_id, chunk_num)
+    def get_chunk_sizes(self, object_id):
+        """Get the size of each chunk of an object, in chunk order"""
+        session = self.get_session()
+        rows = session.execute(self.__prepared_statements['select_chunk_sizes'], (object_id, ))
+        return [r.chunk_size for r in rows]
+
+    def get_object_size(self, object_id, chunk_info=None):
+        """Get the size of a chunked object"""
+        if chunk_info is None:
+            chunk_info = self.get_base_chunk_info(object_id)
+        if chunk_info['object_size'] < OBJECT_SIZE_CAP:
+            return chunk_info['object_size']
+        # object_size was capped when stored, add up the chunks instead:
+        return sum(self.get_chunk_sizes(object_id))
+
+    def generate_object_by_chunks(self, object_id, start=0, stop=None, prefetch=CHUNK_PREFETCH_WINDOW):
+        """Read a chunked object, keeping up to prefetch chunk reads in flight
+
+        Chunks are yielded in order. The next read is only started once
+        a chunk is consumed, so no more than prefetch chunks are ever
+        held in memory.
+
+        start, stop - only yield this byte range of the object, stop
+                      being exclusive. The chunks outside of it are not read.
+        """
+        if start == 0 and stop is None:
+            chunk_info = self.get_base_chunk_info(object_id)
+            chunks = [(chunk_num, None, None) for chunk_num in range(chunk_info['total_chunks'])]
+        else:
+            chunks = []
+            chunk_start = 0
+            for chunk_num, chunk_size in enumerate(self.get_chunk_sizes(object_id)):
+                chunk_stop = chunk_start + chunk_size
+                if stop is not None and chunk_start >= stop:
+                    break
+                if chunk_stop > start:
+                    chunks.append((chunk_num, max(start - chunk_start, 0),
+                                   (stop - chunk_start) if stop is not None else None))
+                chunk_start = chunk_stop
+
+        session = self.get_session()
+        statement = self.__prepared_statements['select_chunk_data']
+        chunks = iter(chunks)
+        in_flight = deque()
+        while True:
+            while len(in_flight) < max(prefetch, 1):
+                try:
+                    chunk_num, slice_start, slice_stop = next(chunks)
+                except StopIteration:
+                    break
+                in_flight.append((session.execute_async(statement, (object_id, chunk_num)), slice_start, slice_stop))
+            if not in_flight:
+                break
+            future, slice_start, slice_stop = in_flight.popleft()
+            rows = future.result()
+            data = decode_artifact_blob(rows[0].object_chunk, rows[0].encoding) if rows else ""
+            if slice_start is not None:
+                data = data[slice_start:slice_stop]
+            yield data
 
     def get_test_artifact(self, test_id, artifact_type, artifact_name):
         """Retrieve one test artifact type"""
@@ -422,9 +768,66 @@ class Model(object):
                 return ''.join(self.generate_object_by_chunks(artifact.object_id)), artifact.object_id, artifact.artifact_available
             # old style artifact
             else:
-                return (artifact.artifact.decode("hex") if artifact.artifact else None), artifact.object_id, artifact.artifact_available
+                return decode_artifact_blob(artifact.artifact, artifact.encoding) or None, artifact.object_id, artifact.artifact_available
         return None
 
+    def migrate_hex_artifacts(self, throttle=0):
+        """Rewrite hex encoded artifacts and chunks as raw bytes
+
+        Only the keys are scanned, so blobs that are already raw are never
+        read. Chunks are checked against their sha before being rewritten.
+        Rows are only rewritten if they are still hex encoded, so an
+        artifact uploaded again meanwhile is left alone. Safe to run while
+        the server is up, and to run again if interrupted.
+
+        throttle - seconds to sleep after each rewritten row
+
+        returns a tuple of (artifacts migrated, chunks migrated, chunks skipped)
+        """
+        session = self.get_session(shared=False)
+        artifacts_migrated = chunks_migrated = chunks_skipped = 0
+
+        for row in session.execute(self.__prepared_statements['select_test_artifact_encodings']):
+            if row.encoding is not None:
+                continue
+            data = session.execute(self.__prepared_statements['select_test_artifact_data'],
+                                   (row.test_id, row.artifact_type, row.name))
+            if not data or data[0].encoding is not None or data[0].artifact is None:
+                continue
+            result = session.execute(self.__prepared_statements['update_test_artifact_data'],
+                                     (decode_artifact_blob(data[0].artifact, ARTIFACT_ENCODING_HEX), ARTIFACT_ENCODING_RAW,
+                                      row.test_id, row.artifact_type, row.name), timeout=60)
+            if not result[0].applied:
+                # Uploaded again since it was read
+                continue
+            artifacts_migrated += 1
+            time.sleep(throttle)
+
+        for row in session.execute(self.__prepared_statements['select_chunk_encodings']):
+            if row.encoding is not None:
+                continue
+            data = session.execute(self.__prepared_statements['select_chunk_data'], (row.object_id, row.chunk_id))
+            if not data or data[0].encoding is not None or data[0].object_chunk is None:
+                continue
+            chunk = decode_artifact_blob(data[0].object_chunk, ARTIFACT_ENCODING_HEX)
+            if row.chunk_sha and hashlib.sha256(chunk).hexdigest() != row.chunk_sha:
+                log.warn("Chunk {chunk_id} of {object_id} does not match its sha, leaving it hex encoded".format(
+                    chunk_id=row.chunk_id, object_id=row.object_id))
+                chunks_skipped += 1
+                continue
+            result = session.execute(self.__prepared_statements['update_chunk_data'],
+                                     (chunk, ARTIFACT_ENCODING_RAW, row.object_id, row.chunk_id), timeout=60)
+            if not result[0].applied:
+                # Uploaded again since it was read
+                continue
+            chunks_migrated += 1
+            if chunks_migrated % 1000 == 0:
+                log.info("Migrated {n} artifact chunks".format(n=chunks_migrated))
+            time.sleep(throttle)
+
+        session.shutdown()
+        return artifacts_migrated, chunks_migrated, chunks_skipped
+
     ################################################################################
     ####  Retrieve tests by status:
     ################################################################################
@@ -439,7 +842,7 @@ class Model(object):
                 rows = session.execute(self.__prepared_statements['select_test_status_asc'], (status, cluster, limit))
             else:
                 raise ValueError('Unknown sort direction: {direction}'.format(**locals()))
-        return [self.__test_row_to_dict(r) for r in rows]
+        return [TestRecord(r) for r in rows]
 
     def get_scheduled_tests(self, cluster, limit=999999999):
         return self.get_test_status_by_cluster('scheduled', cluster, 'ASC', limit)
@@ -453,7 +856,7 @@ class Model(object):
     def get_next_scheduled_test(self, cluster):
         session = self.get_session()
         rows = session.execute(self.__prepared_statements['select_next_scheduled'], (cluster,))
-        tests = [self.__test_row_to_dict(r) for r in rows]
+        tests = [TestRecord(r) for r in rows]
         try:
             return tests[0]
         except IndexError:
@@ -463,18 +866,91 @@ class Model(object):
         return self.get_test_status_by_cluster('in_progress', cluster, 'ASC', limit) + \
             self.get_test_status_by_cluster('cancel_pending', cluster, 'ASC', limit)
 
+    def __get_completed_months(self, session, date_from=None, date_to=None):
+        """Get the months that have completed tests, newest first
+
+        date_from, date_to - only get the months between these timestamps, in seconds
+        """
+        months = [r.month for r in session.execute(self.__prepared_statements['select_test_completed_months'])]
+        if date_from is not None:
+            months = [m for m in months if m >= timestamp_month(date_from)]
+        if date_to is not None:
+            months = [m for m in months if m <= timestamp_month(date_to)]
+        return months
+
+    def __generate_completed_test_rows(self, session, date_from=None, date_to=None):
+        """Read completed test rows, most recently completed first, walking the months newest first"""
+        bounds = (int(date_from * 1000) if date_from is not None else 0,
+                  int(date_to * 1000) if date_to is not None else MAX_TIMESTAMP_MS)
+        for month in self.__get_completed_months(session, date_from, date_to):
+            for row in session.execute(self.__prepared_statements['select_test_completed_by_month'], (month,) + bounds):
+                yield row
+
     def get_completed_tests(self, limit=999999999):
         session = self.get_session()
-        rows = session.execute(self.__prepared_statements['select_test_completed'], (limit,))
-        return [self.__test_row_to_dict(r) for r in rows]
+        rows = itertools.islice(self.__generate_completed_test_rows(session), limit)
+        return [TestRecord(r) for r in rows]
+
+    def get_completed_tests_page(self, page_size=100, page=None, date_from=None, date_to=None):
+        """Get one page of completed tests, most recently completed first
+
+        page - where the page starts, as returned with the previous page
+        date_from, date_to - only get the tests completed between these
+                             timestamps, in seconds
+
+        returns a tuple of (tests, page to pass to get the next page or None)
+        """
+        session = self.get_session()
+        months = self.__get_completed_months(session, date_from, date_to)
+        paging_state = None
+        if page:
+            # Pages are <month>:<hex paging state within that month>
+            try:
+                month, paging_state = page.split(':', 1)
+                paging_state = paging_state.decode('hex') or None
+            except (ValueError, TypeError):
+                raise ValueError('Invalid page: {page}'.format(page=page))
+            months = [m for m in months if m <= month]
+
+        bounds = (int(date_from * 1000) if date_from is not None else 0,
+                  int(date_to * 1000) if date_to is not None else MAX_TIMESTAMP_MS)
+        tests = []
+        for i, month in enumerate(months):
+            statement = self.__prepared_statements['select_test_completed_by_month'].bind((month,) + bounds)
+            statement.fetch_size = page_size - len(tests)
+            rows = session.execute(statement, paging_state=paging_state)
+            paging_state = None
+            tests.extend(TestRecord(r) for r in rows.current_rows)
+            if rows.paging_state:
+                return tests, '{month}:{state}'.format(month=month, state=rows.paging_state.encode('hex'))
+            if len(tests) >= page_size:
+                return tests, ('{month}:'.format(month=months[i + 1]) if i + 1 < len(months) else None)
+        return tests, None
+
+    def backfill_tests_completed_by_month(self):
+        """Copy the rows of tests_completed into tests_completed_by_month
+
+        returns the number of tests copied
+        """
+        session = self.get_session(shared=False)
+        copied = 0
+        # Not a prepared statement, tests_completed only exists in keyspaces created before 0009.cql:
+        for row in session.execute("SELECT * FROM tests_completed WHERE status = 'completed'"):
+            month = completed_month(row.completed_date)
+            session.execute(self.__prepared_statements['insert_test_completed_month'], (month,))
+            session.execute(self.__prepared_statements['insert_test_completed_by_month'],
+                            (month, row.completed_date, row.status, row.test_id, row.cluster, row.title, row.user))
+            copied += 1
+        session.shutdown()
+        return copied
 
     ################################################################################
     ####  Retrieve tests by user:
     ################################################################################
     def get_test_status_by_user(self, status, user, limit=999999999):
         session = self.get_session()
-        rows = session.execute(self.__prepared_statements['select_test_status_by_user'], (status, user, limit))
-        return [self.__test_row_to_dict(r) for r in rows]
+        rows = session.execute(self.__prepared_statements['select_tests_by_user'], (user, status, limit))
+        return [TestRecord(r) for r in rows]
 
     def get_user_scheduled_tests(self, user, limit=999999999):
         return self.get_test_status_by_user('scheduled', user, limit)
@@ -606,7 +1082,6 @@ class Model(object):
             test['test_definition'] = json.loads(test['test_definition'])
         #Compute a usable date field from the test_id:
         test['scheduled_date'] = uuid_to_datetime(test['test_id'])
-        log.debug(row)
         if test.has_key('completed_date') and test['completed_date'] is not None:
             test['completed_date'] = uuid_to_datetime(test['completed_date'])
         test['test_id'] = str(test['test_id'])
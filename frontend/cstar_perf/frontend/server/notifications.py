@@ -5,20 +5,28 @@ test_notification_service - send out notifications of test status changes
  - Registers a PUB socket that broadcasts notifications to cluster_api websocket subscribers.
 
 console_monitor_service - monitor the console out of a cluster
+ - Registers a PULL socket that console_publish sends console messages to.
+ - Registers an XPUB socket that broadcasts them to console subscribers,
+   numbered with a per cluster sequence number.
+ - Registers a REP socket that replays the console backlog of a cluster
+   from a sequence number, see console_replay.
 
 """
 
 import zmq
+import zmq.green
 from daemonize import Daemonize
 import argparse
 import logging
 import traceback
 import threading
 import time
-from collections import defaultdict, deque
 from functools import partial
 import json
 import datetime
+import os
+
+from console_backlog import ConsoleBacklog, CONSOLE_BACKLOG_DIR, CONSOLE_BACKLOG_SIZE
 
 log = logging.getLogger(__name__)
 
@@ -27,6 +35,24 @@ TEST_NOTIFICATION_PORT_PUSH = 5556
 TEST_NOTIFICATION_PORT_SUB = 5557
 CONSOLE_MONITOR_PORT_PUSH = 5558
 CONSOLE_MONITOR_PORT_SUB = 5559
+CONSOLE_MONITOR_PORT_REPLAY = 5560
+
+# console_publish keeps one PUSH socket per process. The frontend's
+# threads are greenlets, so it is a gevent aware socket they share, and
+# the messages of a stream go out in order on it:
+_console_push = {'pid': None, 'socket': None}
+
+def realtime_message(msg, realtime, seq=None):
+    """Add the realtime flag and sequence number to a JSON encoded console message
+
+    They are appended to the JSON text, so the message doesn't have to
+    be decoded and encoded again for every subscriber.
+    """
+    msg = msg.rstrip()
+    flag = '"realtime": true}' if realtime else '"realtime": false}'
+    if seq is not None:
+        flag = '"seq": {seq}, {flag}'.format(seq=seq, flag=flag)
+    return msg[:-1] + (flag if msg.endswith('{}') else ', ' + flag)
 
 def test_notification_service(port_pull=TEST_NOTIFICATION_PORT_PUSH, port_pub=TEST_NOTIFICATION_PORT_SUB, ip='127.0.0.1'):
     url_pull = "tcp://{ip}:{port_pull}".format(**locals())
@@ -54,9 +80,12 @@ def test_notification_service(port_pull=TEST_NOTIFICATION_PORT_PUSH, port_pub=TE
         log.error(traceback.format_exc())
         log.info("test_notification_service shutdown")
 
-def console_monitor_service(port_pull=CONSOLE_MONITOR_PORT_PUSH, port_pub=CONSOLE_MONITOR_PORT_SUB, ip='127.0.0.1'):
+def console_monitor_service(port_pull=CONSOLE_MONITOR_PORT_PUSH, port_pub=CONSOLE_MONITOR_PORT_SUB,
+                            port_replay=CONSOLE_MONITOR_PORT_REPLAY, ip='127.0.0.1',
+                            backlog_dir=CONSOLE_BACKLOG_DIR, backlog_size=CONSOLE_BACKLOG_SIZE):
     url_pull = "tcp://{ip}:{port_pull}".format(**locals())
     url_pub = "tcp://{ip}:{port_pub}".format(**locals())
+    url_replay = "tcp://{ip}:{port_replay}".format(**locals())
     try:
         log.info('console_monitor_service staring')
         log.info('console_monitor_service pull url: {url_pull}'.format(**locals()))
@@ -69,25 +98,25 @@ def console_monitor_service(port_pull=CONSOLE_MONITOR_PORT_PUSH, port_pub=CONSOL
         publisher = context.socket(zmq.XPUB)
         publisher.bind(url_pub)
 
+        replayer = context.socket(zmq.REP)
+        replayer.bind(url_replay)
+
         poller = zmq.Poller()
         poller.register(receiver, zmq.POLLIN)
         poller.register(publisher, zmq.POLLIN)
+        poller.register(replayer, zmq.POLLIN)
 
-        # Cache the last 100 messages per cluster:
-        cache = defaultdict(partial(deque, maxlen=100)) # cluster_name -> deque
+        # Keep the last backlog_size bytes of messages per cluster:
+        backlog = ConsoleBacklog(backlog_dir, backlog_size)
 
         while True:
             events = dict(poller.poll(1000))
             
             if receiver in events:
                 data = receiver.recv()
-                topic, cluster, msg = data.split(' ', 2)
-                cache[cluster].append(msg)
-                # Mark message as realtime:
-                msg = json.loads(msg)
-                msg['realtime'] = True
-                msg = json.dumps(msg)
-                data = " ".join([topic, cluster, msg])
+                topic, cluster, job_id, msg = data.split(' ', 3)
+                seq = backlog[cluster].add(job_id, msg)
+                data = " ".join([topic, cluster, realtime_message(msg, True, seq)])
                 log.debug("PUB - {msg}".format(msg=data))
                 publisher.send(data)
             
@@ -96,33 +125,47 @@ def console_monitor_service(port_pull=CONSOLE_MONITOR_PORT_PUSH, port_pub=CONSOL
                 # Subscription events areone byte: 0=unsub or 1=sub,
                 # followed by topic:
                 if event[0] == b'\x01':
-                    topic, cluster = event[1:].strip().split(" ")
                     log.debug("SUBSCRIBE - {sub}".format(sub=event[1:]))
-                    if topic == 'console':
-                        # Client subscribed, send out previous messages:
-                        log.debug("Sending backlog:")
-                        for msg in cache[cluster]:
-                            # Mark messages as non-realtime:
-                            data = json.loads(msg)
-                            data['realtime'] = False
-                            msg = json.dumps(data)
-                            data = "console {cluster} {msg}".format(cluster=cluster, msg=msg)
-                            log.debug(data)
-                            publisher.send(data)
                 elif event[0] == b'\x00':
                     log.debug("UNSUBSCRIBE - {sub}".format(sub=event[1:]))
                     
 
+            if replayer in events:
+                # Replay requests are: replay <cluster> <from_seq> [<job_id>]
+                # Replies are the sequence number replayed from, followed
+                # by the messages:
+                request = replayer.recv().split(' ')
+                try:
+                    cluster, from_seq = request[1], int(request[2])
+                    job_id = request[3] if len(request) > 3 else None
+                    # Only clusters that published something have a
+                    # backlog, don't create one for any name asked for:
+                    cluster_backlog = backlog.get(cluster)
+                    if cluster_backlog is None:
+                        messages = []
+                    else:
+                        if from_seq > cluster_backlog.next_seq:
+                            # The sequence numbers started over, as the
+                            # backlog was lost, so replay all of it:
+                            from_seq = 0
+                        messages = [realtime_message(msg, False, seq) for seq, msg in
+                                    cluster_backlog.replay(from_seq, job_id)]
+                except (IndexError, ValueError):
+                    log.error("Bad replay request: {request}".format(request=request))
+                    from_seq, messages = 0, []
+                replayer.send_multipart([str(from_seq)] + messages)
+
     except Exception, e:
         # Log every error. If we're not running in the foreground, we
         # won't see the errrors any other way:
         log.error(traceback.format_exc())
         log.info("console_monitor_service shutdown")
 
-def multi_service():
+def multi_service(backlog_dir=CONSOLE_BACKLOG_DIR, backlog_size=CONSOLE_BACKLOG_SIZE):
     """Start all the services in separate threads"""
     threads = []
-    for service in [test_notification_service, console_monitor_service]:
+    for service in [test_notification_service,
+                    partial(console_monitor_service, backlog_dir=backlog_dir, backlog_size=backlog_size)]:
         threads.append(threading.Thread(target=service))
     for thread in threads:
         thread.daemon = True
@@ -133,17 +176,6 @@ def multi_service():
         except KeyboardInterrupt:
             exit()
 
-def zmq_socket_subscribe(url, topic='', timeout=5000):
-    zmq_context = zmq.Context()
-    zmq_socket = zmq_context.socket(zmq.SUB)
-    zmq_socket.connect(url)
-    zmq_socket.setsockopt_string(
-        zmq.SUBSCRIBE, 
-        unicode(topic))
-    # Timeout:
-    zmq_socket.setsockopt(zmq.RCVTIMEO, timeout)
-    return zmq_socket
-    
 def console_publish(cluster_name, data):
     """Publish a console message or control message
 
@@ -153,21 +185,46 @@ def console_publish(cluster_name, data):
        msg - a message shown on the console
        ctl - A control message indicating cluster status START, DONE, IDLE
     """
-    zmq_context = zmq.Context()
-    zmq_socket = zmq_context.socket(zmq.PUSH)
-    zmq_socket.connect("tcp://127.0.0.1:{port}".format(port=CONSOLE_MONITOR_PORT_PUSH))
+    # Reuse the socket of this process, unless it was created before a fork:
+    if _console_push['pid'] != os.getpid():
+        zmq_socket = zmq.green.Context().socket(zmq.PUSH)
+        zmq_socket.connect("tcp://127.0.0.1:{port}".format(port=CONSOLE_MONITOR_PORT_PUSH))
+        _console_push.update(pid=os.getpid(), socket=zmq_socket)
+    zmq_socket = _console_push['socket']
     if not data.has_key('timestamp'):
         data['timestamp'] = (datetime.datetime.utcnow() - datetime.datetime(1970,1,1)).total_seconds()
-    zmq_socket.send_string("console {cluster_name} {data}".format(
-        cluster_name=cluster_name, 
+    # The job id is sent ahead of the message for the backlog to index it
+    # by, console_monitor_service strips it out:
+    zmq_socket.send_string("console {cluster_name} {job_id} {data}".format(
+        cluster_name=cluster_name,
+        job_id=data.get('job_id') or '-',
         data=json.dumps(data)))
 
-def console_subscribe(cluster_name):
-    return zmq_socket_subscribe(
-        'tcp://localhost:{port}'.format(port=CONSOLE_MONITOR_PORT_SUB), 
-        'console {cluster_name} '.format(cluster_name=cluster_name))
+def console_replay(cluster_name, from_seq=0, job_id=None, timeout=5000, zmq=zmq):
+    """Get the console messages of a cluster since a sequence number
 
+    job_id - only get the messages of this job
+    zmq - the zmq module to use, zmq.green from gevent code
 
+    Returns the sequence number replayed from, which is 0 if the
+    sequence numbers started over since from_seq, and the messages,
+    encoded as JSON and marked as non-realtime. Returns None if
+    console_monitor_service did not answer within timeout ms.
+    """
+    zmq_socket = zmq.Context.instance().socket(zmq.REQ)
+    zmq_socket.setsockopt(zmq.LINGER, 0)
+    zmq_socket.connect("tcp://127.0.0.1:{port}".format(port=CONSOLE_MONITOR_PORT_REPLAY))
+    try:
+        request = "replay {cluster_name} {from_seq}".format(cluster_name=cluster_name, from_seq=from_seq)
+        if job_id:
+            request += " " + job_id
+        zmq_socket.send(request)
+        if not zmq_socket.poll(timeout):
+            return None
+        reply = zmq_socket.recv_multipart()
+        return int(reply[0]), reply[1:]
+    finally:
+        zmq_socket.close()
 
 def main():
     parser = argparse.ArgumentParser(description='cstar_perf_notifications')
@@ -179,7 +236,12 @@ def main():
                         help='File to log to', dest='logfile')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Print log messages', dest='verbose')
+    parser.add_argument('--backlog-dir', default=CONSOLE_BACKLOG_DIR,
+                        help='Directory to keep the console backlogs in', dest='backlog_dir')
+    parser.add_argument('--backlog-size', type=int, default=CONSOLE_BACKLOG_SIZE,
+                        help='Bytes of console messages to keep per cluster', dest='backlog_size')
     args = parser.parse_args()
+    service = partial(multi_service, backlog_dir=args.backlog_dir, backlog_size=args.backlog_size)
 
     log.setLevel(logging.DEBUG)
     log.propagate = False
@@ -197,9 +259,9 @@ def main():
 
 
     if args.foreground:
-        multi_service()
+        service()
     else:
-        daemon = Daemonize(app="notifications", pid=args.pid, action=multi_service, keep_fds=keep_fds)
+        daemon = Daemonize(app="notifications", pid=args.pid, action=service, keep_fds=keep_fds)
         daemon.start()
 
 
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..console_backlog import ClusterBacklog, ConsoleBacklog
+
+
+def message(n):
+    return '{{"job_id": "job", "msg": "{n:04d}"}}'.format(n=n)
+
+MESSAGE_SIZE = len(message(0))
+
+
+class TestClusterBacklog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cluster.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sequence_numbers(self):
+        backlog = ClusterBacklog(self.path)
+        self.assertEquals([backlog.add('job', message(n)) for n in range(3)], [0, 1, 2])
+        self.assertEquals(backlog.replay(), [(0, message(0)), (1, message(1)), (2, message(2))])
+        self.assertEquals(backlog.replay(2), [(2, message(2))])
+        self.assertEquals(backlog.replay(3), [])
+
+    def test_replay_job(self):
+        backlog = ClusterBacklog(self.path)
+        backlog.add('a', message(0))
+        backlog.add(None, message(1))
+        backlog.add('b', message(2))
+        backlog.add('a', message(3))
+        self.assertEquals(backlog.replay(job_id='a'), [(0, message(0)), (3, message(3))])
+        self.assertEquals(backlog.replay(1, job_id='a'), [(3, message(3))])
+
+    def test_budget(self):
+        backlog = ClusterBacklog(self.path, max_size=MESSAGE_SIZE * 3)
+        for n in range(10):
+            backlog.add('job', message(n))
+        # The oldest messages are dropped first:
+        self.assertEquals([seq for seq, msg in backlog.replay()], [7, 8, 9])
+        self.assertEquals(backlog.size, MESSAGE_SIZE * 3)
+        # A message larger than the budget is still kept, on its own:
+        backlog.add('job', 'x' * MESSAGE_SIZE * 5)
+        self.assertEquals([seq for seq, msg in backlog.replay()], [10])
+
+    def test_reload(self):
+        backlog = ClusterBacklog(self.path, max_size=MESSAGE_SIZE * 3)
+        for n in range(5):
+            backlog.add('job', message(n))
+        backlog = ClusterBacklog(self.path, max_size=MESSAGE_SIZE * 3)
+        self.assertEquals([seq for seq, msg in backlog.replay()], [2, 3, 4])
+        # Sequence numbers carry on from where they were:
+        self.assertEquals(backlog.add('job', message(5)), 5)
+
+    def test_reload_skips_bad_lines(self):
+        backlog = ClusterBacklog(self.path)
+        backlog.add('job', message(0))
+        with open(self.path, 'a') as f:
+            f.write('not a backlog line\n')
+        backlog = ClusterBacklog(self.path)
+        self.assertEquals(backlog.replay(), [(0, message(0))])
+
+    def test_compaction(self):
+        backlog = ClusterBacklog(self.path, max_size=MESSAGE_SIZE * 3)
+        for n in range(20):
+            backlog.add('job', message(n))
+            # The log file never grows much past twice the budget:
+            self.assertTrue(os.path.getsize(self.path) <= (MESSAGE_SIZE + 10) * 6)
+        self.assertEquals(ClusterBacklog(self.path, max_size=MESSAGE_SIZE * 3).replay(), backlog.replay())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+
+class TestConsoleBacklog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_clusters(self):
+        backlog = ConsoleBacklog(os.path.join(self.tmp_dir, 'backlog'))
+        backlog['a/b'].add('job', message(0))
+        backlog['a/b'].add('job', message(1))
+        backlog['c'].add('job', message(2))
+        self.assertTrue(backlog['a/b'] is backlog['a/b'])
+        self.assertEquals(backlog['c'].replay(), [(0, message(2))])
+        # Cluster names are quoted to make file names:
+        self.assertEquals(sorted(os.listdir(os.path.join(self.tmp_dir, 'backlog'))), ['a%2Fb.log', 'c.log'])
+
+    def test_get(self):
+        directory = os.path.join(self.tmp_dir, 'backlog')
+        backlog = ConsoleBacklog(directory)
+        # Unknown clusters have no backlog, and get doesn't create one:
+        self.assertIsNone(backlog.get('unknown'))
+        self.assertEquals(os.listdir(directory), [])
+        backlog['c'].add('job', message(0))
+        self.assertTrue(backlog.get('c') is backlog['c'])
+        # Backlogs left on disk are loaded:
+        backlog = ConsoleBacklog(directory)
+        self.assertEquals(backlog.get('c').replay(), [(0, message(0))])
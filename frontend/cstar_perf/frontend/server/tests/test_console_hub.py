@@ -0,0 +1,36 @@
+import unittest
+
+from ..console_hub import ConsoleSubscription, message_seq
+from ..notifications import realtime_message
+
+
+def message(seq):
+    return realtime_message('{"msg": "%d"}' % seq, True, seq)
+
+
+class TestConsoleSubscription(unittest.TestCase):
+    def test_message_seq(self):
+        self.assertEquals(message_seq(message(42)), 42)
+        self.assertEquals(message_seq(realtime_message('{"ctl": "WAIT"}', False)), None)
+
+    def test_skips_seen_messages(self):
+        subscription = ConsoleSubscription(None, 'cluster', from_seq=2)
+        for seq in (1, 2, 3, 3, 4):
+            subscription.put(message(seq), seq)
+        subscription.put('{"ctl": "WAIT"}', None)
+        self.assertEquals([subscription.get(0) for _ in range(4)],
+                          [message(2), message(3), message(4), '{"ctl": "WAIT"}'])
+
+    def test_drops_oldest(self):
+        subscription = ConsoleSubscription(None, 'cluster', maxlen=2)
+        for seq in range(5):
+            subscription.put(message(seq), seq)
+        self.assertEquals(subscription.dropped, 3)
+        self.assertEquals([subscription.get(0), subscription.get(0)], [message(3), message(4)])
+
+    def test_holds_messages(self):
+        subscription = ConsoleSubscription(None, 'cluster')
+        subscription.held = []
+        subscription.put(message(0), 0)
+        self.assertEquals(list(subscription.queue), [])
+        self.assertEquals(subscription.held, [(message(0), 0)])
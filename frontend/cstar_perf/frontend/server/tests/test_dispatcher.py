@@ -0,0 +1,74 @@
+import time
+import unittest
+import uuid
+
+from ..dispatcher import ClusterQueue, Dispatcher, queue_stats, scheduled_time
+from cstar_perf.frontend.lib.util import uuid_from_time
+
+
+def make_test_ids(*ages):
+    """Make test ids scheduled the given numbers of seconds ago"""
+    now = time.time()
+    return [str(uuid_from_time(now - age)) for age in ages]
+
+
+class TestClusterQueue(unittest.TestCase):
+    def test_scheduled_time(self):
+        now = time.time()
+        self.assertAlmostEqual(scheduled_time(uuid.uuid1()), now, delta=1)
+        self.assertAlmostEqual(scheduled_time(str(uuid_from_time(now - 60))), now - 60, delta=1)
+
+    def test_oldest_first(self):
+        newest, oldest, middle = make_test_ids(10, 30, 20)
+        queue = ClusterQueue('cluster')
+        for test_id in (newest, oldest, middle):
+            queue.add(test_id)
+        # Already queued:
+        queue.add(uuid.UUID(oldest))
+        self.assertEquals([queue.get(0) for _ in range(3)], [oldest, middle, newest])
+        self.assertEquals(queue.get(0), None)
+
+    def test_remove(self):
+        first, second = make_test_ids(20, 10)
+        queue = ClusterQueue('cluster')
+        queue.add(first)
+        queue.add(second)
+        queue.remove(uuid.UUID(first))
+        # Not queued:
+        queue.remove(first)
+        self.assertEquals(queue.get(0), second)
+        self.assertEquals(queue.get(0), None)
+
+    def test_requeue(self):
+        first, second = make_test_ids(20, 10)
+        dispatcher = Dispatcher(db=None)
+        queue = dispatcher.queues['cluster'] = ClusterQueue('cluster')
+        queue.add(second)
+        queue.add(first)
+        self.assertEquals(dispatcher.get('cluster', 0), first)
+        # A test put back keeps its place in line:
+        dispatcher.requeue('cluster', first)
+        self.assertEquals(dispatcher.get('cluster', 0), first)
+        # Clusters without a queue are ignored:
+        dispatcher.requeue('other', first)
+        self.assertFalse('other' in dispatcher.queues)
+
+    def test_stats(self):
+        queue = ClusterQueue('cluster')
+        for test_id in make_test_ids(30, 10):
+            queue.add(test_id)
+        queue.get(0)
+        stats = queue.stats()
+        self.assertEquals(stats['depth'], 1)
+        self.assertAlmostEqual(stats['oldest_wait'], 10, delta=1)
+        self.assertEquals(stats['dispatched'], 1)
+        self.assertAlmostEqual(stats['dispatched_max_wait'], 30, delta=1)
+        self.assertAlmostEqual(stats['dispatched_mean_wait'], 30, delta=1)
+
+    def test_queue_stats(self):
+        now = time.time()
+        stats = queue_stats(make_test_ids(30, 10), now=now)
+        self.assertEquals(stats['depth'], 2)
+        self.assertAlmostEqual(stats['oldest_wait'], 30, delta=1)
+        self.assertAlmostEqual(stats['mean_wait'], 20, delta=1)
+        self.assertEquals(queue_stats([]), {'depth': 0, 'oldest_wait': 0, 'mean_wait': 0})
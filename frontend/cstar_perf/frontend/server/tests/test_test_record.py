@@ -0,0 +1,61 @@
+import json
+import unittest
+import uuid
+from collections import namedtuple
+
+from ..model import TestRecord
+from cstar_perf.frontend.lib.util import uuid_to_datetime
+
+Row = namedtuple('Row', ['test_id', 'status', 'completed_date', 'test_definition'])
+
+
+class TestTestRecord(unittest.TestCase):
+    def setUp(self):
+        self.test_id = uuid.uuid1()
+        self.completed = uuid.uuid1()
+        self.row = Row(self.test_id, 'completed', self.completed, json.dumps({'title': 'Test'}))
+        self.record = TestRecord(self.row)
+
+    def test_values(self):
+        self.assertEquals(self.record['test_id'], str(self.test_id))
+        self.assertEquals(self.record['status'], 'completed')
+        self.assertEquals(self.record['scheduled_date'], uuid_to_datetime(self.test_id))
+        self.assertEquals(self.record['completed_date'], uuid_to_datetime(self.completed))
+        self.assertEquals(self.record['test_definition'], {'title': 'Test'})
+
+    def test_null_values(self):
+        record = TestRecord(Row(self.test_id, 'scheduled', None, None))
+        self.assertEquals(record['completed_date'], None)
+        self.assertEquals(record['test_definition'], None)
+
+    def test_converted_once(self):
+        definition = self.record['test_definition']
+        definition['title'] = 'Changed'
+        self.assertEquals(self.record['test_definition']['title'], 'Changed')
+
+    def test_missing_keys(self):
+        self.assertRaises(KeyError, lambda: self.record['user'])
+        self.assertEquals(self.record.get('user'), None)
+        self.assertEquals(self.record.get('user', 'nobody'), 'nobody')
+        self.assertFalse('user' in self.record)
+        self.assertFalse(self.record.has_key('user'))
+
+    def test_keys(self):
+        keys = ['test_id', 'status', 'completed_date', 'test_definition', 'scheduled_date']
+        self.assertEquals(self.record.keys(), keys)
+        self.assertEquals(list(self.record), keys)
+        self.assertEquals(len(self.record), 5)
+        self.assertTrue('scheduled_date' in self.record)
+        # Values set on the record are added to the keys:
+        self.record['user'] = 'ryan'
+        self.assertEquals(self.record['user'], 'ryan')
+        self.assertEquals(self.record.keys(), keys + ['user'])
+        self.record['status'] = 'failed'
+        self.assertEquals(self.record['status'], 'failed')
+        self.assertEquals(len(self.record), 6)
+
+    def test_to_dict(self):
+        test = self.record.to_dict()
+        self.assertEquals(sorted(test), sorted(self.record.keys()))
+        self.assertEquals(test['test_id'], str(self.test_id))
+        self.assertEquals(json.loads(json.dumps(test, default=str))['status'], 'completed')
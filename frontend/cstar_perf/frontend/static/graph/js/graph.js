@@ -682,7 +682,32 @@ var drawGraph = function() {
 
     $('#loading_indicator').loadingOverlay();
 
+    //Intervals may be stored column oriented, one array per metric
+    //(see cstar_perf.tool.intervals), convert those back to rows:
+    var decode_intervals = function(intervals) {
+        if (intervals === undefined || intervals.format !== 'columnar') {
+            return intervals;
+        }
+        var columns = intervals.columns;
+        var rows = [];
+        if (columns.length > 0) {
+            for (var r = 0; r < columns[0].length; r++) {
+                var row = [];
+                for (var c = 0; c < columns.length; c++) {
+                    row.push(columns[c][r]);
+                }
+                rows.push(row);
+            }
+        }
+        return rows;
+    };
+
     d3.json(stats_db, function(error, data) {
+        if (data && data.stats) {
+            data.stats.forEach(function(d) {
+                d.intervals = decode_intervals(d.intervals);
+            });
+        }
         //Filter the dataset for the one we want:
         raw_data = data;
         $('#loading_indicator').loadingOverlay('remove');
@@ -1,6 +1,8 @@
 var ws;
 var connectionAttempts = 1;
 var currentJobId;
+// Sequence number of the last console message received, to resume from on reconnect:
+var lastSeq;
 
 var consoleMessage = function(msg, classes) {
     var conn = $("#console");
@@ -17,7 +19,9 @@ var consoleMessage = function(msg, classes) {
 var newWebsocket = function() {
     var wsUri = "ws://" + window.location.host + "/api/console";
     var conn = $("#console");
-    conn.empty();
+    if (lastSeq === undefined) {
+        conn.empty();
+    }
     var indicator = $("#status_indicator");
     var change_status = function(state, job_id) {
         if (state === 'wait') {
@@ -51,6 +55,9 @@ var newWebsocket = function() {
             ws.send(evt.data)
             return;
         } 
+        if (data.seq != undefined) {
+            lastSeq = data.seq;
+        }
         // Handle control messages.
         if (data.ctl != undefined) {
             // The server will relay us old messages, so make sure they
@@ -93,17 +100,21 @@ var newWebsocket = function() {
     };
     ws.onopen = function(evt) {
         connectionAttempts = 1;
-        conn.empty();
         change_status('unknown');
         conn.scrollTop(conn.prop("scrollHeight"));
         var cluster_re = /\/cluster\/(.*)/;
         var cluster_name = cluster_re.exec(window.location.pathname)[1];
-        ws.send(cluster_name);
+        if (lastSeq === undefined) {
+            conn.empty();
+            ws.send(cluster_name);
+        } else {
+            // Resume after the last message received:
+            ws.send(cluster_name + " " + (lastSeq + 1));
+        }
     };
     ws.onclose = function(evt) {
         var timeToWait = exponentialBackoff(connectionAttempts);
         change_status('client_disconnected');
-        conn.empty();
         conn.append("<span class='error_text'>Disconnected from server.</span>" + "<br/>");
         conn.append("<span class='error_text'>Will retry in " + (timeToWait/1000) +" seconds ...</span>" + "<br/>");
         setTimeout(function() {
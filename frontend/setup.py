@@ -21,7 +21,9 @@ setup(
                     ['cstar_perf_client = cstar_perf.frontend.client.client:main',
                      'cstar_perf_server = cstar_perf.frontend.lib.server:main',
                      'cstar_perf_notifications = cstar_perf.frontend.server.notifications:main',
-                     'cstar_perf_schedule = cstar_perf.frontend.client.schedule:main']},
+                     'cstar_perf_schedule = cstar_perf.frontend.client.schedule:main',
+                     'cstar_perf_migrate_artifacts = cstar_perf.frontend.server.migrate_artifacts:main',
+                     'cstar_perf_backfill = cstar_perf.frontend.server.backfill:main']},
 )
 
 # from cstar_perf.frontend.lib.crypto import get_or_generate_server_keys
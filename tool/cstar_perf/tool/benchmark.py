@@ -5,6 +5,7 @@ Bootstrap Cassandra onto a cluster and benchmark stress.
 import subprocess
 import tempfile
 import os
+import sys
 import time
 import datetime
 from pprint import pprint
@@ -17,13 +18,13 @@ import logging
 import itertools
 import shutil
 import distutils.util
+from contextlib import contextmanager
 
 from fabric.tasks import execute
 import fabric.api as fab
 import yaml
 
 import sh
-import shlex
 
 
 # Import the default config first:r
@@ -32,6 +33,8 @@ import fab_dse as dse
 import fab_cassandra as cstar
 import fab_flamegraph as flamegraph
 import fab_profiler as profiler
+import intervals
+from log_archive import append_log_archive
 
 # Then import our cluster specific config:
 from cluster_config import config
@@ -106,6 +109,17 @@ def _parse_yaml(yaml_file):
     return yaml_file
 
 
+def build_cassandra_archive(git_fetch=True, revision_override=None):
+    """Build a cassandra revision on the local host for the cluster nodes to install
+
+    Returns the name of the build archive
+    """
+    localhost_ip, localhost_entry = get_localhost()
+    with common.fab.settings(hosts=[localhost_entry]):
+        return execute(cstar.build_archive, common.config, git_fetch=git_fetch,
+                       revision_override=revision_override)[localhost_entry]
+
+
 def bootstrap(cfg=None, destroy=False, leave_data=False, git_fetch=True):
     """Deploy and start cassandra on the cluster
     
@@ -173,9 +187,14 @@ def bootstrap(cfg=None, destroy=False, leave_data=False, git_fetch=True):
     # Bootstrap C* onto the cluster nodes, as well as the localhost,
     # so we have access to nodetool, stress etc
     hosts = get_all_hosts(common.fab.env)
+    # build_once: build each cassandra revision only on this node and
+    # distribute the build, instead of building it on every node:
+    build_once = product.name == 'cassandra' and bool(distutils.util.strtobool(str(cfg.get('build_once', 'False'))))
     if not cfg.get('revision_override'):
+        build_archive_name = build_cassandra_archive(git_fetch) if build_once else None
         with common.fab.settings(hosts=hosts):
-            git_ids = execute(common.bootstrap, git_fetch=git_fetch, replace_existing_dse_install=replace_existing_dse_install)
+            git_ids = execute(common.bootstrap, git_fetch=git_fetch, replace_existing_dse_install=replace_existing_dse_install,
+                              build_archive_name=build_archive_name)
     else:
         # revision_override is only supported for the product cassandra
         if product.name != 'cassandra':
@@ -184,12 +203,15 @@ def bootstrap(cfg=None, destroy=False, leave_data=False, git_fetch=True):
         git_ids = {}
         default_hosts = set(hosts) - set(itertools.chain(*cfg['revision_override'].values()))
         print 'default version on {default_hosts}'.format(default_hosts=default_hosts)
+        build_archive_name = build_cassandra_archive(git_fetch) if build_once else None
         with common.fab.settings(hosts=default_hosts):
-            git_ids.update(execute(common.bootstrap, git_fetch=git_fetch))
+            git_ids.update(execute(common.bootstrap, git_fetch=git_fetch, build_archive_name=build_archive_name))
         for override_revision, hosts_to_override in cfg['revision_override'].items():
             print '{revision} on {hosts_to_override}'.format(revision=override_revision, hosts_to_override=hosts_to_override)
+            build_archive_name = build_cassandra_archive(False, override_revision) if build_once else None
             with common.fab.settings(hosts=hosts_to_override):
-                git_ids.update(execute(common.bootstrap, git_fetch=git_fetch, revision_override=override_revision))
+                git_ids.update(execute(common.bootstrap, git_fetch=git_fetch, revision_override=override_revision,
+                                       build_archive_name=build_archive_name))
 
     if product.name == 'cassandra':
         overridden_host_versions = {}
@@ -214,7 +236,7 @@ def bootstrap(cfg=None, destroy=False, leave_data=False, git_fetch=True):
 
     if not is_running:
         try:
-            retrieve_logs_and_create_tarball(job_id=_extract_job_id())
+            retrieve_logs_to_archive(get_log_archive_path(common.config['log']), 'startup')
         except Exception as e:
             logger.warn(e)
             pass
@@ -226,21 +248,32 @@ def bootstrap(cfg=None, destroy=False, leave_data=False, git_fetch=True):
     return git_ids
 
 
-def _extract_job_id():
-    # this will have a string looking as following: /home/cstar/.cstar_perf/jobs/<jobid>/stats.<jobid>.json
-    stats_log = common.config.get('log')
-    # will give us: <jobid>
-    return stats_log.split(os.path.sep)[-2]
+def get_log_archive_path(stats_log):
+    """Get the path of the log archive for a job, kept next to its stats log
+
+    The archive is named after the job directory: cassandra_logs.<job_id>.tar.gz
+    """
+    job_dir = os.path.dirname(os.path.abspath(stats_log))
+    return os.path.join(job_dir, 'cassandra_logs.{job_id}.tar.gz'.format(job_id=os.path.basename(job_dir)))
 
 
-def retrieve_logs_and_create_tarball(job_id):
-    log_dir = os.path.join(CSTAR_PERF_LOGS_DIR, job_id)
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    retrieve_logs(log_dir)
-    # Tar them for archiving:
-    subprocess.Popen(shlex.split('tar cfvz {id}.tar.gz {id}'.format(id=job_id)), cwd=CSTAR_PERF_LOGS_DIR).communicate()
-    shutil.rmtree(log_dir)
+def retrieve_logs_to_archive(archive_path, member_dir, max_file_size=None, include=None, exclude=None):
+    """Stream each node's logs into a log archive
+
+    archive_path - the job's log archive, see get_log_archive_path
+    member_dir - the directory in the archive for these logs, eg. revision_01
+    max_file_size - keep only the last max_file_size bytes of larger log files
+    include - if set, only log files matching one of these glob patterns are kept
+    exclude - log files matching any of these glob patterns are left out
+    """
+    # The archive holds a single top level directory, named like the archive:
+    prefix = os.path.join(os.path.basename(archive_path).replace('.tar.gz', ''), member_dir)
+    parts = execute(common.stream_logs_to_archive, archive_path, prefix, max_file_size=max_file_size,
+                    include=include, exclude=exclude)
+    # The nodes stream their logs in parallel into parts, appended here
+    # by a single writer:
+    for part_path in sorted(p for p in parts.values() if isinstance(p, basestring)):
+        append_log_archive(archive_path, part_path)
 
 
 def restart():
@@ -450,103 +483,49 @@ def nodetool_multi(nodes, command):
         return execute(common.multi_nodetool, command)
 
 
-def wait_for_compaction(nodes=None, check_interval=30, idle_confirmations=3,
+def wait_for_compaction(nodes=None, check_interval=2, stability_window=10,
                         compaction_throughput=16, allowed_connection_errors=10):
     """Wait for all currently scheduled compactions to finish on all (or just specified) nodes
 
+    The checks are run by an agent script on each node, which polls
+    nodetool compactionstats and tpstats locally and returns as soon as
+    compactions have been idle for the whole stability window.
+
     nodes - the nodes to check (None == all)
-    check_interval - the time to wait between checks
-    idle_confirmations - the number of checks that must show 0 compactions before we assume compactions are really done.
+    check_interval - the time the agent waits between checks
+    stability_window - the number of seconds compactions must stay idle before we assume they are really done
     compaction_throughput - the default compaction_throughput_mb_per_sec setting from the cassandra.yaml
     allowed_connection_errors - the number of consecutive connection errors allowed before we quit trying
 
-    returns the duration all compactions took (margin of error: check_interval * idle_confirmations)
+    returns the duration all compactions took (margin of error: the time a single check takes plus check_interval)
     """
-
-    def compactionstats(nodes, check_interval):
-        """Check for compactions via nodetool compactionstats"""
-        consecutive_connection_errors = 0
-        pattern = re.compile("(^|\n)pending tasks: 0")
-        failure_pattern = re.compile("ConnectException")
-        nodes = set(nodes)
-        while True:
-            results = execute(common.multi_nodetool, cmd="compactionstats")
-            for node, output in results.iteritems():
-                if pattern.search(output.strip()):
-                    nodes.discard(node)
-                elif failure_pattern.search(output.strip()):
-                    consecutive_connection_errors += 1
-
-            if consecutive_connection_errors > allowed_connection_errors:
-                raise NodetoolException(
-                    "Failed to connect via nodetool {consecutive_connection_errors} times in a row.".format(
-                        consecutive_connection_errors=consecutive_connection_errors))
-
-            if len(nodes) == 0:
-                break
-            logger.info("Waiting for compactions (compactionstats) on nodes:")
-            for node in nodes:
-                logger.info("{node} - {output}".format(node=node, output=results[node]))
-            time.sleep(check_interval)
-
-        assert len(nodes) == 0, ("Compactions (compactionstats) should have finished, but they didn't"
-                            " on nodes: {nodes}. output: {results}".format(
-                                nodes=nodes, output=results))
-
-    def tpstats(nodes, check_interval):
-        """Check for compactions via nodetool tpstats"""
-        consecutive_connection_errors = 0
-        stat_exists_pattern = re.compile("^CompactionExecutor", re.MULTILINE)
-        no_compactions_pattern = re.compile("CompactionExecutor\W*0\W*0\W*[0-9]*\W*0", re.MULTILINE)
-        failure_pattern = re.compile("ConnectException")
-
-        nodes = set(nodes)
-        while True:
-            results = execute(common.multi_nodetool, cmd="tpstats")
-            for node, output in results.iteritems():
-                if stat_exists_pattern.search(output):
-                    if no_compactions_pattern.search(output):
-                        nodes.discard(node)
-                elif failure_pattern.search(output.strip()):
-                    consecutive_connection_errors += 1
-                else:
-                    logger.warn("CompactionExecutor not listed in nodetool tpstats, can't check for compactions this way.")
-                    return
-
-            if consecutive_connection_errors > allowed_connection_errors:
-                raise NodetoolException(
-                    "Failed to connect via nodetool {consecutive_connection_errors} times in a row.".format(
-                        consecutive_connection_errors=consecutive_connection_errors))
-
-            if len(nodes) == 0:
-                break
-            logger.info("Waiting for compactions (tpstats) on nodes: {nodes}".format(nodes=nodes))
-            time.sleep(check_interval)
-
-        assert len(nodes) == 0, ("Compactions (tpstats) should have finished, but they didn't"
-                            " on nodes: {nodes}. output: {results}".format(
-                                nodes=nodes, output=results))
-
     if nodes is None:
         nodes = set(common.fab.env.hosts)
     else:
         nodes = set(nodes)
 
-    # Disable compaction throttling to speed things up:
-    execute(common.multi_nodetool, cmd="setcompactionthroughput 0")
+    with common.fab.settings(hosts=list(nodes)):
+        # Disable compaction throttling to speed things up:
+        execute(common.multi_nodetool, cmd="setcompactionthroughput 0")
+
+        results = execute(common.wait_for_compaction_idle, poll_interval=check_interval,
+                          stability_window=stability_window, allowed_connection_errors=allowed_connection_errors)
 
-    # Perform checks multiple times to ensure compactions are really done:
-    start = time.time()
-    for i in range(idle_confirmations):
-        compactionstats(nodes, check_interval)
-        tpstats(nodes, check_interval)
+        # Re-enable compaction throttling:
+        execute(common.multi_nodetool, cmd='setcompactionthroughput {compaction_throughput}'.format(**locals()))
 
-    duration = time.time() - start
+    durations = {}
+    for node, output in results.iteritems():
+        result = json.loads(output)
+        if 'error' in result:
+            raise NodetoolException("{node} - {error}".format(node=node, error=result['error']))
+        durations[node] = result['duration']
+        logger.info("Compactions finished on {node} after {duration:.1f}s ({checks} checks)".format(
+            node=node, **result))
 
-    # Re-enable compaction throttling:
-    execute(common.multi_nodetool, cmd='setcompactionthroughput {compaction_throughput}'.format(**locals()))
+    duration = max(durations.values()) if durations else 0
 
-    logger.info("Compactions finished on all nodes. Duration of checks: {duration}".format(**locals()))
+    logger.info("Compactions finished on all nodes. Duration of compactions: {duration}".format(**locals()))
 
     return duration
 
@@ -611,8 +590,63 @@ def setup_stress(stress_revisions=[]):
     return revisions
 
 
-def stress(cmd, revision_tag, stress_sha, stats=None):
-    """Run stress command and collect average statistics"""
+class StressOutputParser(object):
+    """Incrementally parse cassandra-stress output into a stats dictionary
+
+    Lines are fed in one at a time as stress prints them, so the full
+    log never has to be written to disk or held in memory.
+
+    stats - the stats dictionary to record intervals and aggregates into
+    on_interval - optional callback, called with each interval row
+                  (a list of floats) as soon as it is parsed.
+    """
+    # Regex for trunk cassandra-stress
+    start_of_intervals_re = re.compile('type.*total ops,.*op/s,.*pk/s')
+
+    def __init__(self, stats, on_interval=None):
+        self.stats = stats
+        self.on_interval = on_interval
+        self.collecting_aggregates = False
+        self.collecting_values = False
+
+    def feed(self, line):
+        """Parse a single line of stress output"""
+        line = line.strip()
+        if line.startswith("Results:"):
+            self.collecting_aggregates = True
+            return
+        if not self.collecting_aggregates:
+            if self.start_of_intervals_re.match(line):
+                self.collecting_values = True
+                return
+            if self.collecting_values:
+                line_parts = [l.strip() for l in line.split(',')]
+                # Only capture total metrics for now
+                if line_parts[0] == 'total':
+                    try:
+                        interval = [float(x) for x in line_parts[1:]]
+                        self.stats['intervals'].append(interval)
+                    except ValueError:
+                        return
+                    if self.on_interval is not None:
+                        self.on_interval(interval)
+            return
+        if line.startswith("END") or line == "":
+            return
+        # Collect aggregates:
+        try:
+            stat, value = line.split(":", 1)
+            self.stats[stat.strip().lower()] = value.strip()
+        except ValueError:
+            logger.info("Unable to parse aggregate line: '{}'".format(line))
+
+
+def stress(cmd, revision_tag, stress_sha, stats=None, on_interval=None):
+    """Run stress command and collect average statistics
+
+    on_interval - optional callback, called with each interval row as
+                  stress reports it.
+    """
     # Check for compatible stress commands. This doesn't yet have full
     # coverage of every option:
     # Make sure that if this is a read op, that the number of threads
@@ -623,7 +657,6 @@ def stress(cmd, revision_tag, stress_sha, stats=None):
 
     stress_path = os.path.join(CASSANDRA_STRESS_PATH, stress_sha, 'tools/bin/cassandra-stress')
 
-    temp_log = tempfile.mktemp()
     logger.info("Running stress from '{stress_path}' : {cmd}"
                 .format(stress_path=stress_path, cmd=cmd))
 
@@ -642,48 +675,22 @@ def stress(cmd, revision_tag, stress_sha, stats=None):
         }
 
     # Run stress:
-    # Subprocess communicate() blocks, preventing us from seeing any
-    # realtime output, so pipe the output to a file as a workaround:
-    proc = subprocess.Popen('JAVA_HOME={JAVA_HOME} {CASSANDRA_STRESS} {cmd} | tee {temp_log}'
+    # Read stdout line by line as it is produced, echoing it for
+    # realtime output and parsing it as we go:
+    proc = subprocess.Popen('JAVA_HOME={JAVA_HOME} {CASSANDRA_STRESS} {cmd}'
                             .format(JAVA_HOME=JAVA_HOME,
                                     CASSANDRA_STRESS=stress_path,
-                                    cmd=cmd, temp_log=temp_log), shell=True)
+                                    cmd=cmd),
+                            stdout=subprocess.PIPE, bufsize=1, shell=True)
+    parser = StressOutputParser(stats, on_interval=on_interval)
+    # iter() with readline avoids the read-ahead buffering of file
+    # iteration, which would delay lines until the buffer fills:
+    for line in iter(proc.stdout.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        parser.feed(line)
+    proc.stdout.close()
     proc.wait()
-    log = open(temp_log)
-    collecting_aggregates = False
-    collecting_values = False
-    
-    # Regex for trunk cassandra-stress
-    start_of_intervals_re = re.compile('type.*total ops,.*op/s,.*pk/s')
-    for line in log:
-        line = line.strip()
-        if line.startswith("Results:"):
-            collecting_aggregates = True
-            continue
-        if not collecting_aggregates:
-            if start_of_intervals_re.match(line):
-                collecting_values = True
-                continue
-            if collecting_values:
-                line_parts = [l.strip() for l in line.split(',')]
-                # Only capture total metrics for now
-                if line_parts[0] == 'total':
-                    try:
-                        stats['intervals'].append([float(x) for x in line_parts[1:]])
-                    except:
-                        pass
-                continue
-            continue
-        if line.startswith("END") or line.strip() == "":
-            continue
-        # Collect aggregates:
-        try:
-            stat, value = line.split(":", 1)
-            stats[stat.strip().lower()] = value.strip()
-        except ValueError:
-            logger.info("Unable to parse aggregate line: '{}'".format(line))
-    log.close()
-    os.remove(temp_log)
     return stats
 
 
@@ -711,23 +718,106 @@ def stop_fincore_capture():
     """Stop linux-fincore monitoring"""
     execute(common.stop_fincore_capture)
 
-def log_add_data(file, data):
-    """Merge the dictionary data into the json log file root."""
+# Stats logs can be written as an append-only journal next to the
+# stats file, one JSON record per line following a header line. This
+# avoids rewriting the whole stats file after every operation:
+STATS_JOURNAL_SUFFIX = '.journal'
+STATS_JOURNAL_HEADER = {'journal': 'stats', 'version': 1}
+
+def get_stats_journal_path(file):
+    return file + STATS_JOURNAL_SUFFIX
+
+def _append_stats_journal(file, record, compact=False):
+    """Append a single record to the journal for the given stats file"""
+    journal = get_stats_journal_path(file)
+    default = intervals.encode_intervals if compact else intervals.encode_interval_rows
+    with open(journal, 'a') as f:
+        if f.tell() == 0:
+            f.write(json.dumps(STATS_JOURNAL_HEADER) + '\n')
+        f.write(json.dumps(record, sort_keys=True, separators=(',', ':'), default=default) + '\n')
+
+def compact_stats_journal(file, compact=False):
+    """Replay the journal for a stats file into the stats file itself
+
+    The result has the same layout log_stats() and log_add_data()
+    produce without a journal. The journal is removed afterwards.
+
+    compact - write stress intervals in the compact columnar format.
+    """
+    journal = get_stats_journal_path(file)
+    if not os.path.exists(journal):
+        return
+    if os.path.exists(file) and os.path.getsize(file) > 0:
+        with open(file) as f:
+            log = json.loads(f.read())
+    else:
+        log = {'title': 'Title goes here', 'stats':[]}
+
+    with open(journal) as f:
+        header = json.loads(f.readline())
+        if header.get('journal') != STATS_JOURNAL_HEADER['journal']:
+            raise ValueError('{journal} is not a stats journal'.format(journal=journal))
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last record can be truncated if we were killed mid-write:
+                logger.warn("Skipping unreadable stats journal record: '{}'".format(line[:100]))
+                continue
+            if 'stats' in record:
+                log['stats'].append(record['stats'])
+            elif 'data' in record:
+                log.update(record['data'])
+
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(intervals.dumps_stats(log, compact=compact))
+    os.rename(tmp_file, file)
+    os.remove(journal)
+
+@contextmanager
+def stats_journal(file, compact=False):
+    """Compact the journal for the given stats file when the block exits"""
+    try:
+        yield
+    finally:
+        compact_stats_journal(file, compact=compact)
+
+def log_add_data(file, data, compact=False, journal=False):
+    """Merge the dictionary data into the json log file root.
+
+    compact - write stress intervals in the compact columnar format.
+    journal - append to the stats journal instead of rewriting the file,
+              see compact_stats_journal()."""
+    if journal:
+        _append_stats_journal(file, {'data': data}, compact=compact)
+        return
     with open(file) as f:
         log = f.read()
         log = json.loads(log)
         log.update(data)
-        log = json.dumps(log, sort_keys=True, indent=4, separators=(', ', ': '))
+        log = intervals.dumps_stats(log, compact=compact)
     with open(file, 'w') as f:
         f.write(log)
 
 def log_set_title(file, title, subtitle=''):
     log_add_data(file, {'title': title, 'subtitle': subtitle})
 
-def log_stats(stats, memo=None, file='stats.json'):
-    """Log results"""
+def log_stats(stats, memo=None, file='stats.json', compact=False, journal=False):
+    """Log results
+
+    compact - write stress intervals in the compact columnar format.
+    journal - append to the stats journal instead of rewriting the file,
+              see compact_stats_journal()."""
     # TODO: this should go back into a cassandra store for long term
     # keeping
+    if memo:
+        stats.update({'memo': memo})
+
+    if journal:
+        _append_stats_journal(file, {'stats': stats}, compact=compact)
+        return
+
     if not os.path.exists(file) or os.path.getsize(file) == 0:
         with open(file, 'w') as f:
             f.write(json.dumps({'title': 'Title goes here', 'stats':[]}))
@@ -735,10 +825,8 @@ def log_stats(stats, memo=None, file='stats.json'):
     with open(file) as f:
         log = f.read()
         log = json.loads(log)
-        if memo:
-            stats.update({'memo': memo})
         log['stats'].append(stats)
-        log = json.dumps(log, sort_keys=True, indent=4, separators=(', ', ': '))
+        log = intervals.dumps_stats(log, compact=compact)
 
     with open(file, 'w') as f:
         f.write(log)
@@ -37,8 +37,14 @@ def main():
                         help='The version of Cassandra to install, specified by git refspec (eg \'apache/cassandra-2.1\') - uses the default C* config. Use JSON_CONFIG file instead to change this.', dest="version")
     parser.add_argument('config', metavar="JSON_CONFIG",
                         help='The revision config JSON file', nargs='?', default=sys.stdin)
+    parser.add_argument('--clear-config-options-cache', action='store_true',
+                        help='Clear the cached lists of Cassandra/DSE config options and exit', dest="clear_config_options_cache")
     args = parser.parse_args()
 
+    if args.clear_config_options_cache:
+        common.clear_config_options_cache()
+        return
+
     if (not sys.stdin.isatty() and args.version):
         parser.print_help()
         print("\nYou can only specify a config file or a --version")
@@ -3,12 +3,20 @@ import re
 import json
 import yaml
 import time
+import hashlib
 from fabric import api as fab
 
 name = 'cassandra'
 
 MAX_CACHED_BUILDS = 10
 
+# Build archives shared between nodes, see build_archive():
+BUILD_ARCHIVES_PATH = '~/fab/cassandra_build_archives'
+# Scratch checkout build_archive() builds in, apart from ~/fab/cassandra:
+BUILD_ROOT = '~/fab/cassandra_build'
+# The total size build archives may take up on each node, in MB:
+MAX_CACHED_BUILD_ARCHIVES_MB = 4096
+
 # Git repositories
 GIT_REPOS = [
     ('apache',        'git://github.com/apache/cassandra.git'),
@@ -83,12 +91,38 @@ def get_cassandra_config_options(config):
     return [o for o in opts if p.match(o)]
 
 
-def bootstrap(config, git_fetch=True, revision_override=None):
+def _build(config, revision, git_id, build_dir='~/fab/cassandra'):
+    """Build the revision in build_dir, ~/fab/cassandra by default"""
+    # Checkout revision/tag:
+    fab.run('mkdir -p %s' % build_dir)
+    fab.run('git --git-dir=$HOME/fab/cassandra.git archive %s |'
+            ' tar x -C %s' % (revision, build_dir))
+    fab.run('echo -e \'%s\\n%s\\n%s\' > %s/0.GIT_REVISION.txt' %
+            (revision, git_id, config.get('log',''), build_dir))
+
+    fab.run('JAVA_HOME={java_home} ~/fab/ant/bin/ant -f {build_dir}/build.xml realclean'.format(java_home=config['java_home'], build_dir=build_dir))
+    if config['override_version'] is not None:
+        fab.run('JAVA_TOOL_OPTIONS=-Dfile.encoding=UTF8 JAVA_HOME={java_home} ~/fab/ant/bin/ant -f {build_dir}/build.xml -Dversion={version}'.format(java_home=config['java_home'], version=config['override_version'], build_dir=build_dir))
+    else:
+        fab.run('JAVA_TOOL_OPTIONS=-Dfile.encoding=UTF8 JAVA_HOME={java_home} ~/fab/ant/bin/ant -f {build_dir}/build.xml'.format(java_home=config['java_home'], build_dir=build_dir))
+
+
+def bootstrap(config, git_fetch=True, revision_override=None, build_archive_name=None):
     """Install and configure Cassandra
+
+    build_archive_name - install this archive made by build_archive()
+                         instead of building the revision on the node.
+
     Returns the git id or the version checked out.
     """
     revision = revision_override or config['revision']
 
+    if build_archive_name is not None:
+        fab.run('rm -rf ~/fab/cassandra')
+        time.sleep(2)
+        install_build_archive(build_archive_name)
+        return get_build_archive_git_id(build_archive_name)
+
     if git_fetch:
         update_cassandra_git()
 
@@ -106,19 +140,7 @@ def bootstrap(config, git_fetch=True, revision_override=None):
         # Copy previously built Cassandra
         fab.run('cp -a ~/fab/cassandra_builds/{git_id} ~/fab/cassandra'.format(git_id=git_id))
     else:
-        # Build Cassandra
-        # Checkout revision/tag:
-        fab.run('mkdir -p ~/fab/cassandra')
-        fab.run('git --git-dir=$HOME/fab/cassandra.git archive %s |'
-                ' tar x -C ~/fab/cassandra' % revision)
-        fab.run('echo -e \'%s\\n%s\\n%s\' > ~/fab/cassandra/0.GIT_REVISION.txt' %
-                (revision, git_id, config.get('log','')))
-
-        fab.run('JAVA_HOME={java_home} ~/fab/ant/bin/ant -f ~/fab/cassandra/build.xml realclean'.format(java_home=config['java_home']))
-        if config['override_version'] is not None:
-            fab.run('JAVA_TOOL_OPTIONS=-Dfile.encoding=UTF8 JAVA_HOME={java_home} ~/fab/ant/bin/ant -f ~/fab/cassandra/build.xml -Dversion={version}'.format(java_home=config['java_home'], version=config['override_version']))
-        else:
-            fab.run('JAVA_TOOL_OPTIONS=-Dfile.encoding=UTF8 JAVA_HOME={java_home} ~/fab/ant/bin/ant -f ~/fab/cassandra/build.xml'.format(java_home=config['java_home']))
+        _build(config, revision, git_id)
 
         # Archive this build for future runs:
         fab.run('cp -a ~/fab/cassandra ~/fab/cassandra_builds/{git_id}'.format(git_id=git_id))
@@ -131,6 +153,92 @@ def bootstrap(config, git_fetch=True, revision_override=None):
 
     return git_id
 
+
+def get_build_archive_name(config, git_id):
+    """Get the name of the build archive for a git id and the current build options
+
+    Builds are content addressed: the name changes with anything that
+    changes the build output.
+    """
+    build_options = json.dumps({'git_id': git_id,
+                                'override_version': config['override_version'],
+                                'java_home': config['java_home']}, sort_keys=True)
+    return '{git_id}-{options_hash}.tar.gz'.format(
+        git_id=git_id, options_hash=hashlib.sha1(build_options).hexdigest()[:12])
+
+
+def get_build_archive_git_id(archive_name):
+    """Get the git id a build archive was built from"""
+    return archive_name.split('-', 1)[0]
+
+
+def build_archive(config, git_fetch=True, revision_override=None):
+    """Build a revision once, and archive it for other nodes to install
+
+    Intended to be run on a single node, normally the controlling node,
+    with install_build_archive() then run on every other node.
+
+    Returns the name of the archive in BUILD_ARCHIVES_PATH
+    """
+    revision = revision_override or config['revision']
+
+    if git_fetch:
+        update_cassandra_git()
+
+    git_id = fab.run('git --git-dir=$HOME/fab/cassandra.git rev-parse {revision}'.format(revision=revision)).strip()
+    archive_name = get_build_archive_name(config, git_id)
+    archive_path = os.path.join(BUILD_ARCHIVES_PATH, archive_name)
+    fab.run('mkdir -p {path}'.format(path=BUILD_ARCHIVES_PATH))
+    if fab.run('test -f {archive_path}'.format(archive_path=archive_path), quiet=True).return_code == 0:
+        # Mark the archive as recently used:
+        fab.run('touch {archive_path}'.format(archive_path=archive_path))
+        return archive_name
+
+    # Build in a scratch directory, as ~/fab/cassandra may be this
+    # node's own install of another revision:
+    fab.run('rm -rf {build_root}'.format(build_root=BUILD_ROOT))
+    _build(config, revision, git_id, build_dir=os.path.join(BUILD_ROOT, 'cassandra'))
+    fab.run('tar czf {archive_path}.tmp -C {build_root} cassandra && mv {archive_path}.tmp {archive_path}'.format(
+        archive_path=archive_path, build_root=BUILD_ROOT))
+    fab.run('rm -rf {build_root}'.format(build_root=BUILD_ROOT))
+    evict_build_archives(keep=archive_name)
+    return archive_name
+
+
+def install_build_archive(archive_name):
+    """Install a build archive into ~/fab/cassandra
+
+    If the node does not have the archive yet, it is uploaded from the
+    node this runs from, where build_archive() must have been run.
+    """
+    archive_path = os.path.join(BUILD_ARCHIVES_PATH, archive_name)
+    fab.run('mkdir -p {path}'.format(path=BUILD_ARCHIVES_PATH))
+    if fab.run('test -f {archive_path}'.format(archive_path=archive_path), quiet=True).return_code == 0:
+        fab.run('touch {archive_path}'.format(archive_path=archive_path))
+    else:
+        fab.put(os.path.expanduser(archive_path), archive_path + '.tmp')
+        fab.run('mv {archive_path}.tmp {archive_path}'.format(archive_path=archive_path))
+        evict_build_archives(keep=archive_name)
+    fab.run('tar xzf {archive_path} -C ~/fab'.format(archive_path=archive_path))
+
+
+def evict_build_archives(keep=None, max_size_mb=MAX_CACHED_BUILD_ARCHIVES_MB):
+    """Remove the least recently used build archives over max_size_mb
+
+    keep - an archive name never to remove
+    """
+    # Newest first, with their sizes in KB:
+    out = fab.run('cd {path} && ls -t1 | grep "\.tar\.gz$" | xargs -r du -k'.format(path=BUILD_ARCHIVES_PATH), quiet=True)
+    if out.return_code != 0:
+        return
+    total_size = 0
+    for line in out.splitlines():
+        size, archive_name = line.split(None, 1)
+        total_size += int(size)
+        if archive_name != keep and total_size > max_size_mb * 1024:
+            fab.run('rm -f {archive_path}'.format(archive_path=os.path.join(BUILD_ARCHIVES_PATH, archive_name)))
+
+
 @fab.parallel
 def update_cassandra_git():
     print 'Updating cassandra git'
@@ -22,10 +22,16 @@ import time
 import os
 import re
 import uuid
+import hashlib
+import json
+import pipes
+import fcntl
+import shutil
 import logging
 
 from fabric import api as fab
 from fabric.tasks import execute
+from fabric.state import connections
 import yaml
 import pkg_resources
 
@@ -36,6 +42,7 @@ import fab_dse as dse
 import fab_cassandra as cstar
 import fab_flamegraph as flamegraph
 import fab_profiler as profiler
+import log_archive
 
 logging.basicConfig()
 logger = logging.getLogger('common')
@@ -43,6 +50,12 @@ logger.setLevel(logging.INFO)
 
 fab.env.use_ssh_config = True
 fab.env.connection_attempts = 10
+# Keep cached connections alive through long running operations, so
+# they get reused rather than dropped and re-established:
+fab.env.keepalive = 30
+
+# Config option lists parsed from the Config classes, by product and revision:
+CONFIG_OPTIONS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cstar_perf", "config_options_cache")
 
 # Git repositories
 git_repos = [
@@ -328,10 +341,61 @@ setup()
 # for the configured cluster:
 setup(cluster_config)
 
+def get_cached_config_options(product, rev_id, config_name, get_config_options):
+    """Get the config options of a product revision, parsing them only if they aren't cached
+
+    The cache is kept on the controlling node and shared by all the
+    hosts being bootstrapped, so the options are parsed on one host only.
+
+    product - the product module
+    rev_id - the git id (cassandra) or version (dse) the host was bootstrapped with
+    config_name - which Config class the options come from, 'cassandra' or 'dse'
+    get_config_options - the product function parsing the options on the host
+    """
+    if product.name == 'dse' and (rev_id.startswith('bdp/') or config.get('use_existing_tarball')):
+        # DSE branch builds and supplied tarballs may change under the same name:
+        return get_config_options(config)
+
+    cache_key = json.dumps([product.name, rev_id, config_name])
+    cache_file = os.path.join(CONFIG_OPTIONS_CACHE_DIR, '{}.json'.format(hashlib.sha1(cache_key).hexdigest()))
+    if not os.path.exists(CONFIG_OPTIONS_CACHE_DIR):
+        try:
+            os.makedirs(CONFIG_OPTIONS_CACHE_DIR)
+        except OSError:
+            # Created by another host's bootstrap in the meantime
+            pass
+
+    # Hosts are bootstrapped in parallel, hold a lock so only the
+    # first one parses the options while the others wait for it:
+    with open(cache_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(cache_file):
+                with open(cache_file) as f:
+                    return json.load(f)['options']
+            options = get_config_options(config)
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'product': product.name, 'revision': rev_id, 'config': config_name, 'options': options}, f)
+            os.rename(cache_file + '.tmp', cache_file)
+            return options
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def clear_config_options_cache():
+    """Remove all cached config option lists, so they are parsed again on the next bootstrap"""
+    if os.path.exists(CONFIG_OPTIONS_CACHE_DIR):
+        shutil.rmtree(CONFIG_OPTIONS_CACHE_DIR)
+        logger.info("Removed config options cache {}".format(CONFIG_OPTIONS_CACHE_DIR))
+
+
 @fab.parallel
-def bootstrap(git_fetch=True, revision_override=None, replace_existing_dse_install=True):
+def bootstrap(git_fetch=True, revision_override=None, replace_existing_dse_install=True, build_archive_name=None):
     """Install and configure the specified product on each host
 
+    build_archive_name - for cassandra, install this prebuilt archive
+                         instead of building on each host (see fab_cassandra.build_archive)
+
     Returns the git id for the version checked out.
     """
     partitioner = config['partitioner']
@@ -349,7 +413,8 @@ def bootstrap(git_fetch=True, revision_override=None, replace_existing_dse_insta
     if product.name == 'dse':
         rev_id = dse.bootstrap(config, replace_existing_dse_install=replace_existing_dse_install)
     else:
-        rev_id = cstar.bootstrap(config, git_fetch=git_fetch, revision_override=revision_override)
+        rev_id = cstar.bootstrap(config, git_fetch=git_fetch, revision_override=revision_override,
+                                 build_archive_name=build_archive_name)
 
     cassandra_path = product.get_cassandra_path()
 
@@ -392,7 +457,7 @@ def bootstrap(git_fetch=True, revision_override=None, replace_existing_dse_insta
     cass_yaml = yaml.load(conf_file.read())
 
     # Get the canonical list of options from the c* source code:
-    cstar_config_opts = product.get_cassandra_config_options(config)
+    cstar_config_opts = get_cached_config_options(product, rev_id, 'cassandra', product.get_cassandra_config_options)
     # CASSANDRA-11217 brought in a 'log' method and locals() contains 'log' which taints our cassandra.yaml. Delete it.
     try:
         cstar_config_opts.remove('log')
@@ -400,7 +465,7 @@ def bootstrap(git_fetch=True, revision_override=None, replace_existing_dse_insta
         pass
 
     if product.name == 'dse':
-        dse_config_options = product.get_dse_config_options(config)
+        dse_config_options = get_cached_config_options(product, rev_id, 'dse', product.get_dse_config_options)
         dse_conf_file = StringIO()
         dse_yaml_path = os.path.join(product.get_dse_conf_path(), 'dse.yaml')
         fab.get(dse_yaml_path.replace('$HOME', '~'), dse_conf_file)
@@ -628,6 +693,23 @@ def multi_nodetool(cmd):
     """run node tool command on all nodes in parallel"""
     return fab.run('JAVA_HOME={java_home} {nodetool_cmd} {cmd}'.format(java_home=config['java_home'], nodetool_cmd=_nodetool_cmd(), cmd=cmd), warn_only=True)
 
+@fab.parallel
+def wait_for_compaction_idle(poll_interval, stability_window, allowed_connection_errors):
+    """Wait for compactions to be idle on the node.
+
+    The polling runs on the node itself, so there is one ssh session
+    per node for the whole wait rather than one per check.
+
+    Returns the JSON result line printed by scripts/compaction.py
+    """
+    output = run_python_script(
+        'compaction',
+        'wait_for_idle',
+        '"{nodetool_cmd}", "{java_home}", {poll_interval}, {stability_window}, {allowed_connection_errors}'.format(
+            nodetool_cmd=_nodetool_cmd(), java_home=config['java_home'], poll_interval=poll_interval,
+            stability_window=stability_window, allowed_connection_errors=allowed_connection_errors))
+    return output[-1]
+
 def ensure_running(retries=15, wait=10):
     """Ensure cassandra is running on all nodes.
     Runs 'nodetool ring' on a single node continuously until it
@@ -726,6 +808,48 @@ def copy_logs(local_directory):
         # copy the node's system.log
         fab.get(os.path.join(config['log_dir'], '*'), host_log_dir)
 
+@fab.parallel
+def stream_logs_to_archive(archive_path, prefix, max_file_size=None, include=None, exclude=None):
+    """Stream the node's startup log and log_dir into a part archive of a log archive
+
+    The logs are tarred and compressed on the node and appended to the
+    part archive <archive_path>.<hostname> as they arrive, under
+    prefix/<hostname>. Every node writes its own part, so they can be
+    streamed in parallel, to be appended to the archive with
+    log_archive.append_log_archive.
+
+    See log_archive.append_tar_stream for the other parameters.
+
+    Returns the path of the part archive, or None if streaming failed
+    """
+    cfg = config['hosts'][fab.env.host]
+    part_path = '{archive_path}.{hostname}'.format(archive_path=archive_path, hostname=cfg['hostname'])
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    # The startup log goes first, as log_dir may not exist if
+    # Cassandra failed to start:
+    cmd = 'tar czf - --ignore-failed-read -C {startup_log_dir} {startup_log} -C {log_dir} .'.format(
+        startup_log_dir=os.path.dirname(CASSANDRA_STARTUP_LOG),
+        startup_log=os.path.basename(CASSANDRA_STARTUP_LOG),
+        log_dir=config['log_dir'])
+    stdin, stdout, stderr = connections[fab.env.host_string].exec_command(cmd)
+    stdin.close()
+    try:
+        num_files = log_archive.append_tar_stream(
+            part_path, stdout, os.path.join(prefix, cfg['hostname']),
+            max_file_size=max_file_size, include=include, exclude=exclude)
+    except Exception, e:
+        # A member may have been cut short, which would corrupt the
+        # members appended after it:
+        logger.warn("Failed to stream logs from {host}: {e}".format(host=fab.env.host, e=e))
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
+    if stdout.channel.recv_exit_status() != 0:
+        logger.warn("tar of logs on {host} failed: {err}".format(host=fab.env.host, err=stderr.read()))
+    logger.info("Streamed {num_files} log files from {host}".format(num_files=num_files, host=fab.env.host))
+    return part_path
+
 @fab.parallel
 def start_fincore_capture(interval=10):
     """Start fincore_capture utility on each node"""
@@ -843,13 +967,30 @@ def parse_output(output):
     return results
 
 
+def put_script(script, extension):
+    """Upload a script to ~/fab/scripts on the host, unless an identical one is already there
+
+    Scripts are named by the hash of their contents, so each distinct
+    script is uploaded at most once per host.
+
+    Returns the remote path of the script
+    """
+    script_path = '~/fab/scripts/{sha}.{extension}'.format(
+        sha=hashlib.sha1(script).hexdigest(), extension=extension)
+    # Check for the script and make its directory in a single round trip:
+    if fab.run('test -f {script_path} && echo cached || mkdir -p ~/fab/scripts'.format(
+            script_path=script_path), quiet=True).strip() != 'cached':
+        # Upload under a temporary name, so an interrupted upload is never mistaken for a cached script:
+        tmp_path = '{script_path}.{uuid}'.format(script_path=script_path, uuid=uuid.uuid1())
+        fab.put(StringIO(script), tmp_path)
+        fab.run('mv {tmp_path} {script_path}'.format(tmp_path=tmp_path, script_path=script_path))
+    return script_path
+
+
 @fab.parallel
 def bash(script):
     """Run a bash script on the host"""
-    script = StringIO(script)
-    fab.run('mkdir -p ~/fab/scripts')
-    script_path = '~/fab/scripts/{script_name}.sh'.format(script_name=uuid.uuid1())
-    fab.put(script, script_path)
+    script_path = put_script(script, 'sh')
     output = StringIO()
     fab.run('bash {script_path}'.format(script_path=script_path), stdout=output, stderr=output)
     output.seek(0)
@@ -866,16 +1007,13 @@ def runbg(cmd, envs, sockname="dtach"):
 
 
 @fab.parallel
-def python(script):
-    """Run a python script on the host"""
-    script = StringIO(script)
-    fab.run('mkdir -p ~/fab/scripts')
-    script_path = '~/fab/scripts/{script_name}.py'.format(script_name=uuid.uuid1())
-    fab.put(script, script_path)
+def python(script, args=''):
+    """Run a python script on the host, with the given (shell quoted) arguments"""
+    script_path = put_script(script, 'py')
     output = StringIO()
     with fab.settings(warn_only=True):
         retval = fab.run(
-            'python {script_path}'.format(script_path=script_path),
+            'python {script_path} {args}'.format(script_path=script_path, args=args),
             stdout=output, stderr=output
         )
         output.seek(0)
@@ -899,5 +1037,6 @@ def run_python_script(script_name, function_name, parameters):
     resource_package = __name__
     resource_path = os.path.join('scripts', '{}.py'.format(script_name))
     script = pkg_resources.resource_string(resource_package, resource_path)
-    script = script.replace('{function}', function_name).replace('{parameters}', parameters)
-    return python(script)
+    # The function and parameters are passed on the command line, so the
+    # script itself is the same for every call, and only uploaded once:
+    return python(script, '{} {}'.format(pipes.quote(function_name), pipes.quote(parameters)))
@@ -0,0 +1,132 @@
+"""
+Compact storage of cassandra-stress interval data.
+
+Stress intervals are normally kept as a list of rows, one list of
+floats per reporting interval. A long stress run produces tens of
+thousands of these small lists. ColumnarIntervals stores the same data
+as one array('d') per metric instead, and is serialized as column
+oriented JSON:
+
+    {"format": "columnar", "columns": [[...], [...], ...]}
+
+load_stats() reads stats files written in either format.
+"""
+
+from array import array
+import json
+
+COLUMNAR_FORMAT = 'columnar'
+
+
+class ColumnarIntervals(object):
+    """Stress interval rows stored as one typed array per metric
+
+    Supports the parts of the list interface used on intervals:
+    append(), len(), iteration and indexing, which return rows as
+    lists of floats.
+    """
+
+    def __init__(self, rows=(), columns=None):
+        self.columns = [array('d', c) for c in columns] if columns else []
+        for row in rows:
+            self.append(row)
+
+    def append(self, row):
+        if not self.columns:
+            self.columns = [array('d') for _ in row]
+        elif len(row) != len(self.columns):
+            raise ValueError('Expected an interval of {expected} values, got {got}'.format(
+                expected=len(self.columns), got=len(row)))
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+    def column(self, index):
+        """Get all the values of a single metric"""
+        return self.columns[index]
+
+    def tolist(self):
+        """Convert to the list of rows format"""
+        return [list(row) for row in zip(*self.columns)]
+
+    def to_json(self):
+        """Convert to the column oriented JSON format"""
+        return {'format': COLUMNAR_FORMAT,
+                'columns': [c.tolist() for c in self.columns]}
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        for row in zip(*self.columns):
+            yield list(row)
+
+    def __getitem__(self, index):
+        return [c[index] for c in self.columns]
+
+    def __eq__(self, other):
+        if isinstance(other, ColumnarIntervals):
+            return self.columns == other.columns
+        return self.tolist() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def is_columnar(data):
+    return isinstance(data, dict) and data.get('format') == COLUMNAR_FORMAT
+
+
+def encode_intervals(obj):
+    """json.dumps default hook writing intervals in the columnar format"""
+    if isinstance(obj, ColumnarIntervals):
+        return obj.to_json()
+    raise TypeError('{obj!r} is not JSON serializable'.format(obj=obj))
+
+
+def encode_interval_rows(obj):
+    """json.dumps default hook writing intervals in the list of rows format"""
+    if isinstance(obj, ColumnarIntervals):
+        return obj.tolist()
+    raise TypeError('{obj!r} is not JSON serializable'.format(obj=obj))
+
+
+def decode_intervals(data, columnar=False):
+    """Decode intervals stored in either format
+
+    data - a list of rows, or a columnar JSON object
+    columnar - if True, return ColumnarIntervals, otherwise a list of rows
+    """
+    if is_columnar(data):
+        intervals = ColumnarIntervals(columns=data['columns'])
+        return intervals if columnar else intervals.tolist()
+    return ColumnarIntervals(rows=data) if columnar else data
+
+
+def dumps_stats(log, compact=False):
+    """Serialize a stats log
+
+    compact - if True, write intervals column oriented without
+              indentation. Otherwise, use the list of rows format.
+    """
+    if compact:
+        return json.dumps(log, sort_keys=True, separators=(',', ':'), default=encode_intervals)
+    return json.dumps(log, sort_keys=True, indent=4, separators=(', ', ': '), default=encode_interval_rows)
+
+
+def loads_stats(data, columnar=False):
+    """Deserialize a stats log written in either format
+
+    columnar - if True, intervals are returned as ColumnarIntervals,
+               otherwise as lists of rows.
+    """
+    log = json.loads(data)
+    for stat in log.get('stats', []):
+        if 'intervals' in stat:
+            stat['intervals'] = decode_intervals(stat['intervals'], columnar=columnar)
+    return log
+
+
+def load_stats(path, columnar=False):
+    """Read a stats log file written in either format"""
+    with open(path) as f:
+        return loads_stats(f.read(), columnar=columnar)
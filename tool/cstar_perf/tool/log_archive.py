@@ -0,0 +1,130 @@
+"""
+Append-only log archives.
+
+A gzip file may be made of several concatenated gzip members, and a tar
+file is a sequence of member blocks closed by two zero blocks. So a
+.tar.gz can be grown by writing another gzip member holding more tar
+members, without decompressing or rewriting what is already in it.
+
+Node logs are streamed in parallel into a part archive per node, which
+are then appended to the job's single log archive with
+append_log_archive(), one directory per revision. finish_log_archive()
+writes the closing zero blocks, though tar can read the archive without
+them too.
+"""
+
+import fnmatch
+import gzip
+import os
+import shutil
+import tarfile
+from contextlib import contextmanager
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def _matches(name, patterns):
+    """Check if a file path or its base name matches any of the glob patterns"""
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(os.path.basename(name), p)
+               for p in patterns)
+
+
+def _skip(f, size):
+    while size > 0:
+        data = f.read(min(size, COPY_BUFFER_SIZE))
+        if not data:
+            break
+        size -= len(data)
+
+
+def _copy(src, dst, size):
+    while size > 0:
+        data = src.read(min(size, COPY_BUFFER_SIZE))
+        if not data:
+            raise IOError('Tar stream ended {size} bytes before the end of a member'.format(size=size))
+        dst.write(data)
+        size -= len(data)
+
+
+def append_tar_stream(archive_path, stream, prefix, max_file_size=None, include=None, exclude=None):
+    """Append the files of a tar stream to a log archive
+
+    The stream is read sequentially, so it can be the output of a
+    remote tar command.
+
+    archive_path - the .tar.gz log archive, created if it doesn't exist
+    stream - a file object reading a tar stream, compressed or not
+    prefix - the directory in the archive to put the files under
+    max_file_size - keep only the last max_file_size bytes of larger files
+    include - if set, only files matching one of these glob patterns are kept
+    exclude - files matching any of these glob patterns are left out
+
+    returns the number of files appended
+    """
+    source = tarfile.open(fileobj=stream, mode='r|*')
+    archive = gzip.open(archive_path, 'ab')
+    appended = 0
+    try:
+        for member in source:
+            if not member.isfile():
+                continue
+            name = os.path.normpath(member.name).lstrip('/')
+            if include and not _matches(name, include):
+                continue
+            if exclude and _matches(name, exclude):
+                continue
+
+            f = source.extractfile(member)
+            size = member.size
+            if max_file_size is not None and size > max_file_size:
+                # Keep the end of the file, which is where errors show up:
+                _skip(f, size - max_file_size)
+                size = max_file_size
+
+            info = tarfile.TarInfo(os.path.join(prefix, name))
+            info.size = size
+            info.mtime = member.mtime
+            info.mode = member.mode
+            archive.write(info.tobuf(tarfile.GNU_FORMAT))
+            _copy(f, archive, size)
+            remainder = size % tarfile.BLOCKSIZE
+            if remainder:
+                archive.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            appended += 1
+    finally:
+        archive.close()
+        source.close()
+    return appended
+
+
+def append_log_archive(archive_path, part_path):
+    """Append the members of a part archive to a log archive, and remove the part
+
+    The part must not have an end of archive marker, see append_tar_stream.
+    """
+    if not os.path.exists(part_path):
+        return
+    with open(archive_path, 'ab') as archive:
+        with open(part_path, 'rb') as part:
+            shutil.copyfileobj(part, archive, COPY_BUFFER_SIZE)
+    os.remove(part_path)
+
+
+def finish_log_archive(archive_path):
+    """Write the end of archive marker, once nothing more will be appended"""
+    if not os.path.exists(archive_path):
+        return
+    archive = gzip.open(archive_path, 'ab')
+    try:
+        archive.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    finally:
+        archive.close()
+
+
+@contextmanager
+def finishing_log_archive(archive_path):
+    """Finish the log archive on the way out, even if appending to it failed"""
+    try:
+        yield archive_path
+    finally:
+        finish_log_archive(archive_path)
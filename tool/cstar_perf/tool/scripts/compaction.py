@@ -0,0 +1,83 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+PENDING_TASKS_IDLE_PATTERN = re.compile("(^|\n)pending tasks: 0")
+TPSTATS_EXISTS_PATTERN = re.compile("^CompactionExecutor", re.MULTILINE)
+TPSTATS_IDLE_PATTERN = re.compile("CompactionExecutor\W*0\W*0\W*[0-9]*\W*0", re.MULTILINE)
+CONNECTION_FAILURE_PATTERN = re.compile("ConnectException")
+
+
+def nodetool(nodetool_cmd, java_home, cmd):
+    """Run a nodetool command, returning its combined output"""
+    env = dict(os.environ, JAVA_HOME=java_home)
+    proc = subprocess.Popen([nodetool_cmd, cmd], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return proc.communicate()[0]
+
+
+def is_idle(nodetool_cmd, java_home):
+    """Check if compactions are idle on this node
+
+    Returns True or False, or None if nodetool could not connect.
+    """
+    output = nodetool(nodetool_cmd, java_home, 'compactionstats').strip()
+    if CONNECTION_FAILURE_PATTERN.search(output):
+        return None
+    if not PENDING_TASKS_IDLE_PATTERN.search(output):
+        return False
+
+    output = nodetool(nodetool_cmd, java_home, 'tpstats')
+    if TPSTATS_EXISTS_PATTERN.search(output):
+        return TPSTATS_IDLE_PATTERN.search(output) is not None
+    if CONNECTION_FAILURE_PATTERN.search(output):
+        return None
+    # CompactionExecutor is not listed, so compactionstats is all we can go by:
+    return True
+
+
+def wait_for_idle(nodetool_cmd, java_home, poll_interval, stability_window, allowed_connection_errors):
+    """Poll nodetool until compactions have been idle for stability_window seconds
+
+    Returns a JSON object on a single line containing:
+      duration - the time until compactions were first seen idle, at the start of the stability window
+      checks - the number of checks made
+      error - set if nodetool failed to connect too many times in a row
+    """
+    start = time.time()
+    idle_since = None
+    consecutive_connection_errors = 0
+    checks = 0
+    while True:
+        idle = is_idle(nodetool_cmd, java_home)
+        now = time.time()
+        checks += 1
+        if idle is None:
+            consecutive_connection_errors += 1
+            if consecutive_connection_errors > allowed_connection_errors:
+                return json.dumps({'duration': now - start, 'checks': checks,
+                                   'error': 'Failed to connect via nodetool {n} times in a row.'.format(
+                                       n=consecutive_connection_errors)})
+        else:
+            consecutive_connection_errors = 0
+            if not idle:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = now
+            if idle_since is not None and now - idle_since >= stability_window:
+                return json.dumps({'duration': idle_since - start, 'checks': checks})
+        time.sleep(poll_interval)
+
+
+def main():
+    """Call function with its parameters, given on the command line"""
+
+    function, parameters = sys.argv[1:3]
+    print eval('{function}({parameters})'.format(function=function, parameters=parameters))
+
+
+if __name__ == "__main__":
+    main()
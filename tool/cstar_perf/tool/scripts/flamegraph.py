@@ -1,5 +1,6 @@
 import os
 import sh
+import sys
 
 
 def setup(flamegraph_directory, flamegraph_path, perf_map_agent_path, java_home):
@@ -35,9 +36,10 @@ def ensure_stopped_perf_agent():
 
 
 def main():
-    """Call function with its parameters"""
+    """Call function with its parameters, given on the command line"""
 
-    print {function}({parameters})
+    function, parameters = sys.argv[1:3]
+    print eval('{function}({parameters})'.format(function=function, parameters=parameters))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import os
 import sh
+import sys
 
 
 def find_process_pid(process_line, child_process=False):
@@ -39,9 +40,10 @@ def clean_directory(directory):
 
 
 def main():
-    """Call function with its parameters"""
+    """Call function with its parameters, given on the command line"""
 
-    print {function}({parameters})
+    function, parameters = sys.argv[1:3]
+    print eval('{function}({parameters})'.format(function=function, parameters=parameters))
 
 
 if __name__ == "__main__":
@@ -2,8 +2,9 @@ from benchmark import (bootstrap, stress, nodetool, nodetool_multi, cqlsh, bash,
                        log_stats, log_set_title, log_add_data, retrieve_logs, restart,
                        start_fincore_capture, stop_fincore_capture, retrieve_fincore_logs,
                        drop_page_cache, wait_for_compaction, setup_stress, clean_stress,
-                       get_localhost, retrieve_flamegraph, retrieve_yourkit, dsetool_cmd, dse_cmd, CSTAR_PERF_LOGS_DIR)
-from benchmark import config as fab_config, cstar, dse, set_cqlsh_path, set_nodetool_path, spark_cassandra_stress, retrieve_logs_and_create_tarball
+                       get_localhost, retrieve_flamegraph, retrieve_yourkit, dsetool_cmd, dse_cmd, CSTAR_PERF_LOGS_DIR,
+                       stats_journal, get_log_archive_path, retrieve_logs_to_archive)
+from benchmark import config as fab_config, cstar, dse, set_cqlsh_path, set_nodetool_path, spark_cassandra_stress
 import fab_common as common
 import fab_cassandra as cstar
 import fab_flamegraph as flamegraph
@@ -11,6 +12,8 @@ import fab_profiler as profiler
 from fabric.tasks import execute
 from command import Ctool
 from util import get_bool_if_method_and_config_values_do_not_conflict
+from intervals import ColumnarIntervals
+from log_archive import finishing_log_archive
 import os
 import sys
 import datetime
@@ -135,7 +138,11 @@ def stress_compare(revisions,
                    keep_page_cache=False,
                    git_fetch_before_test=True,
                    bootstrap_before_test=True,
-                   teardown_after_test=True
+                   teardown_after_test=True,
+                   compact_intervals=False,
+                   log_max_file_size=None,
+                   log_include=None,
+                   log_exclude=None
                ):
     """
     Run Stress on multiple C* branches and compare them.
@@ -167,6 +174,12 @@ def stress_compare(revisions,
     git_fetch_before_test (bool): If True, will update the cassandra.git with fab_common.git_repos
     bootstrap_before_test (bool): If True, will bootstrap DSE / C* before running the operations
     teardown_after_test (bool): If True, will shutdown DSE / C* after all of the operations
+    compact_intervals (bool): If True, keep stress intervals as typed columns in memory and
+        write them to the log in the compact columnar format (see intervals.py)
+    log_max_file_size - Keep only the last log_max_file_size bytes of each node log file
+        collected into the job's log archive.
+    log_include - List of glob patterns, if set only node log files matching one are collected.
+    log_exclude - List of glob patterns of node log files not to collect.
     """
     validate_revisions_list(revisions)
     validate_operations_list(operations)
@@ -191,13 +204,28 @@ def stress_compare(revisions,
                                                                                  pristine_config,
                                                                                  method_name='stress_compare')
 
+    compact_intervals = get_bool_if_method_and_config_values_do_not_conflict('compact_intervals',
+                                                                             compact_intervals,
+                                                                             pristine_config,
+                                                                             method_name='stress_compare')
+
     stress_shas = maybe_update_cassandra_git_and_setup_stress(operations, git_fetch=git_fetch_before_test)
 
     # Flamegraph Setup
     if flamegraph.is_enabled():
         execute(flamegraph.setup)
 
-    with GracefulTerminationHandler() as handler:
+    # Node logs of each revision are streamed into a single log archive
+    # for the whole job:
+    log_archive = get_log_archive_path(log)
+    if os.path.exists(log_archive):
+        os.remove(log_archive)
+
+    # Stats are appended to a journal as operations finish, and
+    # compacted into the log file once all revisions are done. The log
+    # archive is finished even if a revision fails:
+    with GracefulTerminationHandler() as handler, stats_journal(log, compact=compact_intervals), \
+            finishing_log_archive(log_archive):
         for rev_num, revision_config in enumerate(revisions):
             config = copy.copy(pristine_config)
             config.update(revision_config)
@@ -252,157 +280,160 @@ def stress_compare(revisions,
                 start_fincore_capture(interval=10)
 
             last_stress_operation_id = 'None'
-            for operation_i, operation in enumerate(operations, 1):
-                try:
-                    start = datetime.datetime.now()
-                    stats = {
-                        "id": str(uuid.uuid1()),
-                        "type": operation['type'],
-                        "revision": revision,
-                        "git_id": git_id,
-                        "start_date": start.isoformat(),
-                        "label": revision_config.get('label', revision_config['revision']),
-                        "test": '{operation_i}_{operation}'.format(
-                            operation_i=operation_i,
-                            operation=operation['type'])
-                    }
-
-                    if operation['type'] == 'stress':
-                        last_stress_operation_id = stats['id']
-                        # Default to all the nodes of the cluster if no
-                        # nodes were specified in the command:
-                        if operation.has_key('nodes'):
-                            cmd = "{command} -node {hosts}".format(
-                                command=operation['command'],
-                                hosts=",".join(operation['nodes']))
-                        elif '-node' in operation['command']:
-                            cmd = operation['command']
-                        else:
-                            cmd = "{command} -node {hosts}".format(
-                                command=operation['command'],
-                                hosts=",".join([n for n in fab_config['hosts']]))
-                        stats['command'] = cmd
-                        stats['intervals'] = []
-                        stats['test'] = '{operation_i}_{operation}'.format(
-                            operation_i=operation_i, operation=cmd.strip().split(' ')[0]).replace(" ", "_")
-                        logger.info('Running stress operation : {cmd}  ...'.format(cmd=cmd))
-                        # Run stress:
-                        # (stress takes the stats as a parameter, and adds
-                        #  more as it runs):
-                        stress_sha = stress_shas[operation.get('stress_revision', 'default')]
-                        stats = stress(cmd, revision, stress_sha, stats=stats)
-                        # Wait for all compactions to finish (unless disabled):
-                        if operation.get('wait_for_compaction', True):
-                            compaction_throughput = revision_config.get("compaction_throughput_mb_per_sec", 16)
-                            wait_for_compaction(compaction_throughput=compaction_throughput)
-
-                    elif operation['type'] == 'nodetool':
-                        if 'nodes' not in operation:
-                            operation['nodes'] = 'all'
-                        if operation['nodes'] in ['all','ALL']:
-                            nodes = [n for n in fab_config['hosts']]
-                        else:
-                            nodes = operation['nodes']
-
-                        set_nodetool_path(os.path.join(product.get_bin_path(), 'nodetool'))
-                        logger.info("Running nodetool on {nodes} with command: {command}".format(nodes=operation['nodes'], command=operation['command']))
-                        stats['command'] = operation['command']
-                        output = nodetool_multi(nodes, operation['command'])
-                        stats['output'] = output
-                        logger.info("Nodetool command finished on all nodes")
-
-                    elif operation['type'] == 'cqlsh':
-                        logger.info("Running cqlsh commands on {node}".format(node=operation['node']))
-                        set_cqlsh_path(os.path.join(product.get_bin_path(), 'cqlsh'))
-                        output = cqlsh(operation['script'], operation['node'])
-                        stats['output'] = output.split("\n")
-                        stats['command'] = operation['script']
-                        logger.info("Cqlsh commands finished")
-
-                    elif operation['type'] == 'bash':
-                        nodes = operation.get('nodes', [n for n in fab_config['hosts']])
-                        logger.info("Running bash commands on: {nodes}".format(nodes=nodes))
-                        stats['output'] = bash(operation['script'], nodes)
-                        stats['command'] = operation['script']
-                        logger.info("Bash commands finished")
-
-                    elif operation['type'] == 'spark_cassandra_stress':
-                        nodes = operation.get('nodes', [n for n in fab_config['hosts']])
-                        stress_node = config.get('stress_node', None)
-                        # Note: once we have https://datastax.jira.com/browse/CSTAR-617, we should fix this to use
-                        # client-tool when DSE_VERSION >= 4.8.0
-                        # https://datastax.jira.com/browse/DSP-6025: dse client-tool
-                        master_regex = re.compile(r"(.|\n)*(?P<master>spark:\/\/\d+.\d+.\d+.\d+:\d+)(.|\n)*")
-                        master_out = dsetool_cmd(nodes[0], options='sparkmaster')[nodes[0]]
-                        master_match = master_regex.match(master_out)
-                        if not master_match:
-                            raise ValueError('Could not find master address from "dsetool sparkmaster" cmd\n'
-                                             'Found output: {f}'.format(f=master_out))
-                        master_string = master_match.group('master')
-                        build_spark_cassandra_stress = bool(distutils.util.strtobool(
-                            str(operation.get('build_spark_cassandra_stress', 'True'))))
-                        remove_existing_spark_data = bool(distutils.util.strtobool(
-                            str(operation.get('remove_existing_spark_data', 'True'))))
-                        logger.info("Running spark_cassandra_stress on {stress_node} "
-                                    "using spark.cassandra.connection.host={node} and "
-                                    "spark-master {master}".format(stress_node=stress_node,
-                                                                   node=nodes[0],
-                                                                   master=master_string))
-                        output = spark_cassandra_stress(operation['script'], nodes, stress_node=stress_node,
-                                                        master=master_string,
-                                                        build_spark_cassandra_stress=build_spark_cassandra_stress,
-                                                        remove_existing_spark_data=remove_existing_spark_data)
-                        stats['output'] = output.get('output', 'No output captured')
-                        stats['spark_cass_stress_time_in_seconds'] = output.get('stats', {}).get('TimeInSeconds', 'No time captured')
-                        stats['spark_cass_stress_ops_per_second'] = output.get('stats', {}).get('OpsPerSecond', 'No ops/s captured')
-                        logger.info("spark_cassandra_stress finished")
-
-                    elif operation['type'] == 'ctool':
-                        logger.info("Running ctool with parameters: {command}".format(command=operation['command']))
-                        ctool = Ctool(operation['command'], common.config)
-                        output = execute(ctool.run)
-                        stats['output'] = output
-                        logger.info("ctool finished")
-
-                    elif operation['type'] == 'dsetool':
-                        if 'nodes' not in operation:
-                            operation['nodes'] = 'all'
-                        if operation['nodes'] in ['all','ALL']:
-                            nodes = [n for n in fab_config['hosts']]
-                        else:
-                            nodes = operation['nodes']
-
-                        dsetool_options = operation['script']
-                        logger.info("Running dsetool {command} on {nodes}".format(nodes=operation['nodes'], command=dsetool_options))
-                        stats['command'] = dsetool_options
-                        output = dsetool_cmd(nodes=nodes, options=dsetool_options)
-                        stats['output'] = output
-                        logger.info("dsetool command finished on all nodes")
-
-                    elif operation['type'] == 'dse':
-                        logger.info("Running dse command on {node}".format(node=operation['node']))
-                        output = dse_cmd(node=operation['node'], options=operation['script'])
-                        stats['output'] = output.split("\n")
-                        stats['command'] = operation['script']
-                        logger.info("dse commands finished")
-
-                    end = datetime.datetime.now()
-                    stats['end_date'] = end.isoformat()
-                    stats['op_duration'] = str(end - start)
-                    log_stats(stats, file=log)
-                finally:
-                    # Copy node logs:
-                    retrieve_logs_and_create_tarball(job_id=stats['id'])
-                    revision_config['last_log'] = stats['id']
-
-                if capture_fincore:
-                    stop_fincore_capture()
-                    log_dir = os.path.join(CSTAR_PERF_LOGS_DIR, stats['id'])
-                    retrieve_fincore_logs(log_dir)
-                    # Restart fincore capture if this is not the last
-                    # operation:
-                    if operation_i < len(operations):
-                        start_fincore_capture(interval=10)
+            try:
+                for operation_i, operation in enumerate(operations, 1):
+                    try:
+                        start = datetime.datetime.now()
+                        stats = {
+                            "id": str(uuid.uuid1()),
+                            "type": operation['type'],
+                            "revision": revision,
+                            "git_id": git_id,
+                            "start_date": start.isoformat(),
+                            "label": revision_config.get('label', revision_config['revision']),
+                            "test": '{operation_i}_{operation}'.format(
+                                operation_i=operation_i,
+                                operation=operation['type'])
+                        }
+
+                        if operation['type'] == 'stress':
+                            last_stress_operation_id = stats['id']
+                            # Default to all the nodes of the cluster if no
+                            # nodes were specified in the command:
+                            if operation.has_key('nodes'):
+                                cmd = "{command} -node {hosts}".format(
+                                    command=operation['command'],
+                                    hosts=",".join(operation['nodes']))
+                            elif '-node' in operation['command']:
+                                cmd = operation['command']
+                            else:
+                                cmd = "{command} -node {hosts}".format(
+                                    command=operation['command'],
+                                    hosts=",".join([n for n in fab_config['hosts']]))
+                            stats['command'] = cmd
+                            stats['intervals'] = ColumnarIntervals() if compact_intervals else []
+                            stats['test'] = '{operation_i}_{operation}'.format(
+                                operation_i=operation_i, operation=cmd.strip().split(' ')[0]).replace(" ", "_")
+                            logger.info('Running stress operation : {cmd}  ...'.format(cmd=cmd))
+                            # Run stress:
+                            # (stress takes the stats as a parameter, and adds
+                            #  more as it runs):
+                            stress_sha = stress_shas[operation.get('stress_revision', 'default')]
+                            stats = stress(cmd, revision, stress_sha, stats=stats)
+                            # Wait for all compactions to finish (unless disabled):
+                            if operation.get('wait_for_compaction', True):
+                                compaction_throughput = revision_config.get("compaction_throughput_mb_per_sec", 16)
+                                wait_for_compaction(compaction_throughput=compaction_throughput)
+
+                        elif operation['type'] == 'nodetool':
+                            if 'nodes' not in operation:
+                                operation['nodes'] = 'all'
+                            if operation['nodes'] in ['all','ALL']:
+                                nodes = [n for n in fab_config['hosts']]
+                            else:
+                                nodes = operation['nodes']
+
+                            set_nodetool_path(os.path.join(product.get_bin_path(), 'nodetool'))
+                            logger.info("Running nodetool on {nodes} with command: {command}".format(nodes=operation['nodes'], command=operation['command']))
+                            stats['command'] = operation['command']
+                            output = nodetool_multi(nodes, operation['command'])
+                            stats['output'] = output
+                            logger.info("Nodetool command finished on all nodes")
+
+                        elif operation['type'] == 'cqlsh':
+                            logger.info("Running cqlsh commands on {node}".format(node=operation['node']))
+                            set_cqlsh_path(os.path.join(product.get_bin_path(), 'cqlsh'))
+                            output = cqlsh(operation['script'], operation['node'])
+                            stats['output'] = output.split("\n")
+                            stats['command'] = operation['script']
+                            logger.info("Cqlsh commands finished")
+
+                        elif operation['type'] == 'bash':
+                            nodes = operation.get('nodes', [n for n in fab_config['hosts']])
+                            logger.info("Running bash commands on: {nodes}".format(nodes=nodes))
+                            stats['output'] = bash(operation['script'], nodes)
+                            stats['command'] = operation['script']
+                            logger.info("Bash commands finished")
+
+                        elif operation['type'] == 'spark_cassandra_stress':
+                            nodes = operation.get('nodes', [n for n in fab_config['hosts']])
+                            stress_node = config.get('stress_node', None)
+                            # Note: once we have https://datastax.jira.com/browse/CSTAR-617, we should fix this to use
+                            # client-tool when DSE_VERSION >= 4.8.0
+                            # https://datastax.jira.com/browse/DSP-6025: dse client-tool
+                            master_regex = re.compile(r"(.|\n)*(?P<master>spark:\/\/\d+.\d+.\d+.\d+:\d+)(.|\n)*")
+                            master_out = dsetool_cmd(nodes[0], options='sparkmaster')[nodes[0]]
+                            master_match = master_regex.match(master_out)
+                            if not master_match:
+                                raise ValueError('Could not find master address from "dsetool sparkmaster" cmd\n'
+                                                 'Found output: {f}'.format(f=master_out))
+                            master_string = master_match.group('master')
+                            build_spark_cassandra_stress = bool(distutils.util.strtobool(
+                                str(operation.get('build_spark_cassandra_stress', 'True'))))
+                            remove_existing_spark_data = bool(distutils.util.strtobool(
+                                str(operation.get('remove_existing_spark_data', 'True'))))
+                            logger.info("Running spark_cassandra_stress on {stress_node} "
+                                        "using spark.cassandra.connection.host={node} and "
+                                        "spark-master {master}".format(stress_node=stress_node,
+                                                                       node=nodes[0],
+                                                                       master=master_string))
+                            output = spark_cassandra_stress(operation['script'], nodes, stress_node=stress_node,
+                                                            master=master_string,
+                                                            build_spark_cassandra_stress=build_spark_cassandra_stress,
+                                                            remove_existing_spark_data=remove_existing_spark_data)
+                            stats['output'] = output.get('output', 'No output captured')
+                            stats['spark_cass_stress_time_in_seconds'] = output.get('stats', {}).get('TimeInSeconds', 'No time captured')
+                            stats['spark_cass_stress_ops_per_second'] = output.get('stats', {}).get('OpsPerSecond', 'No ops/s captured')
+                            logger.info("spark_cassandra_stress finished")
+
+                        elif operation['type'] == 'ctool':
+                            logger.info("Running ctool with parameters: {command}".format(command=operation['command']))
+                            ctool = Ctool(operation['command'], common.config)
+                            output = execute(ctool.run)
+                            stats['output'] = output
+                            logger.info("ctool finished")
+
+                        elif operation['type'] == 'dsetool':
+                            if 'nodes' not in operation:
+                                operation['nodes'] = 'all'
+                            if operation['nodes'] in ['all','ALL']:
+                                nodes = [n for n in fab_config['hosts']]
+                            else:
+                                nodes = operation['nodes']
+
+                            dsetool_options = operation['script']
+                            logger.info("Running dsetool {command} on {nodes}".format(nodes=operation['nodes'], command=dsetool_options))
+                            stats['command'] = dsetool_options
+                            output = dsetool_cmd(nodes=nodes, options=dsetool_options)
+                            stats['output'] = output
+                            logger.info("dsetool command finished on all nodes")
+
+                        elif operation['type'] == 'dse':
+                            logger.info("Running dse command on {node}".format(node=operation['node']))
+                            output = dse_cmd(node=operation['node'], options=operation['script'])
+                            stats['output'] = output.split("\n")
+                            stats['command'] = operation['script']
+                            logger.info("dse commands finished")
+
+                        end = datetime.datetime.now()
+                        stats['end_date'] = end.isoformat()
+                        stats['op_duration'] = str(end - start)
+                        log_stats(stats, file=log, compact=compact_intervals, journal=True)
+                    finally:
+                        revision_config['last_log'] = stats['id']
+
+                    if capture_fincore:
+                        stop_fincore_capture()
+                        log_dir = os.path.join(CSTAR_PERF_LOGS_DIR, stats['id'])
+                        retrieve_fincore_logs(log_dir)
+                        # Restart fincore capture if this is not the last
+                        # operation:
+                        if operation_i < len(operations):
+                            start_fincore_capture(interval=10)
+            finally:
+                # Stream the node logs into the job's log archive:
+                retrieve_logs_to_archive(log_archive, 'revision_{rev:02d}'.format(rev=rev_num+1),
+                                         max_file_size=log_max_file_size, include=log_include, exclude=log_exclude)
 
             if flamegraph.is_enabled(revision_config):
                 # Generate and Copy node flamegraphs
@@ -416,7 +447,8 @@ def stress_compare(revisions,
 
             log_add_data(log, {'title':title,
                                'subtitle': subtitle,
-                               'revisions': revisions})
+                               'revisions': revisions},
+                         compact=compact_intervals, journal=True)
             if teardown_after_test:
                 if revisions[-1].get('leave_data', leave_data):
                     teardown(destroy=False, leave_data=True)
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..benchmark import (StressOutputParser, log_stats, log_add_data, compact_stats_journal,
+                         stats_journal, get_stats_journal_path)
+from ..intervals import ColumnarIntervals, load_stats
+
+STRESS_OUTPUT = """\
+Running WRITE with 50 threads for 10000 iteration
+type       total ops,    op/s,    pk/s,   row/s,    mean,     med,     .95,     .99,    .999,     max,   time,   stderr, errors,  gc: #,  max ms,  sum ms,  sdv ms,      mb
+WRITE,          1000,    1000,    1000,    1000,     1.0,     0.9,     2.0,     3.0,     4.0,     5.0,    1.0,  0.00000,      0,      0,       0,       0,       0,       0
+total,          1000,    1000,    1000,    1000,     1.0,     0.9,     2.0,     3.0,     4.0,     5.0,    1.0,  0.00000,      0,      0,       0,       0,       0,       0
+total,          3000,    2000,    2000,    2000,     1.5,     1.2,     2.5,     3.5,     4.5,     5.5,    2.0,  0.01000,      0,      0,       0,       0,       0,       0
+total, not, a, number
+
+
+Results:
+op rate                   : 1500 [WRITE:1500]
+Latency mean              : 1.3 [WRITE:1.3]
+Total operation time      : 00:00:02
+END
+"""
+
+
+class TestStressOutputParser(unittest.TestCase):
+    def parse(self, output, on_interval=None):
+        stats = {'intervals': []}
+        parser = StressOutputParser(stats, on_interval=on_interval)
+        for line in output.splitlines(True):
+            parser.feed(line)
+        return stats
+
+    def test_intervals(self):
+        stats = self.parse(STRESS_OUTPUT)
+        # Only the total rows are kept, and unparsable ones are skipped:
+        self.assertEquals(len(stats['intervals']), 2)
+        self.assertEquals(stats['intervals'][0][:3], [1000.0, 1000.0, 1000.0])
+        self.assertEquals(stats['intervals'][1][:2], [3000.0, 2000.0])
+
+    def test_aggregates(self):
+        stats = self.parse(STRESS_OUTPUT)
+        self.assertEquals(stats['op rate'], '1500 [WRITE:1500]')
+        self.assertEquals(stats['latency mean'], '1.3 [WRITE:1.3]')
+        # Values may contain the separator:
+        self.assertEquals(stats['total operation time'], '00:00:02')
+        self.assertFalse('end' in stats)
+
+    def test_on_interval(self):
+        seen = []
+        stats = self.parse(STRESS_OUTPUT, on_interval=seen.append)
+        self.assertEquals(seen, stats['intervals'])
+
+    def test_no_intervals_before_header(self):
+        stats = self.parse("total, 1, 2, 3\n")
+        self.assertEquals(stats['intervals'], [])
+
+
+class TestStatsJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'stats.json')
+        self.journal = get_stats_journal_path(self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def stats(self, id):
+        return {'id': id, 'intervals': ColumnarIntervals(rows=[[1.0, 2.0], [3.0, 4.0]])}
+
+    def test_journal_matches_direct_log(self):
+        direct = os.path.join(self.tmp_dir, 'direct.json')
+        for file, journal in ((self.log, True), (direct, False)):
+            log_stats(self.stats('a'), file=file, journal=journal)
+            log_add_data(file, {'title': 'Title', 'subtitle': 'Subtitle'}, journal=journal)
+            log_stats(self.stats('b'), memo='memo', file=file, journal=journal)
+        self.assertFalse(os.path.exists(self.log))
+        compact_stats_journal(self.log)
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEquals(load_stats(self.log), load_stats(direct))
+
+    def test_compact_appends_to_existing_log(self):
+        log_stats(self.stats('a'), file=self.log)
+        log_stats(self.stats('b'), file=self.log, journal=True)
+        compact_stats_journal(self.log, compact=True)
+        log = load_stats(self.log)
+        self.assertEquals([s['id'] for s in log['stats']], ['a', 'b'])
+        self.assertEquals(log['stats'][1]['intervals'], [[1.0, 2.0], [3.0, 4.0]])
+
+    def test_recover_truncated_record(self):
+        log_stats(self.stats('a'), file=self.log, journal=True)
+        log_stats(self.stats('b'), file=self.log, journal=True)
+        # Killed in the middle of writing the last record:
+        with open(self.journal) as f:
+            data = f.read()
+        with open(self.journal, 'w') as f:
+            f.write(data[:-10])
+        compact_stats_journal(self.log)
+        self.assertEquals([s['id'] for s in load_stats(self.log)['stats']], ['a'])
+
+    def test_not_a_journal(self):
+        with open(self.journal, 'w') as f:
+            f.write(json.dumps({'title': 'stats'}) + '\n')
+        self.assertRaises(ValueError, compact_stats_journal, self.log)
+
+    def test_stats_journal_compacts_on_error(self):
+        try:
+            with stats_journal(self.log):
+                log_stats(self.stats('a'), file=self.log, journal=True)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEquals([s['id'] for s in load_stats(self.log)['stats']], ['a'])
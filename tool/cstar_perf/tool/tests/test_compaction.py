@@ -0,0 +1,68 @@
+import imp
+import json
+import os
+import unittest
+
+# compaction.py is uploaded to and run on the nodes, it isn't part of the package:
+COMPACTION_SCRIPT = os.path.join(os.path.dirname(__file__), os.path.pardir, 'scripts', 'compaction.py')
+
+IDLE_COMPACTIONSTATS = "pending tasks: 0\n"
+BUSY_COMPACTIONSTATS = "pending tasks: 3\n   compaction type   keyspace   table   completed   total   unit   progress\n"
+CONNECTION_FAILURE = "nodetool: Failed to connect to '127.0.0.1:7199' - ConnectException: 'Connection refused'."
+TPSTATS = """Pool Name                    Active   Pending      Completed   Blocked  All time blocked
+MutationStage                     0         0          12345         0                 0
+CompactionExecutor                {active}         {pending}             42         0                 0
+"""
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestCompactionIdle(unittest.TestCase):
+    def setUp(self):
+        self.compaction = imp.load_source('compaction', COMPACTION_SCRIPT)
+        self.outputs = {}
+        self.compaction.nodetool = lambda nodetool_cmd, java_home, cmd: self.outputs[cmd].pop(0)
+        self.clock = self.compaction.time = FakeClock()
+
+    def is_idle(self, compactionstats, tpstats=None):
+        self.outputs = {'compactionstats': [compactionstats], 'tpstats': [tpstats]}
+        return self.compaction.is_idle('nodetool', '/java')
+
+    def test_is_idle(self):
+        self.assertTrue(self.is_idle(IDLE_COMPACTIONSTATS, TPSTATS.format(active=0, pending=0)))
+        self.assertFalse(self.is_idle(IDLE_COMPACTIONSTATS, TPSTATS.format(active=1, pending=0)))
+        self.assertFalse(self.is_idle(IDLE_COMPACTIONSTATS, TPSTATS.format(active=0, pending=2)))
+        self.assertFalse(self.is_idle(BUSY_COMPACTIONSTATS))
+        # Without CompactionExecutor in tpstats, compactionstats decides:
+        self.assertTrue(self.is_idle(IDLE_COMPACTIONSTATS, "Pool Name  Active  Pending\n"))
+
+    def test_is_idle_connection_failure(self):
+        self.assertEquals(self.is_idle(CONNECTION_FAILURE), None)
+        self.assertEquals(self.is_idle(IDLE_COMPACTIONSTATS, CONNECTION_FAILURE), None)
+
+    def wait_for_idle(self, idle, stability_window=10, allowed_connection_errors=2):
+        states = list(idle)
+        self.compaction.is_idle = lambda nodetool_cmd, java_home: states.pop(0)
+        return json.loads(self.compaction.wait_for_idle('nodetool', '/java', 5, stability_window,
+                                                        allowed_connection_errors))
+
+    def test_wait_for_idle(self):
+        # Idle at 10s, busy again at 15s, then idle from 20s on:
+        result = self.wait_for_idle([False, False, True, False, True, True, True])
+        self.assertEquals(result, {'duration': 20, 'checks': 7})
+
+    def test_wait_for_idle_connection_errors(self):
+        # A connection error doesn't reset the stability window:
+        self.assertEquals(self.wait_for_idle([True, None, True, True]), {'duration': 0, 'checks': 3})
+        result = self.wait_for_idle([None, None, None])
+        self.assertEquals(result['checks'], 3)
+        self.assertTrue('error' in result)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..intervals import (ColumnarIntervals, decode_intervals, dumps_stats, loads_stats,
+                         load_stats, is_columnar)
+
+ROWS = [[1.0, 10.0, 0.5], [2.0, 20.0, 0.25], [3.0, 30.0, 0.125]]
+
+
+class TestColumnarIntervals(unittest.TestCase):
+    def test_list_interface(self):
+        intervals = ColumnarIntervals(rows=ROWS)
+        self.assertEquals(len(intervals), 3)
+        self.assertEquals(intervals[1], ROWS[1])
+        self.assertEquals(list(intervals), ROWS)
+        self.assertEquals(intervals.tolist(), ROWS)
+        self.assertEquals(list(intervals.column(1)), [10.0, 20.0, 30.0])
+        self.assertEquals(intervals, ROWS)
+
+    def test_empty(self):
+        intervals = ColumnarIntervals()
+        self.assertEquals(len(intervals), 0)
+        self.assertEquals(intervals.tolist(), [])
+        intervals.append([1, 2])
+        self.assertEquals(intervals.tolist(), [[1.0, 2.0]])
+
+    def test_append_wrong_width(self):
+        intervals = ColumnarIntervals(rows=ROWS)
+        self.assertRaises(ValueError, intervals.append, [1.0])
+
+    def test_json_round_trip(self):
+        data = ColumnarIntervals(rows=ROWS).to_json()
+        self.assertTrue(is_columnar(data))
+        self.assertEquals(decode_intervals(data), ROWS)
+        self.assertEquals(decode_intervals(data, columnar=True), ColumnarIntervals(rows=ROWS))
+        # The list of rows format is read either way too:
+        self.assertEquals(decode_intervals(ROWS), ROWS)
+        self.assertEquals(decode_intervals(ROWS, columnar=True), ColumnarIntervals(rows=ROWS))
+
+
+class TestStatsLog(unittest.TestCase):
+    def setUp(self):
+        self.log = {'title': 'Test', 'stats': [{'id': 'a', 'intervals': ColumnarIntervals(rows=ROWS)},
+                                               {'id': 'b', 'type': 'nodetool'}]}
+
+    def test_round_trip(self):
+        for compact in (False, True):
+            data = dumps_stats(self.log, compact=compact)
+            self.assertEquals(loads_stats(data)['stats'][0]['intervals'], ROWS)
+            log = loads_stats(data, columnar=True)
+            self.assertEquals(log['stats'][0]['intervals'], ColumnarIntervals(rows=ROWS))
+            self.assertEquals(log['stats'][1], {'id': 'b', 'type': 'nodetool'})
+
+    def test_compact_is_columnar(self):
+        self.assertTrue('"format":"columnar"' in dumps_stats(self.log, compact=True))
+        self.assertFalse('columnar' in dumps_stats(self.log))
+
+    def test_load_stats(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'stats.json')
+            with open(path, 'w') as f:
+                f.write(dumps_stats(self.log, compact=True))
+            self.assertEquals(load_stats(path)['stats'][0]['intervals'], ROWS)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,81 @@
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from ..log_archive import (append_tar_stream, append_log_archive, finish_log_archive,
+                           finishing_log_archive)
+
+
+def tar_stream(files, mode='w:gz'):
+    """Make a tar stream of (name, contents) files, like tar czf - would"""
+    data = io.BytesIO()
+    tar = tarfile.open(fileobj=data, mode=mode)
+    for name, contents in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        tar.addfile(info, io.BytesIO(contents))
+    tar.close()
+    data.seek(0)
+    return data
+
+
+class TestLogArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, 'logs.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_archive(self):
+        tar = tarfile.open(self.archive)
+        try:
+            return dict((m.name, tar.extractfile(m).read()) for m in tar)
+        finally:
+            tar.close()
+
+    def test_append(self):
+        self.assertEquals(append_tar_stream(self.archive, tar_stream([('./system.log', b'a' * 1000)]), 'r1/n1'), 1)
+        # Uncompressed streams are read too:
+        self.assertEquals(append_tar_stream(self.archive, tar_stream([('debug.log', b'b')], mode='w'), 'r2/n1'), 1)
+        finish_log_archive(self.archive)
+        self.assertEquals(self.read_archive(), {'r1/n1/system.log': b'a' * 1000, 'r2/n1/debug.log': b'b'})
+
+    def test_include_exclude(self):
+        files = [('system.log', b'1'), ('debug.log', b'2'), ('gc/gc.log.0', b'3'), ('nohup.out', b'4')]
+        append_tar_stream(self.archive, tar_stream(files), 'r1', include=['*.log', 'gc.log.*'],
+                          exclude=['debug.log'])
+        self.assertEquals(sorted(self.read_archive()), ['r1/gc/gc.log.0', 'r1/system.log'])
+
+    def test_max_file_size(self):
+        append_tar_stream(self.archive, tar_stream([('system.log', b'head' + b'x' * 600 + b'tail')]), 'r1',
+                          max_file_size=10)
+        # The end of large files is kept:
+        self.assertEquals(self.read_archive(), {'r1/system.log': b'xxxxxxtail'})
+
+    def test_append_parts(self):
+        parts = []
+        for node in ('n1', 'n2'):
+            part = '{archive}.{node}'.format(archive=self.archive, node=node)
+            append_tar_stream(part, tar_stream([('system.log', node.encode())]), 'r1/' + node)
+            parts.append(part)
+        with finishing_log_archive(self.archive):
+            for part in parts:
+                append_log_archive(self.archive, part)
+        self.assertEquals(self.read_archive(), {'r1/n1/system.log': b'n1', 'r1/n2/system.log': b'n2'})
+        self.assertEquals(os.listdir(self.tmp_dir), ['logs.tar.gz'])
+
+    def test_finished_on_error(self):
+        append_tar_stream(self.archive, tar_stream([('system.log', b'a')]), 'r1')
+        try:
+            with finishing_log_archive(self.archive):
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEquals(self.read_archive(), {'r1/system.log': b'a'})
+        with gzip.open(self.archive) as f:
+            self.assertTrue(f.read().endswith(tarfile.NUL * tarfile.BLOCKSIZE * 2))